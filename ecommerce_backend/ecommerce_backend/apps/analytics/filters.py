@@ -0,0 +1,7 @@
+import django_filters
+
+
+class SalesFilter(django_filters.FilterSet):
+    # Both ends inclusive, like OrderFilter. No Meta.model, it filters every rollup table.
+    date_from = django_filters.DateFilter(field_name='date', lookup_expr='gte')
+    date_to = django_filters.DateFilter(field_name='date', lookup_expr='lte')
@@ -0,0 +1,57 @@
+from django.db import models
+from apps.products.models import Category, Product
+
+# Paid, not cancelled orders rolled up per day of their creation. Maintained
+# incrementally by rollups.py, rebuilt with `manage.py rebuild_sales_rollups`.
+
+class DailySales(models.Model):
+    date = models.DateField(unique=True)
+    orders = models.PositiveIntegerField(default=0)
+    units = models.PositiveIntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)  # Items, before tax and shipping
+    total_amount = models.DecimalField(max_digits=14, decimal_places=2, default=0)  # Including tax and shipping
+
+    class Meta:
+        db_table = 'sales_daily'
+        ordering = ['date']
+
+    def __str__(self):
+        return f"Sales {self.date}"
+
+class DailyProductSales(models.Model):
+    date = models.DateField()
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='daily_sales')
+    orders = models.PositiveIntegerField(default=0)
+    units = models.PositiveIntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    class Meta:
+        db_table = 'sales_daily_products'
+        constraints = [
+            models.UniqueConstraint(fields=['date', 'product'], name='sales_daily_products_date_product_unique'),
+        ]
+        indexes = [
+            models.Index(fields=['product', 'date']),
+        ]
+
+    def __str__(self):
+        return f"Sales {self.date} - product {self.product_id}"
+
+class DailyCategorySales(models.Model):
+    date = models.DateField()
+    category = models.ForeignKey(Category, on_delete=models.CASCADE, related_name='daily_sales')
+    orders = models.PositiveIntegerField(default=0)
+    units = models.PositiveIntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    class Meta:
+        db_table = 'sales_daily_categories'
+        constraints = [
+            models.UniqueConstraint(fields=['date', 'category'], name='sales_daily_categories_date_category_unique'),
+        ]
+        indexes = [
+            models.Index(fields=['category', 'date']),
+        ]
+
+    def __str__(self):
+        return f"Sales {self.date} - category {self.category_id}"
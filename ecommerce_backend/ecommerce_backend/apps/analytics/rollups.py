@@ -0,0 +1,161 @@
+"""
+Incremental sales rollups.
+
+An order counts towards the rollups of the day it was created (in
+`TIME_ZONE`) once it is paid, and stops counting when it is cancelled.
+`record_paid` and `record_cancelled` add or remove the contribution of a set
+of orders with `UPDATE ... SET x = x + n` on the affected rows, and are
+called in the same transaction as the status change. Category rollups use
+the category stored on the order item at checkout, so a product moved to
+another category is taken out of the one it was sold in. `rebuild` recomputes a
+date range from the orders, archived ones included, for backfills and repairs.
+"""
+import logging
+from collections import defaultdict
+from datetime import datetime, time, timedelta
+from decimal import Decimal
+
+from django.db import IntegrityError, transaction
+from django.db.models import F, Max, Min
+from django.utils import timezone
+
+from apps.orders.models import ArchivedOrder, ArchivedOrderItem, Order, OrderItem
+from .models import DailyCategorySales, DailyProductSales, DailySales
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1000
+
+
+def day_start(day):
+    """Start of `day` in the current time zone, as an aware datetime."""
+    return timezone.make_aware(datetime.combine(day, time.min))
+
+
+def counted_orders(model=Order):
+    """Orders the rollups are made of."""
+    return model.objects.filter(payment_status='paid').exclude(status='cancelled')
+
+
+def _new_totals():
+    return {'orders': 0, 'units': 0, 'revenue': Decimal('0')}
+
+
+def _accumulate(order_ids, days, products, categories, order_model=Order, item_model=OrderItem):
+    """Add the contributions of `order_ids` to the three per-key total dicts."""
+    order_days = {}
+    for pk, created_at, total_amount in order_model.objects.filter(pk__in=order_ids).values_list(
+        'pk', 'created_at', 'total_amount'
+    ):
+        day = timezone.localdate(created_at)
+        order_days[pk] = day
+        days[day]['orders'] += 1
+        days[day]['total_amount'] += total_amount
+
+    order_categories = set()
+    items = item_model.objects.filter(order_id__in=order_ids).values_list(
+        'order_id', 'product_id', 'category_id', 'quantity', 'total_price'
+    )
+    for order_id, product_id, category_id, quantity, total_price in items:
+        day = order_days[order_id]
+        days[day]['units'] += quantity
+        days[day]['revenue'] += total_price
+        for totals in (products[(day, product_id)], categories[(day, category_id)]):
+            totals['units'] += quantity
+            totals['revenue'] += total_price
+        # Checkout merges lines, so a product appears once per order but a category may not
+        products[(day, product_id)]['orders'] += 1
+        if (order_id, category_id) not in order_categories:
+            order_categories.add((order_id, category_id))
+            categories[(day, category_id)]['orders'] += 1
+
+
+def _contributions(order_ids, archived_ids=()):
+    days = defaultdict(lambda: {**_new_totals(), 'total_amount': Decimal('0')})
+    products = defaultdict(_new_totals)
+    categories = defaultdict(_new_totals)
+    for ids, models in ((order_ids, (Order, OrderItem)), (archived_ids, (ArchivedOrder, ArchivedOrderItem))):
+        for start in range(0, len(ids), CHUNK_SIZE):
+            _accumulate(ids[start:start + CHUNK_SIZE], days, products, categories, *models)
+    return [
+        (DailySales, {(day,): totals for day, totals in days.items()}, ('date',)),
+        (DailyProductSales, products, ('date', 'product_id')),
+        (DailyCategorySales, categories, ('date', 'category_id')),
+    ]
+
+
+def _add(model, key_fields, key, totals, sign):
+    lookup = dict(zip(key_fields, key))
+    changes = {name: F(name) + sign * value for name, value in totals.items()}
+    if model.objects.filter(**lookup).update(**changes):
+        return
+    if sign < 0:
+        # Nothing to take the sale out of, the rollups no longer match the orders
+        logger.warning('No %s row for %s to remove %s from, rebuild the rollups', model.__name__, lookup, totals)
+        return
+    try:
+        with transaction.atomic():
+            model.objects.create(**lookup, **totals)
+    except IntegrityError:
+        # Created concurrently, add to it instead
+        model.objects.filter(**lookup).update(**changes)
+
+
+def _apply(order_ids, sign):
+    order_ids = list(order_ids)
+    if not order_ids:
+        return
+    with transaction.atomic():
+        for model, rows, key_fields in _contributions(order_ids):
+            # A fixed order keeps concurrent updates from deadlocking each other
+            for key in sorted(rows):
+                _add(model, key_fields, key, rows[key], sign)
+
+
+def record_paid(order_ids):
+    """Count orders that just became paid (cancelled ones are skipped)."""
+    _apply(counted_orders().filter(pk__in=list(order_ids)).values_list('pk', flat=True), 1)
+
+
+def record_cancelled(order_ids):
+    """Stop counting paid orders that were just cancelled."""
+    _apply(order_ids, -1)
+
+
+def rebuild(date_from=None, date_to=None):
+    """Recompute the rollups for a range of days (inclusive), all of them by default."""
+    sources = (counted_orders(), counted_orders(ArchivedOrder))
+    if date_from is None or date_to is None:
+        bounds = [
+            orders.aggregate(first=Min('created_at'), last=Max('created_at')) for orders in sources
+        ]
+        firsts = [b['first'] for b in bounds if b['first'] is not None]
+        if not firsts:
+            date_from = date_to = timezone.localdate()
+        else:
+            date_from = date_from or timezone.localdate(min(firsts))
+            date_to = date_to or timezone.localdate(max(b['last'] for b in bounds if b['last'] is not None))
+
+    rows = 0
+    day = date_from
+    # A day at a time keeps memory bounded by what was sold on one day
+    while day <= date_to:
+        order_ids, archived_ids = [
+            list(
+                orders.filter(created_at__gte=day_start(day), created_at__lt=day_start(day + timedelta(days=1)))
+                .values_list('pk', flat=True)
+            )
+            for orders in sources
+        ]
+        with transaction.atomic():
+            for model in (DailySales, DailyProductSales, DailyCategorySales):
+                model.objects.filter(date=day).delete()
+            if order_ids or archived_ids:
+                for model, totals_by_key, key_fields in _contributions(order_ids, archived_ids):
+                    model.objects.bulk_create([
+                        model(**dict(zip(key_fields, key)), **totals)
+                        for key, totals in totals_by_key.items()
+                    ], batch_size=CHUNK_SIZE)
+                    rows += len(totals_by_key)
+        day += timedelta(days=1)
+    return rows
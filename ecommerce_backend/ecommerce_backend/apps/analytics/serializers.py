@@ -0,0 +1,29 @@
+from rest_framework import serializers
+from .models import DailySales
+
+class DailySalesSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = DailySales
+        fields = ('date', 'orders', 'units', 'revenue', 'total_amount')
+
+class SalesTotalsSerializer(serializers.Serializer):
+    orders = serializers.IntegerField()
+    units = serializers.IntegerField()
+    revenue = serializers.DecimalField(max_digits=14, decimal_places=2)
+    total_amount = serializers.DecimalField(max_digits=14, decimal_places=2)
+
+class ProductSalesSerializer(serializers.Serializer):
+    product = serializers.IntegerField(source='product_id')
+    name = serializers.CharField(source='product__name')
+    sku = serializers.CharField(source='product__sku')
+    orders = serializers.IntegerField()
+    units = serializers.IntegerField()
+    revenue = serializers.DecimalField(max_digits=14, decimal_places=2)
+
+class CategorySalesSerializer(serializers.Serializer):
+    category = serializers.IntegerField(source='category_id')
+    name = serializers.CharField(source='category__name')
+    slug = serializers.CharField(source='category__slug')
+    orders = serializers.IntegerField()
+    units = serializers.IntegerField()
+    revenue = serializers.DecimalField(max_digits=14, decimal_places=2)
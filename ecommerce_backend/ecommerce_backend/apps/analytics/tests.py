@@ -0,0 +1,150 @@
+from datetime import timedelta
+from decimal import Decimal
+
+from django.contrib.auth import get_user_model
+from django.test import TestCase
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from apps.orders.gateway import FakeGateway
+from apps.orders.models import Order
+from apps.orders.payments import process_jobs
+from apps.products.models import Category, Product
+from .models import DailyCategorySales, DailyProductSales, DailySales
+from .rollups import rebuild
+
+SHIPPING = {
+    'shipping_address': '1 Main St',
+    'shipping_city': 'Springfield',
+    'shipping_state': 'IL',
+    'shipping_zipcode': '62701',
+}
+
+
+class SalesRollupTests(TestCase):
+    def setUp(self):
+        User = get_user_model()
+        self.user = User.objects.create_user(username='buyer', email='buyer@example.com', password='secret')
+        self.admin = User.objects.create_superuser(username='admin', email='admin@example.com', password='secret')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.books = Category.objects.create(name='Books', slug='books')
+        self.games = Category.objects.create(name='Games', slug='games')
+        self.novel = Product.objects.create(
+            name='Novel', slug='novel', sku='N1', description='', price=Decimal('10.00'), category=self.books, stock=100
+        )
+        self.atlas = Product.objects.create(
+            name='Atlas', slug='atlas', sku='A1', description='', price=Decimal('25.00'), category=self.books, stock=100
+        )
+        self.chess = Product.objects.create(
+            name='Chess', slug='chess', sku='C1', description='', price=Decimal('40.00'), category=self.games, stock=100
+        )
+
+    def order(self, *lines, pay=True):
+        response = self.client.post('/api/orders/orders/', {
+            **SHIPPING, 'items': [{'product': product.pk, 'quantity': quantity} for product, quantity in lines],
+        }, format='json')
+        order_id = response.data['id']
+        if pay:
+            self.client.post(f'/api/orders/orders/{order_id}/create_payment/', {'payment_method': 'paypal'})
+            process_jobs(FakeGateway())
+        return order_id
+
+    def snapshot(self):
+        return (
+            list(DailySales.objects.values_list('date', 'orders', 'units', 'revenue', 'total_amount')),
+            sorted(DailyProductSales.objects.values_list('date', 'product_id', 'orders', 'units', 'revenue')),
+            sorted(DailyCategorySales.objects.values_list('date', 'category_id', 'orders', 'units', 'revenue')),
+        )
+
+    def test_paid_orders_are_rolled_up_and_cancellations_removed(self):
+        first = self.order((self.novel, 2), (self.atlas, 1), (self.chess, 1))
+        self.order((self.novel, 1))
+        self.order((self.chess, 3), pay=False)
+
+        today = timezone.localdate()
+        day = DailySales.objects.get()
+        self.assertEqual((day.date, day.orders, day.units, day.revenue), (today, 2, 5, Decimal('95.00')))
+        books = DailyCategorySales.objects.get(category=self.books)
+        self.assertEqual((books.orders, books.units, books.revenue), (2, 4, Decimal('55.00')))
+        self.assertEqual(DailyProductSales.objects.get(product=self.chess).units, 1)
+
+        self.client.post(f'/api/orders/orders/{first}/cancel/')
+        day.refresh_from_db()
+        self.assertEqual((day.orders, day.units, day.revenue), (1, 1, Decimal('10.00')))
+        self.assertEqual(DailyProductSales.objects.get(product=self.chess).units, 0)
+
+    def test_cancellation_after_recategorizing_a_product(self):
+        order_id = self.order((self.novel, 2))
+        self.novel.category = self.games
+        self.novel.save()
+
+        with self.assertNoLogs('apps.analytics.rollups', level='WARNING'):
+            self.client.post(f'/api/orders/orders/{order_id}/cancel/')
+        # Taken out of the category it was sold in, not the one it is in now
+        books = DailyCategorySales.objects.get(category=self.books)
+        self.assertEqual((books.orders, books.units, books.revenue), (0, 0, Decimal('0')))
+        self.assertFalse(DailyCategorySales.objects.filter(category=self.games).exists())
+
+    def test_missing_rollup_rows_are_reported(self):
+        order_id = self.order((self.chess, 1))
+        DailyCategorySales.objects.all().delete()
+
+        with self.assertLogs('apps.analytics.rollups', level='WARNING') as logs:
+            self.client.post(f'/api/orders/orders/{order_id}/cancel/')
+        self.assertIn('DailyCategorySales', logs.output[0])
+        self.assertEqual(DailySales.objects.get().orders, 0)
+
+    def test_rebuild_matches_incremental_rollups(self):
+        self.order((self.novel, 2), (self.chess, 1))
+        self.order((self.atlas, 4))
+        cancelled = self.order((self.novel, 1))
+        self.client.post(f'/api/orders/orders/{cancelled}/cancel/')
+        # Placed a few days ago, paid today
+        old = self.order((self.atlas, 1), pay=False)
+        Order.objects.filter(pk=old).update(created_at=timezone.now() - timedelta(days=3))
+        self.client.post(f'/api/orders/orders/{old}/create_payment/', {'payment_method': 'paypal'})
+        process_jobs(FakeGateway())
+        incremental = self.snapshot()
+        self.assertEqual(len(incremental[0]), 2)
+
+        DailySales.objects.all().delete()
+        DailyProductSales.objects.all().delete()
+        DailyCategorySales.objects.all().delete()
+        rebuild()
+
+        # Zeroed rows left behind by the cancellation aren't recreated
+        self.assertEqual(self.snapshot(), tuple(
+            [row for row in rows if row[-2] or row[-3]] for rows in incremental
+        ))
+
+    def test_analytics_endpoints(self):
+        self.order((self.novel, 2), (self.chess, 1))
+        self.order((self.atlas, 1))
+        old = self.order((self.chess, 5))
+        Order.objects.filter(pk=old).update(created_at=timezone.now() - timedelta(days=10))
+        rebuild()
+        today = timezone.localdate()
+
+        self.assertEqual(self.client.get('/api/analytics/sales/').status_code, 403)
+        self.client.force_authenticate(self.admin)
+
+        with self.assertNumQueries(2):
+            response = self.client.get('/api/analytics/sales/', {'date_from': today - timedelta(days=1)})
+        self.assertEqual(response.data['totals']['orders'], 2)
+        self.assertEqual(response.data['totals']['revenue'], '85.00')
+        self.assertEqual(len(response.data['days']), 1)
+
+        response = self.client.get('/api/analytics/sales/', {'date_to': today - timedelta(days=10)})
+        self.assertEqual(response.data['totals']['units'], 5)
+
+        response = self.client.get('/api/analytics/sales/products/', {'limit': 2})
+        self.assertEqual(
+            [(row['sku'], row['units'], row['revenue']) for row in response.data],
+            [('C1', 6, '240.00'), ('A1', 1, '25.00')],
+        )
+        response = self.client.get('/api/analytics/sales/categories/', {'date_from': today})
+        self.assertEqual(
+            [(row['slug'], row['orders'], row['revenue']) for row in response.data],
+            [('books', 2, '45.00'), ('games', 1, '40.00')],
+        )
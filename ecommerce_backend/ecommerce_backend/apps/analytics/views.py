@@ -0,0 +1,66 @@
+from rest_framework import viewsets
+from rest_framework.decorators import action
+from rest_framework.response import Response
+from rest_framework.permissions import IsAdminUser
+from django_filters.rest_framework import DjangoFilterBackend
+from django.db.models import DecimalField, Sum, Value
+from django.db.models.functions import Coalesce
+from .filters import SalesFilter
+from .models import DailyCategorySales, DailyProductSales, DailySales
+from .serializers import (
+    CategorySalesSerializer, DailySalesSerializer, ProductSalesSerializer, SalesTotalsSerializer
+)
+
+def _sum(field, decimal=False):
+    default = Value(0, output_field=DecimalField()) if decimal else Value(0)
+    return Coalesce(Sum(field), default)
+
+class SalesViewSet(viewsets.GenericViewSet):
+    """Sales aggregates served from the daily rollup tables (see rollups.py)"""
+    queryset = DailySales.objects.all()
+    serializer_class = DailySalesSerializer
+    permission_classes = [IsAdminUser]
+    filter_backends = [DjangoFilterBackend]
+    filterset_class = SalesFilter
+    pagination_class = None
+    DEFAULT_LIMIT = 50
+    MAX_LIMIT = 500
+
+    def get_limit(self):
+        try:
+            limit = int(self.request.query_params.get('limit', self.DEFAULT_LIMIT))
+        except ValueError:
+            limit = self.DEFAULT_LIMIT
+        return max(1, min(limit, self.MAX_LIMIT))
+
+    def list(self, request):
+        """Daily totals between `?date_from=` and `?date_to=` (inclusive), plus the totals over the range"""
+        queryset = self.filter_queryset(self.get_queryset())
+        totals = queryset.aggregate(
+            orders=_sum('orders'), units=_sum('units'),
+            revenue=_sum('revenue', decimal=True), total_amount=_sum('total_amount', decimal=True),
+        )
+        return Response({
+            'totals': SalesTotalsSerializer(totals).data,
+            'days': DailySalesSerializer(queryset, many=True).data,
+        })
+
+    @action(detail=False, methods=['get'])
+    def products(self, request):
+        """Best selling products by revenue over the date range, `?limit=` rows"""
+        rows = self.filter_queryset(DailyProductSales.objects.all()).values(
+            'product_id', 'product__name', 'product__sku'
+        ).annotate(
+            orders=Sum('orders'), units=Sum('units'), revenue=Sum('revenue')
+        ).order_by('-revenue', 'product_id')[:self.get_limit()]
+        return Response(ProductSalesSerializer(rows, many=True).data)
+
+    @action(detail=False, methods=['get'])
+    def categories(self, request):
+        """Best selling categories by revenue over the date range, `?limit=` rows"""
+        rows = self.filter_queryset(DailyCategorySales.objects.all()).values(
+            'category_id', 'category__name', 'category__slug'
+        ).annotate(
+            orders=Sum('orders'), units=Sum('units'), revenue=Sum('revenue')
+        ).order_by('-revenue', 'category_id')[:self.get_limit()]
+        return Response(CategorySalesSerializer(rows, many=True).data)
@@ -0,0 +1,113 @@
+import hashlib
+import json
+
+from django.db.models import Count, Max
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+from rest_framework.response import Response
+
+
+def make_etag(request, *parts):
+    """Strong ETag over `parts`, the full query string and the response format."""
+    renderer = getattr(request, 'accepted_renderer', None)
+    key = json.dumps(
+        [request.get_full_path(), getattr(renderer, 'format', None), *parts],
+        default=str,
+    )
+    return quote_etag(hashlib.md5(key.encode()).hexdigest())
+
+
+def conditional_response(request, etag, last_modified=None):
+    """A 304 (or 412) response when the client's validators match, else None."""
+    timestamp = int(last_modified.timestamp()) if last_modified else None
+    response = get_conditional_response(request, etag=etag, last_modified=timestamp)
+    if response is not None:
+        set_validators(response, etag, last_modified)
+    return response
+
+
+def set_validators(response, etag, last_modified=None):
+    response['ETag'] = etag
+    if last_modified:
+        response['Last-Modified'] = http_date(last_modified.timestamp())
+    return response
+
+
+def respond_with_validators(request, data):
+    """Respond with in-memory `data`, using a hash of it as the ETag."""
+    etag = make_etag(request, data)
+    return conditional_response(request, etag) or set_validators(Response(data), etag)
+
+
+class ConditionalGetMixin:
+    """
+    ETag / Last-Modified support for list and retrieve.
+
+    Validators come from the rows of the page being served (lists) or the
+    `updated_at` of the row (details), so a client that already has the
+    current representation gets a 304 without it being serialized, and the
+    cost stays bounded by the page size however large the filtered queryset
+    is. `conditional_fields` lists the timestamps to take into account, e.g.
+    a related `category__updated_at` for data that is nested into the
+    representation.
+    """
+    conditional_fields = ('updated_at',)
+
+    def get_list_validators(self, queryset, page=None):
+        if page is None:
+            # Unpaginated, the whole queryset is the representation
+            aggregates = {f'max_{index}': Max(field) for index, field in enumerate(self.conditional_fields)}
+            values = queryset.order_by().aggregate(count=Count('pk'), **aggregates)
+            timestamps = [values[key] for key in aggregates if values[key] is not None]
+            last_modified = max(timestamps) if timestamps else None
+            return make_etag(self.request, values['count'], *timestamps), last_modified
+
+        pks = [obj.pk for obj in page]
+        rows = {
+            row[0]: row[1:] for row in
+            queryset.model._base_manager.filter(pk__in=pks).values_list('pk', *self.conditional_fields)
+        }
+        timestamps = [value for pk in pks for value in rows.get(pk, ()) if value is not None]
+        # The links and count are part of the page too
+        paginator = self.paginator
+        state = [paginator.get_next_link(), paginator.get_previous_link(), getattr(paginator, 'count', None)]
+        return make_etag(self.request, pks, timestamps, *state), max(timestamps) if timestamps else None
+
+    def get_object_validators(self):
+        queryset = self.filter_queryset(self.get_queryset())
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        row = queryset.filter(**{self.lookup_field: self.kwargs[lookup_url_kwarg]}).order_by().values(
+            'pk', *self.conditional_fields
+        ).first()
+        if row is None:
+            return None, None
+        timestamps = [row[field] for field in self.conditional_fields if row[field] is not None]
+        return make_etag(self.request, *row.values()), max(timestamps) if timestamps else None
+
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        page = self.paginate_queryset(queryset)
+        etag, last_modified = self.get_list_validators(queryset, page)
+        not_modified = conditional_response(request, etag, last_modified)
+        if not_modified is not None:
+            return not_modified
+
+        if page is not None:
+            serializer = self.get_serializer(page, many=True)
+            response = self.get_paginated_response(serializer.data)
+        else:
+            serializer = self.get_serializer(queryset, many=True)
+            response = Response(serializer.data)
+        return set_validators(response, etag, last_modified)
+
+    def retrieve(self, request, *args, **kwargs):
+        etag, last_modified = self.get_object_validators()
+        if etag is not None:
+            not_modified = conditional_response(request, etag, last_modified)
+            if not_modified is not None:
+                return not_modified
+
+        response = super().retrieve(request, *args, **kwargs)
+        if etag is not None:
+            set_validators(response, etag, last_modified)
+        return response
@@ -0,0 +1,7 @@
+from django.db.backends.mysql import base
+
+from ..pool import PooledDatabaseWrapper
+
+
+class DatabaseWrapper(PooledDatabaseWrapper, base.DatabaseWrapper):
+    """The MySQL backend, with `OPTIONS["pool"]` for a connection pool (see apps.core.db.pool)."""
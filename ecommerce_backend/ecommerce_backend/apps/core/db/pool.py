@@ -0,0 +1,223 @@
+"""
+Process-wide database connection pool.
+
+Django keeps one connection per thread and, with CONN_MAX_AGE, keeps it open
+between requests of that thread. That's no use under ASGI, where requests
+don't stay on one thread, nor with many threads that are mostly idle. With
+`OPTIONS["pool"]` set, PooledDatabaseWrapper instead hands the connection
+back to a pool shared by all threads of the process when Django closes it
+at the end of a request, and takes one from the pool on the next connect.
+So a request costs a checkout instead of a TCP/TLS handshake and login.
+
+Pool options:
+    max_size       connections per process, checked out or idle (10)
+    timeout        seconds to wait for a free connection before failing (5)
+    max_lifetime   seconds after which a connection is closed instead of pooled (600)
+    check_after    idle seconds after which a connection is pinged on checkout (10)
+
+A connection that had errors, was closed inside a transaction or left
+autocommit off is closed instead of going back. One that fails its ping is
+replaced, counted as a reconnect.
+"""
+import threading
+import time
+from collections import deque
+
+from django.db import OperationalError
+
+STATS = ('connects', 'checkouts', 'waits', 'timeouts', 'reconnects', 'discarded')
+DEFAULTS = {'max_size': 10, 'timeout': 5.0, 'max_lifetime': 600.0, 'check_after': 10.0}
+
+
+class ConnectionPool:
+    """Raw DB-API connections, created by `connect()` and pinged by `check(conn)`."""
+
+    def __init__(self, max_size, timeout, max_lifetime, check_after):
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.check_after = check_after
+        # (connection, created, returned), most recently returned last
+        self._idle = deque()
+        self._created = {}
+        self._condition = threading.Condition()
+        self._stats = dict.fromkeys(STATS, 0)
+        self._wait_time = 0.0
+        self._max_wait_time = 0.0
+
+    def acquire(self, connect, check):
+        started = time.monotonic()
+        waited = False
+        with self._condition:
+            self._stats['checkouts'] += 1
+            while not self._idle and len(self._created) >= self.max_size:
+                remaining = self.timeout - (time.monotonic() - started)
+                if remaining <= 0:
+                    self._stats['timeouts'] += 1
+                    raise OperationalError(
+                        f'No database connection free after {self.timeout}s ({self.max_size} in use)'
+                    )
+                waited = True
+                self._condition.wait(remaining)
+            if waited:
+                wait_time = time.monotonic() - started
+                self._stats['waits'] += 1
+                self._wait_time += wait_time
+                self._max_wait_time = max(self._max_wait_time, wait_time)
+            entry = self._idle.pop() if self._idle else None
+            if entry is None:
+                # Reserve the slot before connecting outside the lock
+                token = object()
+                self._created[id(token)] = (token, started)
+
+        if entry is not None:
+            conn, created, returned = entry
+            if time.monotonic() - returned < self.check_after or self._usable(conn, check):
+                return conn
+            with self._condition:
+                self._stats['reconnects'] += 1
+                self._created.pop(id(conn), None)
+                token = object()
+                self._created[id(token)] = (token, started)
+        return self._connect(connect, token)
+
+    def _connect(self, connect, token):
+        try:
+            conn = connect()
+        except BaseException:
+            with self._condition:
+                self._created.pop(id(token))
+                self._condition.notify()
+            raise
+        with self._condition:
+            self._created.pop(id(token))
+            self._created[id(conn)] = (conn, time.monotonic())
+            self._stats['connects'] += 1
+        return conn
+
+    @staticmethod
+    def _usable(conn, check):
+        try:
+            usable = check(conn)
+        except Exception:
+            usable = False
+        if not usable:
+            _close_quietly(conn)
+        return usable
+
+    def release(self, conn, discard=False):
+        """Give back a connection from `acquire()`, closing it when `discard` or too old."""
+        now = time.monotonic()
+        with self._condition:
+            entry = self._created.get(id(conn))
+            if entry is None:
+                discard = True
+            elif discard or now - entry[1] >= self.max_lifetime:
+                del self._created[id(conn)]
+                discard = True
+            else:
+                self._idle.append((conn, entry[1], now))
+            if discard:
+                self._stats['discarded'] += 1
+            self._condition.notify()
+        if discard:
+            _close_quietly(conn)
+
+    def close_idle(self):
+        """Close every idle connection, for shutdown and tests."""
+        with self._condition:
+            idle = [entry[0] for entry in self._idle]
+            self._idle.clear()
+            for conn in idle:
+                self._created.pop(id(conn), None)
+            self._condition.notify_all()
+        for conn in idle:
+            _close_quietly(conn)
+
+    def get_stats(self):
+        with self._condition:
+            stats = dict(self._stats)
+            stats['size'] = len(self._created)
+            stats['idle'] = len(self._idle)
+            stats['max_size'] = self.max_size
+            stats['wait_time'] = round(self._wait_time, 4)
+            stats['max_wait_time'] = round(self._max_wait_time, 4)
+        return stats
+
+
+def _close_quietly(conn):
+    try:
+        conn.close()
+    except Exception:
+        pass
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(alias, options):
+    with _pools_lock:
+        if alias not in _pools:
+            _pools[alias] = ConnectionPool(**{**DEFAULTS, **options})
+        return _pools[alias]
+
+
+def discard_pool(alias):
+    """Forget the pool of `alias`, closing its idle connections."""
+    with _pools_lock:
+        dropped = _pools.pop(alias, None)
+    if dropped is not None:
+        dropped.close_idle()
+
+
+def get_stats():
+    """Stats of every pool in this process, by database alias."""
+    with _pools_lock:
+        pools = dict(_pools)
+    return {alias: pool.get_stats() for alias, pool in pools.items()}
+
+
+class PooledDatabaseWrapper:
+    """
+    Mixin for a backend's DatabaseWrapper, pooling its connections when
+    `OPTIONS["pool"]` is set (True or a dict of pool options) and behaving
+    like the plain backend otherwise.
+    """
+
+    @property
+    def pool(self):
+        options = self.settings_dict['OPTIONS'].get('pool')
+        if not options:
+            return None
+        return get_pool(self.alias, options if isinstance(options, dict) else {})
+
+    def get_connection_params(self):
+        params = super().get_connection_params()
+        params.pop('pool', None)
+        return params
+
+    def get_new_connection(self, conn_params):
+        pool = self.pool
+        if pool is None:
+            return super().get_new_connection(conn_params)
+        return pool.acquire(lambda: super(PooledDatabaseWrapper, self).get_new_connection(conn_params), self._ping)
+
+    def _ping(self, conn):
+        # The backend's own check (a MySQL ping), run against the pooled connection
+        current, self.connection = self.connection, conn
+        try:
+            return self.is_usable()
+        finally:
+            self.connection = current
+
+    def _close(self):
+        pool = self.pool
+        if pool is None or self.connection is None:
+            return super()._close()
+        discard = (
+            self.errors_occurred
+            or self.in_atomic_block
+            or self.autocommit != self.settings_dict['AUTOCOMMIT']
+        )
+        pool.release(self.connection, discard=discard)
@@ -0,0 +1,135 @@
+"""
+Time-ordered unique identifiers, Snowflake style, without a database round trip.
+
+An id packs a 48-bit millisecond timestamp, a 30-bit node id and a 12-bit
+per-node sequence into 90 bits, written as 18 Crockford base32 characters.
+Because the timestamp comes first and the width is fixed, ids sort by
+creation time both as numbers and as strings.
+
+Ids are unique as long as no two live processes share a node id. With
+`ID_HOST_ID` set (one per machine), the node id is that host id followed by
+the process id, which no two live processes of a machine share, so every
+worker (and every process forked from one) gets its own. Unset, every
+process picks a random node id at startup and again after a fork; callers
+storing ids under a unique constraint should then retry on a collision.
+"""
+import os
+import secrets
+import threading
+import time
+from datetime import datetime, timezone
+
+from django.conf import settings
+
+TIMESTAMP_BITS = 48
+HOST_BITS = 8
+# Linux process ids stay below 2**22 (PID_MAX_LIMIT)
+PID_BITS = 22
+NODE_BITS = HOST_BITS + PID_BITS
+SEQUENCE_BITS = 12
+
+MAX_HOST_ID = (1 << HOST_BITS) - 1
+MAX_PID = (1 << PID_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+
+# Crockford base32, no I, L, O or U
+ALPHABET = '0123456789ABCDEFGHJKMNPQRSTVWXYZ'
+LENGTH = 18
+
+
+def encode(value):
+    chars = []
+    for _ in range(LENGTH):
+        value, remainder = divmod(value, 32)
+        chars.append(ALPHABET[remainder])
+    return ''.join(reversed(chars))
+
+
+def decode(text):
+    value = 0
+    for char in text.upper():
+        value = value * 32 + ALPHABET.index(char)
+    return value
+
+
+def timestamp_of(identifier):
+    """When an id was generated, as an aware datetime."""
+    milliseconds = decode(identifier) >> (NODE_BITS + SEQUENCE_BITS)
+    return datetime.fromtimestamp(milliseconds / 1000, tz=timezone.utc)
+
+
+def lower_bound(moment):
+    """The smallest id that can be generated at or after `moment`, for range scans."""
+    return encode(int(moment.timestamp() * 1000) << (NODE_BITS + SEQUENCE_BITS))
+
+
+class IdGenerator:
+    """Thread-safe, monotonic id generator for one process."""
+
+    def __init__(self, host_id=None):
+        if host_id is not None and not 0 <= host_id <= MAX_HOST_ID:
+            raise ValueError(f'Host id must be between 0 and {MAX_HOST_ID}.')
+        self.host_id = host_id
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        # Called again in forked children, which have a pid of their own
+        if self.host_id is None:
+            self._node = secrets.randbits(NODE_BITS)
+        else:
+            self._node = (self.host_id << PID_BITS) | (os.getpid() & MAX_PID)
+        self._last_ms = 0
+        self._sequence = 0
+
+    def next_value(self):
+        with self._lock:
+            now = time.time_ns() // 1_000_000
+            if now > self._last_ms:
+                self._last_ms = now
+                self._sequence = 0
+            else:
+                # Same millisecond or the clock went back: keep counting from the last one,
+                # borrowing the next millisecond when the sequence runs out
+                self._sequence += 1
+                if self._sequence > MAX_SEQUENCE:
+                    self._last_ms += 1
+                    self._sequence = 0
+            return (
+                (self._last_ms << (NODE_BITS + SEQUENCE_BITS))
+                | (self._node << SEQUENCE_BITS)
+                | self._sequence
+            )
+
+    def next_id(self):
+        return encode(self.next_value())
+
+
+_generator = None
+_generator_lock = threading.Lock()
+
+
+def _get_generator():
+    global _generator
+    if _generator is None:
+        with _generator_lock:
+            if _generator is None:
+                _generator = IdGenerator(getattr(settings, 'ID_HOST_ID', None))
+    return _generator
+
+
+def _after_fork():
+    # A forked worker must not continue the parent's node and sequence
+    global _generator, _generator_lock
+    _generator_lock = threading.Lock()
+    if _generator is not None:
+        _generator._lock = threading.Lock()
+        _generator._reset()
+
+
+os.register_at_fork(after_in_child=_after_fork)
+
+
+def generate_id():
+    """A new 18 character, time-ordered unique id."""
+    return _get_generator().next_id()
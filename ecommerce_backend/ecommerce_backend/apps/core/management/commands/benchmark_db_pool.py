@@ -0,0 +1,54 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from apps.core.db.pool import PooledDatabaseWrapper, discard_pool
+
+
+class Command(BaseCommand):
+    help = 'Time requests against a database with a connection per request and with the connection pool'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default='default', help='Database alias to connect to')
+        parser.add_argument('--requests', type=int, default=500, help='Requests per run')
+        parser.add_argument('--pool-size', type=int, default=4, help='max_size of the pool')
+
+    def handle(self, *args, **options):
+        alias = options['database']
+        if alias not in connections:
+            raise CommandError(f'Unknown database {alias!r}')
+        base = connections[alias]
+        wrapper_class = type(base)
+        if not issubclass(wrapper_class, PooledDatabaseWrapper):
+            wrapper_class = type(f'Pooled{wrapper_class.__name__}', (PooledDatabaseWrapper, wrapper_class), {})
+
+        requests = options['requests']
+        for label, pool_options in (('unpooled', False), ('pooled', {'max_size': options['pool_size']})):
+            settings_dict = {
+                **base.settings_dict,
+                'OPTIONS': {**base.settings_dict['OPTIONS'], 'pool': pool_options},
+                'CONN_MAX_AGE': 0,
+            }
+            wrapper = wrapper_class(settings_dict, f'benchmark-{label}')
+            try:
+                started = time.perf_counter()
+                for _ in range(requests):
+                    self.serve_request(wrapper)
+                elapsed = time.perf_counter() - started
+                connects = wrapper.pool.get_stats()['connects'] if wrapper.pool else requests
+            finally:
+                wrapper.close()
+                discard_pool(wrapper.alias)
+            self.stdout.write(
+                f'{label}: {requests} requests on {base.vendor} in {elapsed:.2f}s '
+                f'({requests / elapsed:.0f} req/s, {connects} connects)'
+            )
+
+    @staticmethod
+    def serve_request(wrapper):
+        # What a request does with its connection, and what request_finished does after it
+        with wrapper.cursor() as cursor:
+            cursor.execute('SELECT 1')
+            cursor.fetchone()
+        wrapper.close_if_unusable_or_obsolete()
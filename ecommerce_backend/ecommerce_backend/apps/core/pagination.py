@@ -0,0 +1,199 @@
+import hashlib
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from datetime import date, datetime
+from decimal import Decimal
+
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from django.utils import timezone
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import CursorPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+class KeysetPagination(CursorPagination):
+    """
+    Opaque cursor pagination that seeks with `WHERE (a, b, id) > (...)`.
+
+    Unlike DRF's CursorPagination it keys on every ordering field plus an
+    `id` tie-breaker, so any ordering picked through `?ordering=` pages in a
+    stable way and page N costs the same as page 1. No COUNT(*) is run unless
+    `?with_count=true` is passed, and then the total is cached for
+    `count_cache_timeout` seconds, so it may lag slightly behind.
+    """
+    ordering = '-created_at'
+    tie_breaker = 'id'
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    count_query_param = 'with_count'
+    count_cache_timeout = 60
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.base_url = request.build_absolute_uri()
+        self.page_size = self.get_page_size(request)
+        if not self.page_size:
+            return None
+
+        self.ordering = self.get_keyset_ordering(request, queryset, view)
+        self.cursor = self.decode_cursor(request, queryset)
+        reverse = bool(self.cursor and self.cursor['r'])
+
+        ordering = self._reversed(self.ordering) if reverse else self.ordering
+        results = self.fetch_page(queryset, ordering)
+        has_more = len(results) > self.page_size
+        self.page = results[:self.page_size]
+        if reverse:
+            self.page.reverse()
+            self.has_next, self.has_previous = self.cursor is not None, has_more
+        else:
+            self.has_next, self.has_previous = has_more, self.cursor is not None
+
+        self.count = None
+        if request.query_params.get(self.count_query_param, '').lower() in ('1', 'true'):
+            self.count = self.get_approximate_count(queryset)
+
+        if (self.has_previous or self.has_next) and self.template is not None:
+            self.display_page_controls = True
+        return self.page
+
+    def fetch_page(self, queryset, ordering):
+        """The rows of the page after the cursor in `ordering`, plus one."""
+        page_queryset = queryset.order_by(*ordering)
+        loaded, deferring = queryset.query.deferred_loading
+        if not deferring and loaded:
+            # only() is in use, the cursor needs the ordering columns as well
+            page_queryset = page_queryset.only(*loaded, *(
+                field.lstrip('-') for field in self.ordering
+                if field.lstrip('-') not in queryset.query.annotations
+            ))
+        if self.cursor:
+            page_queryset = page_queryset.filter(self._seek(ordering, self.cursor['v']))
+
+        # One extra row tells us whether there is another page
+        return list(page_queryset[:self.page_size + 1])
+
+    def get_keyset_ordering(self, request, queryset, view):
+        """The view's ordering with the tie-breaker appended."""
+        fields = [
+            field for field in self.get_ordering(request, queryset, view)
+            if field.lstrip('-') not in (self.tie_breaker, 'pk')
+        ]
+        descending = fields[-1].startswith('-') if fields else False
+        fields.append(f'-{self.tie_breaker}' if descending else self.tie_breaker)
+        return tuple(fields)
+
+    def get_approximate_count(self, queryset):
+        # Keyed on the SQL so every filter combination (and user) gets its own total
+        key = 'keyset-count:' + hashlib.md5(str(queryset.query).encode()).hexdigest()
+        count = cache.get(key)
+        if count is None:
+            count = queryset.count()
+            cache.set(key, count, self.count_cache_timeout)
+        return count
+
+    @staticmethod
+    def _reversed(ordering):
+        return tuple(field[1:] if field.startswith('-') else f'-{field}' for field in ordering)
+
+    @staticmethod
+    def _seek(ordering, values):
+        """Build `(f1 > v1) OR (f1 = v1 AND f2 > v2) OR ...` for `ordering`."""
+        condition = Q()
+        equal = Q()
+        for field, value in zip(ordering, values):
+            name = field.lstrip('-')
+            lookup = 'lt' if field.startswith('-') else 'gt'
+            condition |= equal & Q(**{f'{name}__{lookup}': value})
+            equal &= Q(**{name: value})
+        return condition
+
+    def _position(self, instance):
+        values = []
+        for field in self.ordering:
+            value = getattr(instance, field.lstrip('-'))
+            if isinstance(value, (datetime, date)):
+                value = value.isoformat()
+            elif isinstance(value, Decimal):
+                value = str(value)
+            values.append(value)
+        return values
+
+    @staticmethod
+    def _ordering_field(queryset, name):
+        if name in queryset.query.annotations:
+            return queryset.query.annotations[name].output_field
+        return queryset.model._meta.get_field(name)
+
+    def decode_cursor(self, request, queryset):
+        """The cursor of the request, its values converted to the ordering fields' types."""
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return None
+        try:
+            cursor = json.loads(urlsafe_b64decode(encoded.encode('ascii')))
+            if not isinstance(cursor, dict) or len(cursor['v']) != len(self.ordering):
+                raise ValueError
+            values = []
+            for field, value in zip(self.ordering, cursor['v']):
+                # Clients can craft cursors, so a bad value must not reach the query
+                if value is None or isinstance(value, (dict, list)):
+                    raise ValueError
+                value = self._ordering_field(queryset, field.lstrip('-')).to_python(value)
+                if isinstance(value, datetime) and timezone.is_naive(value):
+                    value = timezone.make_aware(value)
+                values.append(value)
+        except (TypeError, ValueError, KeyError, ValidationError):
+            raise NotFound(self.invalid_cursor_message)
+        return {'v': values, 'r': bool(cursor.get('r'))}
+
+    def encode_cursor(self, cursor):
+        encoded = urlsafe_b64encode(json.dumps(cursor, separators=(',', ':')).encode()).decode('ascii')
+        return replace_query_param(self.base_url, self.cursor_query_param, encoded)
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        if not self.page:
+            # An empty page reached backwards, restart from the beginning
+            return remove_query_param(self.base_url, self.cursor_query_param)
+        return self.encode_cursor({'v': self._position(self.page[-1])})
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        if not self.page:
+            return remove_query_param(self.base_url, self.cursor_query_param)
+        return self.encode_cursor({'v': self._position(self.page[0]), 'r': 1})
+
+    def get_paginated_response(self, data):
+        response = {
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+            'results': data,
+        }
+        if self.count is not None:
+            response = {'count': self.count, **response}
+        return Response(response)
+
+    def get_paginated_response_schema(self, schema):
+        response_schema = super().get_paginated_response_schema(schema)
+        response_schema['properties'] = {
+            'count': {'type': 'integer', 'example': 123},
+            **response_schema['properties'],
+        }
+        return response_schema
+
+    def get_schema_operation_parameters(self, view):
+        return super().get_schema_operation_parameters(view) + [
+            {
+                'name': self.count_query_param,
+                'required': False,
+                'in': 'query',
+                'description': 'Include an approximate (cached) total count.',
+                'schema': {'type': 'boolean'},
+            }
+        ]
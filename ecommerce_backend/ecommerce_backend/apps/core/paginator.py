@@ -0,0 +1,45 @@
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils.functional import cached_property
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Admin changelist paginator for large tables.
+
+    An unfiltered changelist takes its total from the database's table
+    statistics (MySQL `information_schema`, PostgreSQL `pg_class`) once the
+    table is bigger than `exact_threshold` rows, instead of running a
+    `COUNT(*)` over the whole table. A filtered one counts at most
+    `max_count` rows, so a broad filter can't scan the table either; only
+    the first `max_count` rows can be paged to, narrow the filter for more.
+    """
+    exact_threshold = 10000
+    max_count = 10000
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if queryset.query.where:
+            return queryset.order_by()[:self.max_count].count()
+        estimate = self.estimate(queryset)
+        if estimate is not None and estimate > self.exact_threshold:
+            return estimate
+        return queryset.count()
+
+    @staticmethod
+    def estimate(queryset):
+        """Approximate row count of the queryset's table, None where the database has none."""
+        connection = connections[queryset.db]
+        table = queryset.model._meta.db_table
+        if connection.vendor == 'mysql':
+            sql = 'SELECT table_rows FROM information_schema.tables WHERE table_schema = DATABASE() AND table_name = %s'
+        elif connection.vendor == 'postgresql':
+            sql = 'SELECT reltuples::bigint FROM pg_class WHERE relname = %s'
+        else:
+            return None
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [table])
+            row = cursor.fetchone()
+        # PostgreSQL reports -1 for a table that was never analyzed
+        return row[0] if row and row[0] is not None and row[0] >= 0 else None
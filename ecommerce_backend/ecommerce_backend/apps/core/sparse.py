@@ -0,0 +1,151 @@
+"""
+Sparse fieldsets with `?fields=` and `?expand=`.
+
+`?fields=id,name,price` limits a response to the listed fields. Dotted names
+reach into nested serializers (`?fields=id,items.product_name`), a nested
+field named without a dot is returned whole. `?expand=` adds fields that a
+serializer leaves out unless asked for, listed in its
+`Meta.expandable_fields`.
+
+Serializers opt in with SparseFieldsSerializerMixin, views with
+SparseFieldsMixin. The view hands the selection to its serializers and
+prunes its queryset to match: `prune_queryset()` loads only the columns
+behind the selected fields, and `get_queryset` skips joins and prefetches
+for fields that weren't selected by checking `self.wants(...)`.
+"""
+from django.core.exceptions import FieldDoesNotExist
+from rest_framework.permissions import SAFE_METHODS
+
+FIELDS_PARAM = 'fields'
+EXPAND_PARAM = 'expand'
+
+
+def parse_field_paths(value):
+    """`'id,items.product_name'` -> `{'id': {}, 'items': {'product_name': {}}}`"""
+    tree = {}
+    for path in value.split(','):
+        path = path.strip()
+        if not path:
+            continue
+        node = tree
+        for part in path.split('.'):
+            node = node.setdefault(part, {})
+    return tree
+
+
+def _subtree(tree, path):
+    """The part of `tree` below `path`, None when that part is unrestricted."""
+    for part in path:
+        if not tree:
+            return None
+        tree = tree.get(part)
+        if tree is None:
+            return None
+    return tree or None
+
+
+class SparseFieldsSerializerMixin:
+    """
+    Drops the fields a request didn't select.
+
+    `Meta.expandable_fields` are left out unless expanded or named in
+    `?fields=`. `Meta.field_sources` maps fields that don't read a model
+    field of the same name (method fields, properties) to the ORM paths
+    they need, so the view can defer everything else.
+    """
+
+    def _field_path(self):
+        path = []
+        node = self
+        while node.parent is not None:
+            if node.field_name:
+                path.append(node.field_name)
+            node = node.parent
+        return path[::-1]
+
+    def get_fields(self):
+        fields = super().get_fields()
+        path = self._field_path()
+        requested = _subtree(self.context.get('sparse_fields'), path)
+        expanded = _subtree(self.context.get('sparse_expand'), path) or {}
+        expandable = getattr(self.Meta, 'expandable_fields', ())
+        for name in list(fields):
+            if requested is not None:
+                keep = name in requested
+            else:
+                keep = name not in expandable or name in expanded
+            if not keep:
+                del fields[name]
+        return fields
+
+
+class SparseFieldsMixin:
+    """View side of sparse fieldsets, only applied to GET/HEAD requests."""
+
+    def get_sparse_selection(self):
+        if not hasattr(self, '_sparse_selection'):
+            params = self.request.query_params
+            if self.request.method in SAFE_METHODS:
+                fields = parse_field_paths(params[FIELDS_PARAM]) if params.get(FIELDS_PARAM) else None
+                expand = parse_field_paths(params.get(EXPAND_PARAM, ''))
+            else:
+                fields, expand = None, {}
+            self._sparse_selection = (fields, expand)
+        return self._sparse_selection
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        context['sparse_fields'], context['sparse_expand'] = self.get_sparse_selection()
+        return context
+
+    def get_selected_fields(self):
+        """The serializer fields this response will have, after `?fields=`/`?expand=`."""
+        if not hasattr(self, '_selected_fields'):
+            self._selected_fields = self.get_serializer().fields
+        return self._selected_fields
+
+    def wants(self, path):
+        """Whether a (dotted) field ends up in the response."""
+        parts = path.split('.')
+        if parts[0] not in self.get_selected_fields():
+            return False
+        node, _ = self.get_sparse_selection()
+        for part in parts:
+            if not node:
+                return True
+            if part not in node:
+                return False
+            node = node[part]
+        return True
+
+    def get_selected_columns(self, model):
+        """ORM paths the selected fields read, None if that can't be told."""
+        serializer = self.get_serializer()
+        sources = getattr(serializer.Meta, 'field_sources', {})
+        columns = set()
+        for name, field in self.get_selected_fields().items():
+            if name in sources:
+                columns.update(sources[name])
+                continue
+            if field.source == '*':
+                return None
+            try:
+                model_field = model._meta.get_field(field.source_attrs[0])
+            except FieldDoesNotExist:
+                return None
+            # Reverse relations are prefetched, there is nothing to load on this row
+            if model_field.concrete:
+                columns.add('__'.join(field.source_attrs) if model_field.is_relation else model_field.name)
+        return columns
+
+    def prune_queryset(self, queryset):
+        """Defer the columns no selected field reads."""
+        if self.request.method not in SAFE_METHODS:
+            return queryset
+        columns = self.get_selected_columns(queryset.model)
+        if columns is None:
+            return queryset
+        # Relations joined with select_related can't be deferred
+        if isinstance(queryset.query.select_related, dict):
+            columns.update(queryset.query.select_related)
+        return queryset.only(*columns)
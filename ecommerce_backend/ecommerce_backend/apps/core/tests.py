@@ -0,0 +1,170 @@
+import itertools
+import threading
+from io import StringIO
+
+from django.core.management import call_command
+from django.db import OperationalError, connection
+from django.db.backends.sqlite3 import base as sqlite
+from django.test import SimpleTestCase, TestCase
+from rest_framework.test import APIClient
+
+from apps.users.models import User
+
+from .db import pool
+from .db.pool import ConnectionPool, PooledDatabaseWrapper
+
+_aliases = itertools.count()
+
+
+class PooledSQLiteWrapper(PooledDatabaseWrapper, sqlite.DatabaseWrapper):
+    pass
+
+
+class PoolTestMixin:
+    def make_wrapper(self, alias=None, **options):
+        """A connection to the test database, pooled when given pool options."""
+        settings_dict = {
+            **connection.settings_dict,
+            'OPTIONS': {**connection.settings_dict['OPTIONS'], 'pool': options or False},
+            'CONN_MAX_AGE': 0,
+        }
+        alias = alias or f'pool-test-{next(_aliases)}'
+        self.addCleanup(self.drop_pool, alias)
+        return PooledSQLiteWrapper(settings_dict, alias)
+
+    def drop_pool(self, alias):
+        pool.discard_pool(alias)
+
+    def serve_request(self, wrapper):
+        # What a request does with its connection, and what request_finished does after it
+        with wrapper.cursor() as cursor:
+            cursor.execute('SELECT 1')
+            cursor.fetchone()
+        wrapper.close_if_unusable_or_obsolete()
+
+
+class ConnectionPoolTests(PoolTestMixin, SimpleTestCase):
+    def test_requests_reuse_a_pooled_connection(self):
+        wrapper = self.make_wrapper(max_size=2)
+        for _ in range(5):
+            self.serve_request(wrapper)
+        stats = wrapper.pool.get_stats()
+        self.assertEqual((stats['connects'], stats['checkouts'], stats['size'], stats['idle']), (1, 5, 1, 1))
+
+    def test_pool_is_shared_between_threads(self):
+        self.make_wrapper(alias='shared', max_size=1)
+        errors = []
+
+        def serve():
+            try:
+                # Django's connections are per thread, so is this wrapper
+                self.serve_request(self.make_wrapper(alias='shared', max_size=1))
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=serve) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        stats = pool._pools['shared'].get_stats()
+        self.assertEqual((stats['connects'], stats['checkouts']), (1, 4))
+
+    def test_checkout_waits_for_a_free_connection(self):
+        holder = self.make_wrapper(alias='busy', max_size=1, timeout=2)
+        holder.ensure_connection()
+        # Another request finishing shortly
+        holder.inc_thread_sharing()
+        threading.Timer(0.05, holder.close).start()
+        waiter = self.make_wrapper(alias='busy', max_size=1, timeout=2)
+        self.serve_request(waiter)
+        stats = holder.pool.get_stats()
+        self.assertEqual((stats['connects'], stats['waits']), (1, 1))
+        self.assertGreater(stats['wait_time'], 0.03)
+
+    def test_checkout_times_out_when_pool_is_exhausted(self):
+        holder = self.make_wrapper(alias='exhausted', max_size=1, timeout=0.05)
+        holder.ensure_connection()
+        self.addCleanup(holder.close)
+        with self.assertRaises(OperationalError):
+            self.make_wrapper(alias='exhausted', max_size=1, timeout=0.05).ensure_connection()
+        self.assertEqual(holder.pool.get_stats()['timeouts'], 1)
+
+    def test_unhealthy_connections_are_not_reused(self):
+        wrapper = self.make_wrapper(max_size=2)
+        wrapper.ensure_connection()
+        wrapper.errors_occurred = True
+        wrapper.close()
+        # Left in a transaction
+        wrapper.ensure_connection()
+        wrapper.set_autocommit(False)
+        wrapper.close()
+        stats = wrapper.pool.get_stats()
+        self.assertEqual((stats['connects'], stats['discarded'], stats['idle']), (2, 2, 0))
+
+    def test_old_connections_are_retired(self):
+        wrapper = self.make_wrapper(max_lifetime=0)
+        self.serve_request(wrapper)
+        self.serve_request(wrapper)
+        stats = wrapper.pool.get_stats()
+        self.assertEqual((stats['connects'], stats['discarded']), (2, 2))
+
+    def test_idle_connections_failing_a_ping_are_replaced(self):
+        connects = itertools.count()
+        healthy = {'ok': True}
+        conn_pool = ConnectionPool(max_size=1, timeout=1, max_lifetime=60, check_after=0)
+        self.addCleanup(conn_pool.close_idle)
+
+        class Conn:
+            def __init__(self):
+                self.number = next(connects)
+
+            def close(self):
+                pass
+
+        first = conn_pool.acquire(Conn, lambda conn: healthy['ok'])
+        conn_pool.release(first)
+        self.assertIs(conn_pool.acquire(Conn, lambda conn: healthy['ok']), first)
+        conn_pool.release(first)
+        healthy['ok'] = False
+        second = conn_pool.acquire(Conn, lambda conn: healthy['ok'])
+        self.assertEqual(second.number, 1)
+        stats = conn_pool.get_stats()
+        self.assertEqual((stats['connects'], stats['reconnects'], stats['size']), (2, 1, 1))
+
+    def test_without_pool_options_connections_are_not_pooled(self):
+        wrapper = self.make_wrapper()
+        self.assertIsNone(wrapper.pool)
+        self.serve_request(wrapper)
+        self.assertIsNone(wrapper.connection)
+        self.assertNotIn(wrapper.alias, pool._pools)
+
+    def test_many_requests_share_one_connection(self):
+        wrapper = self.make_wrapper(max_size=4)
+        for _ in range(500):
+            self.serve_request(wrapper)
+        self.assertEqual(wrapper.pool.get_stats()['connects'], 1)
+
+    def test_benchmark_command(self):
+        out = StringIO()
+        call_command('benchmark_db_pool', '--requests', '20', stdout=out)
+        unpooled, pooled = out.getvalue().splitlines()
+        self.assertTrue(unpooled.startswith('unpooled: 20 requests'))
+        self.assertTrue(pooled.endswith(', 1 connects)'))
+        self.assertNotIn('benchmark-pooled', pool._pools)
+
+
+class DatabaseStatsTests(TestCase):
+    def test_staff_only(self):
+        user = User.objects.create_user(username='buyer', email='buyer@example.com', password='secret')
+        client = APIClient()
+        client.force_authenticate(user)
+        self.assertEqual(client.get('/api/db-stats').status_code, 403)
+
+        user.is_staff = True
+        user.save()
+        response = client.get('/api/db-stats')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['default']['pooled'], False)
+        self.assertIn('health_checks', response.data['default'])
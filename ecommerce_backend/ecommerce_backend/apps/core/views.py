@@ -0,0 +1,22 @@
+from django.db import connections
+from rest_framework.decorators import api_view, permission_classes
+from rest_framework.permissions import IsAdminUser
+from rest_framework.response import Response
+
+from .db import pool
+
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def database_stats(request):
+    """Connection settings of each database and the stats of its pool in this process"""
+    pools = pool.get_stats()
+    return Response({
+        alias: {
+            'pooled': bool(connections[alias].settings_dict['OPTIONS'].get('pool')),
+            'conn_max_age': connections[alias].settings_dict['CONN_MAX_AGE'],
+            'health_checks': connections[alias].settings_dict['CONN_HEALTH_CHECKS'],
+            'pool': pools.get(alias),
+        }
+        for alias in connections
+    })
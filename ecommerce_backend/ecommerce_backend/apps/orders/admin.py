@@ -1,23 +1,53 @@
-from django.contrib import admin
-from .models import Order, OrderItem, Payment
+from django.contrib import admin, messages
+from apps.core.paginator import EstimatedCountPaginator
+from . import transitions
+from .cancellation import cancel_orders
+from .models import (
+    ArchivedOrder, ArchivedOrderItem, ArchivedPayment, Order, OrderItem, OrderStatusChange, Payment
+)
 
 class OrderItemInline(admin.TabularInline):
     model = OrderItem
     extra = 0
-    readonly_fields = ('product_name', 'product_price', 'total_price')
+    readonly_fields = ('product_name', 'product_price', 'total_price', 'category')
+    # A <select> would list the whole catalog for every line
+    raw_id_fields = ('product',)
 
 class PaymentInline(admin.StackedInline):
     model = Payment
     extra = 0
     readonly_fields = ('payment_id', 'amount', 'currency')
 
+def _transition_action(target, description):
+    def action(modeladmin, request, queryset):
+        changed, rejected = transitions.transition_orders(
+            queryset, list(queryset.values_list('pk', flat=True)), target, user=request.user
+        )
+        modeladmin.report(request, len(changed), rejected, f'marked {target}')
+    action.__name__ = f'mark_{target}'
+    action.short_description = description
+    return action
+
 @admin.register(Order)
 class OrderAdmin(admin.ModelAdmin):
     list_display = ('order_number', 'user', 'status', 'payment_status', 'total_amount', 'created_at')
     list_filter = ('status', 'payment_status', 'created_at')
+    list_select_related = ('user',)
     search_fields = ('order_number', 'user__email', 'customer_email')
-    readonly_fields = ('order_number', 'subtotal', 'tax_amount', 'total_amount')
+    # Status changes go through the actions, so transitions are checked and logged
+    readonly_fields = (
+        'order_number', 'status', 'subtotal', 'tax_amount', 'total_amount', 'created_at', 'updated_at'
+    )
+    raw_id_fields = ('user',)
     inlines = [OrderItemInline, PaymentInline]
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    actions = [
+        _transition_action('processing', 'Mark selected orders processing'),
+        _transition_action('shipped', 'Mark selected orders shipped'),
+        _transition_action('delivered', 'Mark selected orders delivered'),
+        'cancel_orders',
+    ]
     
     fieldsets = (
         ('Order Information', {
@@ -37,11 +67,76 @@ class OrderAdmin(admin.ModelAdmin):
         }),
     )
 
+    @admin.action(description='Cancel selected orders and restore their stock')
+    def cancel_orders(self, request, queryset):
+        cancelled, rejected = cancel_orders(queryset, list(queryset.values_list('pk', flat=True)), user=request.user)
+        self.report(request, len(cancelled), rejected, 'cancelled')
+
+    def report(self, request, changed, rejected, verb):
+        self.message_user(request, f'{changed} orders {verb}.', messages.SUCCESS)
+        if rejected:
+            self.message_user(
+                request, f'{len(rejected)} orders skipped, their status doesn\'t allow it.', messages.WARNING
+            )
+
 @admin.register(Payment)
 class PaymentAdmin(admin.ModelAdmin):
     list_display = ('id', 'order', 'payment_method', 'amount', 'status', 'created_at')
     list_filter = ('payment_method', 'status', 'created_at')
+    list_select_related = ('order__user',)
     search_fields = ('order__order_number', 'payment_id')
     readonly_fields = ('payment_id', 'amount', 'currency')
+    raw_id_fields = ('order',)
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+@admin.register(OrderItem)
+class OrderItemAdmin(admin.ModelAdmin):
+    list_display = ('id', 'order', 'product_name', 'quantity', 'total_price')
+    list_select_related = ('order__user',)
+    search_fields = ('order__order_number', 'product_name')
+    raw_id_fields = ('order', 'product')
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+@admin.register(OrderStatusChange)
+class OrderStatusChangeAdmin(admin.ModelAdmin):
+    list_display = ('order_id', 'from_status', 'to_status', 'changed_by', 'changed_at')
+    list_filter = ('to_status',)
+    list_select_related = ('changed_by',)
+    search_fields = ('=order_id',)
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+class ArchivedOrderItemInline(admin.TabularInline):
+    model = ArchivedOrderItem
+    extra = 0
+    raw_id_fields = ('product',)
+
+class ArchivedPaymentInline(admin.StackedInline):
+    model = ArchivedPayment
+    extra = 0
+
+@admin.register(ArchivedOrder)
+class ArchivedOrderAdmin(admin.ModelAdmin):
+    """Read only, archived orders are closed"""
+    list_display = ('order_number', 'user', 'status', 'payment_status', 'total_amount', 'created_at', 'archived_at')
+    list_filter = ('status', 'payment_status')
+    list_select_related = ('user',)
+    search_fields = ('order_number', 'customer_email')
+    date_hierarchy = 'created_at'
+    inlines = [ArchivedOrderItemInline, ArchivedPaymentInline]
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    def has_add_permission(self, request, obj=None):
+        return False
 
-admin.site.register(OrderItem)
+    def has_change_permission(self, request, obj=None):
+        return False
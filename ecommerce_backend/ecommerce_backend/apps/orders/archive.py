@@ -0,0 +1,148 @@
+"""
+Hot/cold archival of closed orders.
+
+Delivered and cancelled orders created more than ORDER_ARCHIVE_AFTER_DAYS ago
+are moved, with their items and payment, into the `*_archive` tables by
+`manage.py archive_orders`. Each batch is copied with `INSERT ... SELECT` and
+deleted from the hot tables in its own short transaction, so a run can be
+stopped at any point and simply started again. A batch that holds its locks
+longer than ORDER_ARCHIVE_MAX_LOCK_MS halves the next batch, and every batch
+reports its throughput and lock time, so archival can run next to live
+traffic.
+
+Order listings read the archive once they page past the hot data, see
+OrderPagination.
+"""
+import logging
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
+
+from .models import ArchivedOrder, ArchivedOrderItem, ArchivedPayment, Order, OrderItem, Payment, PaymentJob
+
+logger = logging.getLogger(__name__)
+
+CLOSED_STATUSES = ('delivered', 'cancelled')
+MIN_BATCH_SIZE = 10
+
+
+def archive_cutoff(now=None):
+    """Orders created before this are old enough to be archived."""
+    return (now or timezone.now()) - timedelta(days=settings.ORDER_ARCHIVE_AFTER_DAYS)
+
+
+def archivable_orders(cutoff):
+    # A payment still queued for the worker keeps its order in the hot table
+    active_jobs = PaymentJob.objects.filter(payment__order=OuterRef('pk'), status__in=('queued', 'processing'))
+    return Order.objects.filter(status__in=CLOSED_STATUSES, created_at__lt=cutoff).exclude(Exists(active_jobs))
+
+
+def _copy(model, archive_model, key, ids, **extra):
+    """`INSERT INTO <archive> SELECT ... FROM <hot> WHERE key IN ids`, returns the row count."""
+    qn = connection.ops.quote_name
+    columns = [qn(field.column) for field in model._meta.concrete_fields]
+    target = columns + [qn(archive_model._meta.get_field(name).column) for name in extra]
+    sql = 'INSERT INTO {} ({}) SELECT {} FROM {} WHERE {} IN ({})'.format(
+        qn(archive_model._meta.db_table), ', '.join(target),
+        ', '.join(columns + ['%s'] * len(extra)),
+        qn(model._meta.db_table), qn(key), ', '.join(['%s'] * len(ids)),
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [*extra.values(), *ids])
+        return cursor.rowcount
+
+
+def archive_batch(cutoff, batch_size, after=0):
+    """
+    Move up to `batch_size` archivable orders with ids above `after`.
+
+    Returns the moved order ids, the number of moved items and how long the
+    transaction held its locks, in seconds.
+    """
+    started = time.monotonic()
+    items = 0
+    with transaction.atomic():
+        # Orders another transaction is updating right now are left for the next run
+        ids = list(
+            archivable_orders(cutoff).filter(pk__gt=after).select_for_update(skip_locked=True)
+            .order_by('pk').values_list('pk', flat=True)[:batch_size]
+        )
+        if ids:
+            _copy(Order, ArchivedOrder, 'id', ids, archived_at=timezone.now())
+            items = _copy(OrderItem, ArchivedOrderItem, 'order_id', ids)
+            _copy(Payment, ArchivedPayment, 'order_id', ids)
+            # Finished jobs aren't archived, their outcome is on the payment
+            PaymentJob.objects.filter(payment__order_id__in=ids).delete()
+            Order.objects.filter(pk__in=ids).delete()
+    return ids, items, time.monotonic() - started
+
+
+class ArchiveStats:
+    def __init__(self):
+        self.batches = 0
+        self.orders = 0
+        self.items = 0
+        self.lock_time = 0.0
+        self.max_lock_time = 0.0
+        self.elapsed = 0.0
+
+    def add(self, orders, items, lock_time):
+        self.batches += 1
+        self.orders += orders
+        self.items += items
+        self.lock_time += lock_time
+        self.max_lock_time = max(self.max_lock_time, lock_time)
+
+    @property
+    def orders_per_second(self):
+        return self.orders / self.elapsed if self.elapsed else 0.0
+
+    def __str__(self):
+        return (
+            f'{self.orders} orders ({self.items} items) in {self.batches} batches, '
+            f'{self.elapsed:.1f}s, {self.orders_per_second:.0f} orders/s, '
+            f'lock time {self.lock_time * 1000:.0f} ms total / {self.max_lock_time * 1000:.0f} ms max'
+        )
+
+
+def archive_orders(cutoff=None, batch_size=None, max_lock_ms=None, limit=None, pause=0, report=None):
+    """
+    Archive closed orders created before `cutoff` in batches, returns ArchiveStats.
+
+    `limit` caps the orders moved by this run, `pause` sleeps between batches
+    and `report(stats, orders, lock_time)` is called after every batch.
+    """
+    cutoff = cutoff or archive_cutoff()
+    largest = batch_size or settings.ORDER_ARCHIVE_BATCH_SIZE
+    max_lock = (settings.ORDER_ARCHIVE_MAX_LOCK_MS if max_lock_ms is None else max_lock_ms) / 1000
+    size = largest
+    stats = ArchiveStats()
+    started = time.monotonic()
+    last_id = 0
+    while limit is None or stats.orders < limit:
+        if limit is not None:
+            size = min(size, limit - stats.orders)
+        ids, items, lock_time = archive_batch(cutoff, size, after=last_id)
+        if not ids:
+            break
+        last_id = ids[-1]
+        stats.add(len(ids), items, lock_time)
+        stats.elapsed = time.monotonic() - started
+        logger.info(
+            'Archived %d orders (%d items) in %.0f ms, %.0f orders/s overall',
+            len(ids), items, lock_time * 1000, stats.orders_per_second,
+        )
+        if report:
+            report(stats, len(ids), lock_time)
+        if max_lock and lock_time > max_lock:
+            size = max(MIN_BATCH_SIZE, size // 2)
+        elif max_lock and lock_time < max_lock / 4:
+            size = min(largest, size * 2)
+        if pause:
+            time.sleep(pause)
+    stats.elapsed = time.monotonic() - started
+    return stats
@@ -0,0 +1,37 @@
+"""
+Order cancellation.
+
+Cancelling is the `cancelled` transition of transitions.py: a
+compare-and-set on the status, with the stock of exactly the orders it
+cancelled restored in the same transaction. Cancelling an order twice
+restores its stock once.
+"""
+from . import transitions
+
+CANCELLABLE_STATUSES = tuple(
+    status for status, targets in transitions.TRANSITIONS.items() if 'cancelled' in targets
+)
+
+NOT_FOUND = 'not_found'
+ALREADY_CANCELLED = 'already_cancelled'
+NOT_CANCELLABLE = 'not_cancellable'
+
+_REASONS = {
+    transitions.NOT_FOUND: NOT_FOUND,
+    transitions.UNCHANGED: ALREADY_CANCELLED,
+    transitions.NOT_ALLOWED: NOT_CANCELLABLE,
+    # Shipped (or cancelled) while we looked
+    transitions.CONFLICT: NOT_CANCELLABLE,
+}
+
+
+def cancel_orders(queryset, order_ids, user=None):
+    """
+    Cancel the orders in `order_ids` that `queryset` contains.
+
+    Returns `(cancelled, rejected)`: the ids that were cancelled by this
+    call and a mapping of the other ids to `not_found`, `already_cancelled`
+    or `not_cancellable`.
+    """
+    cancelled, rejected = transitions.transition_orders(queryset, order_ids, 'cancelled', user=user)
+    return cancelled, {pk: _REASONS[reason] for pk, reason in rejected.items()}
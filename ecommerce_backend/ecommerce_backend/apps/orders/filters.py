@@ -1,12 +1,26 @@
+from datetime import datetime, time, timedelta
+
 import django_filters
+from django.utils import timezone
 from .models import Order
 
 class OrderFilter(django_filters.FilterSet):
     status = django_filters.CharFilter(field_name='status')
     payment_status = django_filters.CharFilter(field_name='payment_status')
-    date_from = django_filters.DateFilter(field_name='created_at', lookup_expr='gte')
-    date_to = django_filters.DateFilter(field_name='created_at', lookup_expr='lte')
+    date_from = django_filters.DateFilter(method='filter_date_from')
+    date_to = django_filters.DateFilter(method='filter_date_to')
     
     class Meta:
         model = Order
-        fields = ['status', 'payment_status', 'date_from', 'date_to']
\ No newline at end of file
+        fields = ['status', 'payment_status', 'date_from', 'date_to']
+
+    # Whole days in TIME_ZONE, both ends inclusive, as plain ranges so the created_at index is used
+    def filter_date_from(self, queryset, name, value):
+        return queryset.filter(created_at__gte=self._day_start(value))
+
+    def filter_date_to(self, queryset, name, value):
+        return queryset.filter(created_at__lt=self._day_start(value + timedelta(days=1)))
+
+    @staticmethod
+    def _day_start(day):
+        return timezone.make_aware(datetime.combine(day, time.min))
@@ -0,0 +1,70 @@
+"""
+Payment gateway clients.
+
+The worker talks to the gateway configured in `settings.PAYMENT_GATEWAY`
+(a dotted path, built with `PAYMENT_GATEWAY_OPTIONS` as keyword arguments).
+A client implements `charge()` and signals failures with `GatewayError`
+(transient, the job is retried) or `PaymentDeclined` (final).
+"""
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+
+class GatewayError(Exception):
+    """The gateway could not be reached or failed, try again later."""
+
+
+class PaymentDeclined(Exception):
+    """The gateway refused the charge, retrying won't help."""
+
+
+class PaymentGateway:
+    def charge(self, payment, idempotency_key):
+        """
+        Charge `payment.amount` and return the gateway's id for the charge.
+
+        `idempotency_key` is stable across retries of the same payment job,
+        so a charge that succeeded at the gateway but timed out on our side
+        isn't made twice.
+        """
+        raise NotImplementedError
+
+
+class FakeGateway(PaymentGateway):
+    """
+    Local stand-in for development and tests, no network involved.
+
+    Fails the first `fail_first` calls with a GatewayError, declines
+    everything when `decline` is set and sleeps `latency` seconds per call.
+    Charges are remembered by idempotency key like a real gateway would.
+    """
+
+    def __init__(self, fail_first=0, decline=False, latency=0):
+        self.fail_first = fail_first
+        self.decline = decline
+        self.latency = latency
+        self.calls = 0
+        self.charges = {}
+        self._lock = threading.Lock()
+
+    def charge(self, payment, idempotency_key):
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.calls += 1
+            if self.calls <= self.fail_first:
+                raise GatewayError('Gateway unavailable.')
+            if self.decline:
+                raise PaymentDeclined('Card declined.')
+            if idempotency_key not in self.charges:
+                self.charges[idempotency_key] = f'fake_{uuid.uuid4().hex}'
+            return self.charges[idempotency_key]
+
+
+def get_gateway():
+    gateway_class = import_string(settings.PAYMENT_GATEWAY)
+    return gateway_class(**settings.PAYMENT_GATEWAY_OPTIONS)
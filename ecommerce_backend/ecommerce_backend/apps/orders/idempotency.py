@@ -0,0 +1,211 @@
+"""
+`Idempotency-Key` support for order creation and payment.
+
+The first request with a given key (per user) claims it by inserting an
+`in_progress` row, runs, and stores its response on that row. Retries with
+the same key get the stored response replayed instead of running again.
+Completed responses are also kept in a bounded per-worker LRU, so most
+retries don't touch the database.
+
+A retry that arrives while the first request is still running waits up to
+`IDEMPOTENCY_WAIT` seconds for it to finish and gets a 409 otherwise. A
+claim older than `IDEMPOTENCY_LOCK_TIMEOUT` (a crashed worker) can be taken
+over. Responses with a 5xx status are not stored, the key is released so
+the client can retry. Expired keys are deleted in batches by
+`manage.py sweep_idempotency_keys`.
+"""
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from datetime import timedelta
+from functools import wraps
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.response import Response
+
+from .models import IdempotencyKey
+
+HEADER = 'Idempotency-Key'
+REPLAYED_HEADER = 'Idempotent-Replayed'
+MAX_KEY_LENGTH = 255
+POLL_INTERVAL = 0.05
+SWEEP_BATCH_SIZE = 1000
+
+
+class ResponseCache:
+    """Thread-safe LRU of completed responses, bounded to `max_size` entries."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, cache_key):
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            if entry is None:
+                return None
+            if entry['expires_at'] <= timezone.now():
+                del self._entries[cache_key]
+                return None
+            self._entries.move_to_end(cache_key)
+            return entry
+
+    def set(self, cache_key, entry):
+        with self._lock:
+            self._entries[cache_key] = entry
+            self._entries.move_to_end(cache_key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_responses = ResponseCache(settings.IDEMPOTENCY_CACHE_SIZE)
+
+
+def request_fingerprint(request):
+    body = json.dumps(request.data, sort_keys=True, default=str)
+    return hashlib.sha256(f'{request.method} {request.path}\n{body}'.encode()).hexdigest()
+
+
+def _entry(record):
+    return {
+        'fingerprint': record.fingerprint,
+        'status': record.response_status,
+        'body': record.response_body,
+        'expires_at': record.expires_at,
+    }
+
+
+def _error(message, status_code):
+    return Response({'error': message}, status=status_code)
+
+
+def _claim(user_id, key, fingerprint):
+    """
+    Claim `key` for this request.
+
+    Returns `(record, None)` when the caller now owns the key and has to run
+    the request, or `(None, response)` with the replay or error to send.
+    """
+    deadline = time.monotonic() + settings.IDEMPOTENCY_WAIT
+    while True:
+        now = timezone.now()
+        try:
+            with transaction.atomic():
+                record = IdempotencyKey.objects.create(
+                    user_id=user_id, key=key, fingerprint=fingerprint, locked_at=now,
+                    expires_at=now + timedelta(seconds=settings.IDEMPOTENCY_KEY_TTL),
+                )
+            return record, None
+        except IntegrityError:
+            pass
+
+        record = IdempotencyKey.objects.filter(user_id=user_id, key=key).first()
+        if record is None:
+            # Released or swept in the meantime
+            continue
+        if record.expires_at <= now:
+            IdempotencyKey.objects.filter(pk=record.pk, expires_at=record.expires_at).delete()
+            continue
+        if record.fingerprint != fingerprint:
+            return None, _error(
+                'This Idempotency-Key was already used for a different request.',
+                status.HTTP_422_UNPROCESSABLE_ENTITY,
+            )
+        if record.status == 'completed':
+            entry = _entry(record)
+            _responses.set((user_id, key), entry)
+            return None, _replay(entry)
+
+        # Still in flight. Take it over if its owner died, otherwise wait for it.
+        if record.locked_at <= now - timedelta(seconds=settings.IDEMPOTENCY_LOCK_TIMEOUT):
+            taken = IdempotencyKey.objects.filter(
+                pk=record.pk, status='in_progress', locked_at=record.locked_at
+            ).update(locked_at=now)
+            if taken:
+                record.locked_at = now
+                return record, None
+            continue
+        if time.monotonic() >= deadline:
+            return None, _error(
+                'A request with this Idempotency-Key is still being processed.',
+                status.HTTP_409_CONFLICT,
+            )
+        time.sleep(POLL_INTERVAL)
+
+
+def _replay(entry):
+    return Response(entry['body'], status=entry['status'], headers={REPLAYED_HEADER: 'true'})
+
+
+def _complete(record, response):
+    record.status = 'completed'
+    record.response_status = response.status_code
+    record.response_body = response.data
+    IdempotencyKey.objects.filter(pk=record.pk).update(
+        status=record.status, response_status=record.response_status, response_body=record.response_body,
+    )
+    _responses.set((record.user_id, record.key), _entry(record))
+
+
+def _release(record):
+    IdempotencyKey.objects.filter(pk=record.pk, status='in_progress').delete()
+
+
+def idempotent(view_method):
+    """Make a viewset action replay its response for a repeated `Idempotency-Key`."""
+    @wraps(view_method)
+    def wrapper(self, request, *args, **kwargs):
+        key = request.headers.get(HEADER)
+        if not key:
+            return view_method(self, request, *args, **kwargs)
+        if len(key) > MAX_KEY_LENGTH:
+            return _error(f'{HEADER} must be at most {MAX_KEY_LENGTH} characters.', status.HTTP_400_BAD_REQUEST)
+
+        fingerprint = request_fingerprint(request)
+        entry = _responses.get((request.user.pk, key))
+        if entry is not None:
+            if entry['fingerprint'] != fingerprint:
+                return _error(
+                    'This Idempotency-Key was already used for a different request.',
+                    status.HTTP_422_UNPROCESSABLE_ENTITY,
+                )
+            return _replay(entry)
+
+        record, response = _claim(request.user.pk, key, fingerprint)
+        if record is None:
+            return response
+
+        try:
+            response = view_method(self, request, *args, **kwargs)
+        except BaseException:
+            _release(record)
+            raise
+        if response.status_code >= 500 or response.status_code == status.HTTP_429_TOO_MANY_REQUESTS:
+            # Transient, let the client retry with the same key
+            _release(record)
+        else:
+            _complete(record, response)
+        return response
+    return wrapper
+
+
+def sweep_expired_keys(batch_size=SWEEP_BATCH_SIZE):
+    """Delete expired keys `batch_size` rows at a time, returns how many were deleted."""
+    deleted = 0
+    while True:
+        ids = list(
+            IdempotencyKey.objects.filter(expires_at__lte=timezone.now()).values_list('pk', flat=True)[:batch_size]
+        )
+        if not ids:
+            return deleted
+        deleted += IdempotencyKey.objects.filter(pk__in=ids).delete()[0]
@@ -0,0 +1,48 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from apps.orders.archive import archive_cutoff, archive_orders
+
+
+class Command(BaseCommand):
+    help = 'Move closed orders older than ORDER_ARCHIVE_AFTER_DAYS into the archive tables'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, help='Archive orders older than this, at least ORDER_ARCHIVE_AFTER_DAYS (the default)')
+        parser.add_argument('--batch-size', type=int, help='Orders moved per transaction (default ORDER_ARCHIVE_BATCH_SIZE)')
+        parser.add_argument(
+            '--max-lock-ms', type=int,
+            help='Halve the batch size when a batch holds its locks longer (default ORDER_ARCHIVE_MAX_LOCK_MS, 0 disables)',
+        )
+        parser.add_argument('--limit', type=int, help='Stop after moving this many orders')
+        parser.add_argument('--pause', type=float, default=0, help='Seconds to sleep between batches')
+
+    def handle(self, *args, **options):
+        if options['days'] is not None:
+            if options['days'] < settings.ORDER_ARCHIVE_AFTER_DAYS:
+                # Listings wouldn't look for them in the archive
+                raise CommandError(f'--days must be at least ORDER_ARCHIVE_AFTER_DAYS ({settings.ORDER_ARCHIVE_AFTER_DAYS})')
+            cutoff = timezone.now() - timedelta(days=options['days'])
+        else:
+            cutoff = archive_cutoff()
+        self.stdout.write(f'Archiving closed orders created before {cutoff:%Y-%m-%d %H:%M}')
+
+        def report(stats, orders, lock_time):
+            if options['verbosity'] > 1:
+                self.stdout.write(
+                    f'  batch {stats.batches}: {orders} orders, lock {lock_time * 1000:.0f} ms, '
+                    f'{stats.orders_per_second:.0f} orders/s'
+                )
+
+        stats = archive_orders(
+            cutoff=cutoff,
+            batch_size=options['batch_size'],
+            max_lock_ms=options['max_lock_ms'],
+            limit=options['limit'],
+            pause=options['pause'],
+            report=report,
+        )
+        self.stdout.write(self.style.SUCCESS(f'Archived {stats}'))
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from apps.orders.payments import DEFAULT_BATCH_SIZE, run_worker
+
+
+class Command(BaseCommand):
+    help = 'Process queued payment jobs against the configured payment gateway'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE, help='Jobs claimed per round')
+        parser.add_argument('--poll-interval', type=float, default=1.0, help='Seconds to wait when the queue is empty')
+        parser.add_argument('--once', action='store_true', help='Exit once no jobs are due instead of polling')
+
+    def handle(self, *args, **options):
+        self.stdout.write(f'Payment worker started (batch size {options["batch_size"]})')
+        run_worker(
+            batch_size=options['batch_size'],
+            poll_interval=options['poll_interval'],
+            once=options['once'],
+        )
@@ -0,0 +1,24 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from apps.orders.idempotency import SWEEP_BATCH_SIZE, sweep_expired_keys
+
+
+class Command(BaseCommand):
+    help = 'Delete expired Idempotency-Key records in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=SWEEP_BATCH_SIZE)
+        parser.add_argument(
+            '--interval', type=int, default=0,
+            help='Keep running and sweep every N seconds instead of once',
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            deleted = sweep_expired_keys(batch_size=options['batch_size'])
+            self.stdout.write(self.style.SUCCESS(f'Deleted {deleted} expired idempotency keys'))
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
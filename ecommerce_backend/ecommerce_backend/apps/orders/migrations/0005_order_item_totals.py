@@ -0,0 +1,40 @@
+# Generated by Django 5.2.6 on 2026-10-18 11:35
+
+from django.db import migrations, models
+from django.db.models import Count, Sum
+
+
+def backfill_item_totals(apps, schema_editor):
+    Order = apps.get_model('orders', 'Order')
+    OrderItem = apps.get_model('orders', 'OrderItem')
+    totals = (
+        OrderItem.objects.values('order_id')
+        .annotate(count=Count('id'), quantity=Sum('quantity'))
+        .order_by()
+    )
+    for row in totals.iterator():
+        Order.objects.filter(pk=row['order_id']).update(
+            item_count=row['count'],
+            total_quantity=row['quantity'],
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0004_idempotencykey'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='item_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='total_quantity',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(backfill_item_totals, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.2.6 on 2026-10-18 13:09
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def backfill_item_categories(apps, schema_editor):
+    # The category at the time of sale isn't known for existing items, the current one is the best guess
+    Product = apps.get_model('products', 'Product')
+    category = Subquery(Product.objects.filter(pk=OuterRef('product_id')).values('category_id')[:1])
+    for name in ('OrderItem', 'ArchivedOrderItem'):
+        apps.get_model('orders', name).objects.filter(category__isnull=True).update(category_id=category)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0008_orderstatuschange'),
+        ('products', '0007_product_import_jobs'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='archivedorderitem',
+            name='category',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='products.category'),
+        ),
+        migrations.AddField(
+            model_name='orderitem',
+            name='category',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='products.category'),
+        ),
+        migrations.RunPython(backfill_item_categories, migrations.RunPython.noop),
+    ]
@@ -1,9 +1,12 @@
-from django.db import models
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import IntegrityError, models, transaction
 from django.core.validators import MinValueValidator
 from django.conf import settings
-from apps.products.models import Product
+from apps.core.ids import generate_id
+from apps.products.models import Category, Product
 
-class Order(models.Model):
+class AbstractOrder(models.Model):
+    """Columns shared by `orders` and the `orders_archive` table old orders are moved to."""
     STATUS_CHOICES = [
         ('pending', 'Pending'),
         ('processing', 'Processing'),
@@ -19,7 +22,6 @@ class Order(models.Model):
         ('refunded', 'Refunded'),
     ]
 
-    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='orders')
     order_number = models.CharField(max_length=20, unique=True)
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
     payment_status = models.CharField(max_length=20, choices=PAYMENT_STATUS_CHOICES, default='pending')
@@ -29,6 +31,10 @@ class Order(models.Model):
     tax_amount = models.DecimalField(max_digits=10, decimal_places=2, default=0)
     shipping_cost = models.DecimalField(max_digits=10, decimal_places=2, default=0)
     total_amount = models.DecimalField(max_digits=10, decimal_places=2, default=0)
+
+    # Denormalized from the items at checkout, so listings don't count them
+    item_count = models.PositiveIntegerField(default=0, editable=False)
+    total_quantity = models.PositiveIntegerField(default=0, editable=False)
     
     # Shipping information
     shipping_address = models.TextField(max_length=500)
@@ -48,6 +54,12 @@ class Order(models.Model):
     shipped_at = models.DateTimeField(null=True, blank=True)
     delivered_at = models.DateTimeField(null=True, blank=True)
 
+    class Meta:
+        abstract = True
+
+class Order(AbstractOrder):
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='orders')
+
     class Meta:
         db_table = 'orders'
         ordering = ['-created_at']
@@ -57,33 +69,49 @@ class Order(models.Model):
             models.Index(fields=['status']),
             models.Index(fields=['payment_status']),
             models.Index(fields=['created_at']),
+            # Keyset pagination of a user's orders by newest first
+            models.Index(fields=['user', 'created_at']),
         ]
 
     def __str__(self):
         return f"Order {self.order_number} - {self.user.email}"
 
+    # Fresh order numbers tried before a collision is reported
+    ORDER_NUMBER_ATTEMPTS = 3
+
     def save(self, *args, **kwargs):
-        if not self.order_number:
-            self.order_number = self.generate_order_number()
         self.total_amount = self.subtotal + self.tax_amount + self.shipping_cost
-        super().save(*args, **kwargs)
+        if self.order_number:
+            return super().save(*args, **kwargs)
+        # Without ID_HOST_ID two processes can, very rarely, draw the same node id
+        for attempt in range(1, self.ORDER_NUMBER_ATTEMPTS + 1):
+            self.order_number = self.generate_order_number()
+            try:
+                with transaction.atomic():
+                    return super().save(*args, **kwargs)
+            except IntegrityError:
+                taken = type(self)._default_manager.filter(order_number=self.order_number).exists()
+                if not taken or attempt == self.ORDER_NUMBER_ATTEMPTS:
+                    raise
 
     def generate_order_number(self):
-        import random
-        import string
-        return ''.join(random.choices(string.ascii_uppercase + string.digits, k=10))
-
-    @property
-    def item_count(self):
-        return self.items.count()
+        # Unique and time ordered, so order numbers sort by creation time
+        return generate_id()
 
-class OrderItem(models.Model):
-    order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name='items')
-    product = models.ForeignKey(Product, on_delete=models.CASCADE)
+class AbstractOrderItem(models.Model):
     product_name = models.CharField(max_length=200)  # Store product name at time of order
     product_price = models.DecimalField(max_digits=10, decimal_places=2)  # Store price at time of order
     quantity = models.PositiveIntegerField(validators=[MinValueValidator(1)])
     total_price = models.DecimalField(max_digits=10, decimal_places=2)
+    # Category at time of order, so a recategorized product's sales stay where they were rolled up
+    category = models.ForeignKey(Category, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+
+    class Meta:
+        abstract = True
+
+class OrderItem(AbstractOrderItem):
+    order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name='items')
+    product = models.ForeignKey(Product, on_delete=models.CASCADE)
 
     class Meta:
         db_table = 'order_items'
@@ -99,7 +127,7 @@ class OrderItem(models.Model):
         self.total_price = self.product_price * self.quantity
         super().save(*args, **kwargs)
 
-class Payment(models.Model):
+class AbstractPayment(models.Model):
     PAYMENT_METHOD_CHOICES = [
         ('credit_card', 'Credit Card'),
         ('debit_card', 'Debit Card'),
@@ -107,15 +135,20 @@ class Payment(models.Model):
         ('stripe', 'Stripe'),
     ]
 
-    order = models.OneToOneField(Order, on_delete=models.CASCADE, related_name='payment')
     payment_method = models.CharField(max_length=20, choices=PAYMENT_METHOD_CHOICES)
     payment_id = models.CharField(max_length=100, blank=True)  # Payment gateway ID
     amount = models.DecimalField(max_digits=10, decimal_places=2)
     currency = models.CharField(max_length=3, default='USD')
-    status = models.CharField(max_length=20, choices=Order.PAYMENT_STATUS_CHOICES, default='pending')
+    status = models.CharField(max_length=20, choices=AbstractOrder.PAYMENT_STATUS_CHOICES, default='pending')
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        abstract = True
+
+class Payment(AbstractPayment):
+    order = models.OneToOneField(Order, on_delete=models.CASCADE, related_name='payment')
+
     class Meta:
         db_table = 'payments'
         indexes = [
@@ -125,4 +158,129 @@ class Payment(models.Model):
         ]
 
     def __str__(self):
-        return f"Payment for Order {self.order.order_number}"
\ No newline at end of file
+        return f"Payment for Order {self.order.order_number}"
+
+class OrderStatusChange(models.Model):
+    """Append-only log of order status transitions, see transitions.py."""
+    # A plain column rather than a foreign key, so the log outlives archival of the order
+    order_id = models.BigIntegerField()
+    from_status = models.CharField(max_length=20, choices=AbstractOrder.STATUS_CHOICES)
+    to_status = models.CharField(max_length=20, choices=AbstractOrder.STATUS_CHOICES)
+    changed_by = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, blank=True, related_name='+'
+    )
+    changed_at = models.DateTimeField()
+
+    class Meta:
+        db_table = 'order_status_changes'
+        indexes = [
+            models.Index(fields=['order_id', 'changed_at']),
+        ]
+
+    def __str__(self):
+        return f"Order {self.order_id}: {self.from_status} -> {self.to_status}"
+
+class IdempotencyKey(models.Model):
+    """The stored outcome of a request sent with an `Idempotency-Key` header."""
+    STATUS_CHOICES = [
+        ('in_progress', 'In progress'),
+        ('completed', 'Completed'),
+    ]
+
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='idempotency_keys')
+    key = models.CharField(max_length=255)
+    # Method and path plus a hash of the body, a key reused for another request is rejected
+    fingerprint = models.CharField(max_length=64)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='in_progress')
+    response_status = models.PositiveSmallIntegerField(null=True, blank=True)
+    response_body = models.JSONField(null=True, blank=True, encoder=DjangoJSONEncoder)
+    created_at = models.DateTimeField(auto_now_add=True)
+    locked_at = models.DateTimeField()
+    expires_at = models.DateTimeField()
+
+    class Meta:
+        db_table = 'idempotency_keys'
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'key'], name='idempotency_keys_user_key_unique'),
+        ]
+        indexes = [
+            models.Index(fields=['expires_at']),
+        ]
+
+    def __str__(self):
+        return f"{self.key} ({self.status})"
+
+
+class PaymentJob(models.Model):
+    """A queued gateway charge for a Payment, processed by `manage.py run_payment_worker`."""
+    STATUS_CHOICES = [
+        ('queued', 'Queued'),
+        ('processing', 'Processing'),
+        ('succeeded', 'Succeeded'),
+        ('failed', 'Failed'),
+    ]
+
+    payment = models.ForeignKey(Payment, on_delete=models.CASCADE, related_name='jobs')
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='queued')
+    attempts = models.PositiveIntegerField(default=0)
+    run_after = models.DateTimeField()
+    locked_by = models.CharField(max_length=64, blank=True)
+    locked_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        db_table = 'payment_jobs'
+        indexes = [
+            # Workers claim due jobs in run_after order
+            models.Index(fields=['status', 'run_after']),
+        ]
+
+    def __str__(self):
+        return f"Payment job {self.pk} ({self.status})"
+
+
+# Closed orders past ORDER_ARCHIVE_AFTER_DAYS are moved here by `manage.py archive_orders`,
+# see archive.py. Rows keep their ids, so links and order numbers stay valid.
+
+class ArchivedOrder(AbstractOrder):
+    id = models.BigIntegerField(primary_key=True)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='archived_orders')
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        db_table = 'orders_archive'
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['user', 'created_at']),
+            models.Index(fields=['created_at']),
+        ]
+
+    def __str__(self):
+        return f"Archived order {self.order_number}"
+
+class ArchivedOrderItem(AbstractOrderItem):
+    id = models.BigIntegerField(primary_key=True)
+    order = models.ForeignKey(ArchivedOrder, on_delete=models.CASCADE, related_name='items')
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='+')
+
+    class Meta:
+        db_table = 'order_items_archive'
+        indexes = [
+            models.Index(fields=['order']),
+            models.Index(fields=['product']),
+        ]
+
+    def __str__(self):
+        return f"{self.quantity} x {self.product_name}"
+
+class ArchivedPayment(AbstractPayment):
+    id = models.BigIntegerField(primary_key=True)
+    order = models.OneToOneField(ArchivedOrder, on_delete=models.CASCADE, related_name='payment')
+
+    class Meta:
+        db_table = 'payments_archive'
+
+    def __str__(self):
+        return f"Payment for archived order {self.order.order_number}"
@@ -0,0 +1,46 @@
+from operator import attrgetter
+
+from apps.core.pagination import KeysetPagination
+from .archive import archive_cutoff
+
+
+class OrderPagination(KeysetPagination):
+    """
+    Keyset pagination over a user's orders, hot and archived alike.
+
+    Every archived order is older than `archive_cutoff()`, so the archive is
+    only queried for pages that reach past it or run out of hot orders. Those
+    pages merge rows from both tables in the page's ordering. The view
+    provides the archive side with `get_archive_queryset()`.
+    """
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.view = view
+        return super().paginate_queryset(queryset, request, view)
+
+    def fetch_page(self, queryset, ordering):
+        results = super().fetch_page(queryset, ordering)
+        if self.view is None or not self.reaches_archive(results, ordering):
+            return results
+        results += super().fetch_page(self.view.get_archive_queryset(), ordering)
+        # Stable sorts from the last key to the first give the combined ordering
+        for field in reversed(ordering):
+            results.sort(key=attrgetter(field.lstrip('-')), reverse=field.startswith('-'))
+        return results[:self.page_size + 1]
+
+    def reaches_archive(self, results, ordering):
+        if ordering[0].lstrip('-') != 'created_at':
+            return True
+        # Ran out of hot orders going back in time
+        if ordering[0].startswith('-') and len(results) <= self.page_size:
+            return True
+        times = [row.created_at for row in results]
+        if self.cursor:
+            times.append(self.cursor['v'][0])
+        return not times or min(times) < archive_cutoff()
+
+    def get_approximate_count(self, queryset):
+        count = super().get_approximate_count(queryset)
+        if self.view is not None:
+            count += super().get_approximate_count(self.view.get_archive_queryset())
+        return count
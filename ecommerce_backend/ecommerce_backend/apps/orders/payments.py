@@ -0,0 +1,173 @@
+"""
+Asynchronous payment processing.
+
+`create_payment` only records a pending Payment and queues a PaymentJob. A
+worker (`manage.py run_payment_worker`) claims due jobs in batches with
+`SELECT ... FOR UPDATE SKIP LOCKED`, so several workers never pick up the
+same job, and calls the gateway outside of any transaction. The outcome is
+written to the job, the Payment and the Order in one transaction.
+
+Transient gateway errors are retried with exponential backoff up to
+`PAYMENT_MAX_ATTEMPTS`. A job left in `processing` by a crashed worker is
+picked up again after `PAYMENT_JOB_LOCK_TIMEOUT` seconds. The gateway is
+given the same idempotency key on every attempt of a job, so that can't
+charge twice, while a failed payment paid again gets a new job and key.
+Cancelled orders can't be paid, and a charge that lands after the order was
+cancelled leaves the order alone and is logged for a refund.
+"""
+import logging
+import os
+import random
+import socket
+import time
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from apps.analytics.rollups import record_paid
+from .gateway import GatewayError, PaymentDeclined, get_gateway
+from .models import Order, Payment, PaymentJob
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 10
+
+
+class PaymentNotAllowed(Exception):
+    pass
+
+
+def enqueue_payment(order, payment_method):
+    """Create (or retry a failed) Payment for `order` and queue it for the worker."""
+    with transaction.atomic():
+        order = Order.objects.select_for_update().get(pk=order.pk)
+        if order.status == 'cancelled':
+            raise PaymentNotAllowed('Order has been cancelled.')
+        if order.payment_status == 'paid':
+            raise PaymentNotAllowed('Order has already been paid.')
+        payment = Payment.objects.filter(order=order).first()
+        if payment is None:
+            payment = Payment.objects.create(
+                order=order, amount=order.total_amount, payment_method=payment_method,
+            )
+        elif payment.status == 'failed':
+            payment.status = 'pending'
+            payment.amount = order.total_amount
+            payment.payment_method = payment_method
+            payment.save(update_fields=['status', 'amount', 'payment_method', 'updated_at'])
+            Order.objects.filter(pk=order.pk).update(payment_status='pending', updated_at=timezone.now())
+        else:
+            raise PaymentNotAllowed('Order already has a payment.')
+        PaymentJob.objects.create(payment=payment, run_after=timezone.now())
+    return payment
+
+
+def worker_name():
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def claim_jobs(worker, batch_size=DEFAULT_BATCH_SIZE):
+    """Mark up to `batch_size` due jobs as processing by `worker` and return them."""
+    now = timezone.now()
+    stale = now - timedelta(seconds=settings.PAYMENT_JOB_LOCK_TIMEOUT)
+    due = Q(status='queued', run_after__lte=now) | Q(status='processing', locked_at__lt=stale)
+    token = f'{worker}:{uuid.uuid4().hex[:8]}'
+    with transaction.atomic():
+        ids = list(
+            PaymentJob.objects.select_for_update(skip_locked=True)
+            .filter(due).order_by('run_after').values_list('pk', flat=True)[:batch_size]
+        )
+        if not ids:
+            return []
+        # Conditional, so it is safe even where SKIP LOCKED isn't available
+        PaymentJob.objects.filter(due, pk__in=ids).update(
+            status='processing', locked_by=token, locked_at=now, updated_at=now,
+        )
+    return list(PaymentJob.objects.filter(locked_by=token, status='processing').select_related('payment'))
+
+
+def retry_delay(attempts):
+    """Exponential backoff with jitter, in seconds."""
+    delay = min(settings.PAYMENT_RETRY_BACKOFF * 2 ** (attempts - 1), settings.PAYMENT_RETRY_BACKOFF_MAX)
+    return delay * random.uniform(0.8, 1.2)
+
+
+def process_job(job, gateway):
+    payment = job.payment
+    attempts = job.attempts + 1
+    if Order.objects.filter(pk=payment.order_id, status='cancelled').exists():
+        _finish(job, attempts, succeeded=False, error='Order was cancelled.')
+        return
+    try:
+        # Per job: the gateway would answer a new attempt after a failure with the old outcome
+        gateway_id = gateway.charge(payment, idempotency_key=f'payment-job-{job.pk}')
+    except PaymentDeclined as exc:
+        _finish(job, attempts, succeeded=False, error=str(exc))
+    except GatewayError as exc:
+        if attempts >= settings.PAYMENT_MAX_ATTEMPTS:
+            _finish(job, attempts, succeeded=False, error=str(exc))
+        else:
+            PaymentJob.objects.filter(pk=job.pk, locked_by=job.locked_by).update(
+                status='queued', attempts=attempts, last_error=str(exc), locked_by='', locked_at=None,
+                run_after=timezone.now() + timedelta(seconds=retry_delay(attempts)), updated_at=timezone.now(),
+            )
+    else:
+        _finish(job, attempts, succeeded=True, gateway_id=gateway_id)
+
+
+def _finish(job, attempts, succeeded, gateway_id='', error=''):
+    now = timezone.now()
+    with transaction.atomic():
+        # Only the worker still holding the job may record its outcome
+        owned = PaymentJob.objects.filter(pk=job.pk, locked_by=job.locked_by, status='processing').update(
+            status='succeeded' if succeeded else 'failed', attempts=attempts, last_error=error, updated_at=now,
+        )
+        if not owned:
+            return
+        payment_status = 'paid' if succeeded else 'failed'
+        payment_changes = {'status': payment_status, 'updated_at': now}
+        if gateway_id:
+            payment_changes['payment_id'] = gateway_id
+        Payment.objects.filter(pk=job.payment_id, status='pending').update(**payment_changes)
+        order_changes = {'payment_status': payment_status, 'updated_at': now}
+        if succeeded:
+            order_changes['paid_at'] = now
+        order_id = job.payment.order_id
+        # Cancelling doesn't wait for the worker, a cancelled order is never marked paid
+        changed = Order.objects.filter(pk=order_id).exclude(payment_status='paid').exclude(
+            status='cancelled'
+        ).update(**order_changes)
+        if succeeded and changed:
+            record_paid([order_id])
+        elif succeeded:
+            logger.warning('Payment %s was charged but order %s is cancelled or already paid, refund it',
+                           job.payment_id, order_id)
+
+
+def process_jobs(gateway=None, batch_size=DEFAULT_BATCH_SIZE, worker=None):
+    """Claim and process one batch, returns the number of jobs handled."""
+    gateway = gateway or get_gateway()
+    jobs = claim_jobs(worker or worker_name(), batch_size)
+    for job in jobs:
+        try:
+            process_job(job, gateway)
+        except Exception:
+            # Left in processing, the job is retried once its lock times out
+            logger.exception('Payment job %s failed', job.pk)
+    return len(jobs)
+
+
+def run_worker(batch_size=DEFAULT_BATCH_SIZE, poll_interval=1.0, once=False):
+    gateway = get_gateway()
+    worker = worker_name()
+    while True:
+        close_old_connections()
+        handled = process_jobs(gateway, batch_size, worker)
+        if once and not handled:
+            return
+        if not handled:
+            time.sleep(poll_interval)
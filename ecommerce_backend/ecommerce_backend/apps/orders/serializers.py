@@ -1,8 +1,25 @@
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
 from rest_framework import serializers
 from .models import Order, OrderItem, Payment
+from apps.core.sparse import SparseFieldsSerializerMixin
+from apps.products.inventory import stock_case
+from apps.products.leaderboard import invalidate_featured
+from apps.products.models import Product
 from apps.products.serializers import ProductListSerializer
 
-class OrderItemSerializer(serializers.ModelSerializer):
+TAX_RATE = Decimal('0.08')  # 8% tax
+SHIPPING_COST = Decimal('10.00')  # Fixed shipping cost
+
+
+class InsufficientStock(Exception):
+    """Raised inside checkout to roll back a partial stock reservation."""
+
+class OrderItemSerializer(SparseFieldsSerializerMixin, serializers.ModelSerializer):
     product_details = ProductListSerializer(source='product', read_only=True)
     
     class Meta:
@@ -10,21 +27,20 @@ class OrderItemSerializer(serializers.ModelSerializer):
         fields = ('id', 'product', 'product_details', 'product_name', 'product_price', 'quantity', 'total_price')
         read_only_fields = ('product_name', 'product_price', 'total_price')
 
-class OrderItemCreateSerializer(serializers.ModelSerializer):
-    class Meta:
-        model = OrderItem
-        fields = ('product', 'quantity')
+class OrderItemCreateSerializer(serializers.Serializer):
+    # A plain id, OrderCreateSerializer resolves all products of the cart in one query
+    product = serializers.IntegerField()
+    quantity = serializers.IntegerField(min_value=1)
 
-class PaymentSerializer(serializers.ModelSerializer):
+class PaymentSerializer(SparseFieldsSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = Payment
         fields = '__all__'
         read_only_fields = ('order', 'amount', 'currency')
 
-class OrderSerializer(serializers.ModelSerializer):
+class OrderSerializer(SparseFieldsSerializerMixin, serializers.ModelSerializer):
     items = OrderItemSerializer(many=True, read_only=True)
     payment = PaymentSerializer(read_only=True)
-    item_count = serializers.ReadOnlyField()
     
     class Meta:
         model = Order
@@ -34,11 +50,28 @@ class OrderSerializer(serializers.ModelSerializer):
             'shipping_address', 'shipping_city', 'shipping_state', 
             'shipping_zipcode', 'shipping_country',
             'customer_email', 'customer_phone',
-            'items', 'payment', 'item_count',
+            'items', 'payment', 'item_count', 'total_quantity',
             'created_at', 'updated_at', 'paid_at', 'shipped_at', 'delivered_at'
         )
         read_only_fields = ('user', 'order_number', 'subtotal', 'tax_amount', 'total_amount')
 
+class OrderSummarySerializer(SparseFieldsSerializerMixin, serializers.ModelSerializer):
+    """Totals only, for order listings. Line items are on the detail endpoint or `?expand=items`."""
+    items = OrderItemSerializer(many=True, read_only=True)
+    payment = PaymentSerializer(read_only=True)
+
+    class Meta:
+        model = Order
+        fields = (
+            'id', 'order_number', 'status', 'payment_status',
+            'subtotal', 'tax_amount', 'shipping_cost', 'total_amount',
+            'item_count', 'total_quantity',
+            'created_at', 'updated_at', 'paid_at', 'shipped_at', 'delivered_at',
+            'items', 'payment'
+        )
+        read_only_fields = fields
+        expandable_fields = ('items', 'payment')
+
 class OrderCreateSerializer(serializers.ModelSerializer):
     items = OrderItemCreateSerializer(many=True)
     
@@ -50,66 +83,106 @@ class OrderCreateSerializer(serializers.ModelSerializer):
             'customer_email', 'customer_phone',
             'items'
         )
+        # Defaults to the account email
+        extra_kwargs = {'customer_email': {'required': False}}
 
     def validate_items(self, value):
         if not value:
             raise serializers.ValidationError("Order must contain at least one item.")
-        return value
+
+        # Merge repeated lines for the same product
+        quantities = defaultdict(int)
+        for item in value:
+            quantities[item['product']] += item['quantity']
+
+        products = Product.objects.filter(is_active=True).only('id', 'name', 'price', 'category_id').in_bulk(list(quantities))
+        missing = [pk for pk in quantities if pk not in products]
+        if missing:
+            raise serializers.ValidationError(
+                [f'Invalid product "{pk}" - object does not exist or is not available.' for pk in missing]
+            )
+        return [{'product': products[pk], 'quantity': quantity} for pk, quantity in quantities.items()]
 
     def create(self, validated_data):
         items_data = validated_data.pop('items')
+        validated_data.pop('user', None)
         user = self.context['request'].user
-        
-        # Calculate order totals
-        subtotal = 0
-        for item_data in items_data:
-            product = item_data['product']
-            quantity = item_data['quantity']
-            
-            if product.stock < quantity:
-                raise serializers.ValidationError(
-                    f"Insufficient stock for {product.name}. Available: {product.stock}, Requested: {quantity}"
-                )
-            
-            subtotal += product.price * quantity
+        validated_data.setdefault('customer_email', user.email)
+
+        # validate_items already merged the lines and loaded the products
+        products = {item['product'].pk: item['product'] for item in items_data}
+        quantities = {item['product'].pk: item['quantity'] for item in items_data}
+
+        subtotal = sum(products[pk].price * quantity for pk, quantity in quantities.items())
         
         # Calculate tax and shipping (simplified)
-        tax_amount = subtotal * 0.08  # 8% tax
-        shipping_cost = 10.00  # Fixed shipping cost
-        
-        # Create order
-        order = Order.objects.create(
-            user=user,
-            customer_email=user.email,
-            subtotal=subtotal,
-            tax_amount=tax_amount,
-            shipping_cost=shipping_cost,
-            **validated_data
-        )
-        
-        # Create order items and update product stock
-        for item_data in items_data:
-            product = item_data['product']
-            quantity = item_data['quantity']
-            
-            OrderItem.objects.create(
-                order=order,
-                product=product,
-                product_name=product.name,
-                product_price=product.price,
-                quantity=quantity
-            )
-            
-            # Update product stock
-            product.stock -= quantity
-            product.save()
+        tax_amount = (subtotal * TAX_RATE).quantize(Decimal('0.01'))
+        shipping_cost = SHIPPING_COST
+
+        try:
+            with transaction.atomic():
+                # Reserve stock for every line in one conditional UPDATE. A row
+                # only matches if it still has enough stock, so concurrent
+                # checkouts can't oversell and nothing is read-then-written.
+                reserved = Product.objects.filter(
+                    pk__in=list(quantities), stock__gte=stock_case(quantities)
+                ).update(stock=F('stock') - stock_case(quantities), updated_at=timezone.now())
+                if reserved != len(quantities):
+                    raise InsufficientStock
+
+                order = Order.objects.create(
+                    user=user,
+                    subtotal=subtotal,
+                    tax_amount=tax_amount,
+                    shipping_cost=shipping_cost,
+                    item_count=len(quantities),
+                    total_quantity=sum(quantities.values()),
+                    **validated_data
+                )
+                OrderItem.objects.bulk_create([
+                    OrderItem(
+                        order=order,
+                        product=products[pk],
+                        category_id=products[pk].category_id,
+                        product_name=products[pk].name,
+                        product_price=products[pk].price,
+                        quantity=quantity,
+                        total_price=products[pk].price * quantity,
+                    )
+                    for pk, quantity in quantities.items()
+                ])
+                transaction.on_commit(invalidate_featured)
+        except InsufficientStock:
+            # Everything was rolled back, report against the current stock
+            raise serializers.ValidationError(self._insufficient_stock(products, quantities))
         
         return order
 
-class OrderStatusUpdateSerializer(serializers.ModelSerializer):
-    class Meta:
-        model = Order
-        fields = ('status',)
+    def _insufficient_stock(self, products, quantities):
+        available = dict(Product.objects.filter(pk__in=list(quantities)).values_list('pk', 'stock'))
+        return [
+            f"Insufficient stock for {products[pk].name}. Available: {available.get(pk, 0)}, Requested: {quantity}"
+            for pk, quantity in quantities.items()
+            if available.get(pk, 0) < quantity
+        ] or ["Insufficient stock."]
+
+class OrderStatusUpdateSerializer(serializers.Serializer):
+    status = serializers.ChoiceField(choices=Order.STATUS_CHOICES)
+
+class OrderBulkCancelSerializer(serializers.Serializer):
+    MAX_ORDERS = 1000
+
+    ids = serializers.ListField(
+        child=serializers.IntegerField(), allow_empty=False, max_length=MAX_ORDERS
+    )
+
+class OrderBulkTransitionSerializer(serializers.Serializer):
+    MAX_ORDERS = 10000
+
+    ids = serializers.ListField(
+        child=serializers.IntegerField(), allow_empty=False, max_length=MAX_ORDERS
+    )
+    status = serializers.ChoiceField(choices=Order.STATUS_CHOICES)
 
 class PaymentCreateSerializer(serializers.ModelSerializer):
     class Meta:
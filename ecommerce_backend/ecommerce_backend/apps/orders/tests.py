@@ -1,3 +1,875 @@
-from django.test import TestCase
+import multiprocessing
+import os
+import threading
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth import get_user_model
+from django.db import IntegrityError, connection
+from django.test.utils import CaptureQueriesContext
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from apps.core import ids
+from apps.core.ids import IdGenerator, decode, generate_id, lower_bound, timestamp_of
+from apps.core.paginator import EstimatedCountPaginator
+from apps.products.models import Category, Product
+from .archive import archive_orders
+from .gateway import FakeGateway
+from .idempotency import _responses, sweep_expired_keys
+from .models import (
+    ArchivedOrder, ArchivedOrderItem, ArchivedPayment, IdempotencyKey, Order, OrderItem, OrderStatusChange,
+    Payment, PaymentJob
+)
+from .payments import process_jobs
+from .serializers import OrderCreateSerializer
+from .transitions import transition_orders
+
+ORDERS_URL = '/api/orders/orders/'
+
+SHIPPING = {
+    'shipping_address': '1 Main St',
+    'shipping_city': 'Springfield',
+    'shipping_state': 'IL',
+    'shipping_zipcode': '62701',
+}
+
+
+def make_product(category, sku, stock, price='10.00'):
+    return Product.objects.create(
+        name=f'Product {sku}', slug=f'product-{sku}', sku=sku, description='',
+        price=Decimal(price), category=category, stock=stock,
+    )
+
+
+def generate_ids(count):
+    return [generate_id() for _ in range(count)]
+
+
+def generate_ids_with_pid(count):
+    return os.getpid(), generate_ids(count)
+
+
+class OrderNumberTests(SimpleTestCase):
+    PROCESSES = 8
+    PER_PROCESS = 20000
+
+    def test_unique_and_ordered_across_processes(self):
+        generate_id()  # the parent's generator state must not leak into the workers
+        with multiprocessing.get_context('fork').Pool(self.PROCESSES) as pool:
+            batches = pool.map(generate_ids, [self.PER_PROCESS] * self.PROCESSES)
+
+        ids = [identifier for batch in batches for identifier in batch]
+        self.assertEqual(len(set(ids)), self.PROCESSES * self.PER_PROCESS)
+        for batch in batches:
+            self.assertEqual(batch, sorted(batch))
+            self.assertTrue(all(len(identifier) == 18 for identifier in batch))
+
+    def test_host_id_gives_every_process_its_own_node(self):
+        with mock.patch.object(ids, '_generator', IdGenerator(host_id=3)):
+            generate_id()
+            with multiprocessing.get_context('fork').Pool(4) as pool:
+                batches = pool.map(generate_ids_with_pid, [1000] * 4)
+
+        seen = set()
+        for pid, batch in batches:
+            node = decode(batch[0]) >> ids.SEQUENCE_BITS & ((1 << ids.NODE_BITS) - 1)
+            self.assertEqual(node, (3 << ids.PID_BITS) | pid)
+            seen.update(batch)
+        self.assertEqual(len(seen), 4000)
+        with self.assertRaises(ValueError):
+            IdGenerator(host_id=ids.MAX_HOST_ID + 1)
+
+    def test_monotonic_when_the_sequence_overflows(self):
+        generator = IdGenerator(host_id=7)
+        values = [generator.next_value() for _ in range(200000)]
+        self.assertEqual(values, sorted(set(values)))
+
+    def test_time_ordering(self):
+        before = timezone.now()
+        identifier = generate_id()
+        self.assertLessEqual(lower_bound(before), identifier)
+        self.assertLess(abs((timestamp_of(identifier) - before).total_seconds()), 1)
+
+    def test_burst_stays_unique_and_close_to_the_clock(self):
+        count = 200000
+        identifiers = generate_ids(count)
+        self.assertEqual(len(set(identifiers)), count)
+        self.assertEqual(identifiers, sorted(identifiers))
+        # A burst only borrows milliseconds ahead when it outruns the per-millisecond sequence
+        self.assertLess(timestamp_of(identifiers[-1]), timezone.now() + timedelta(seconds=1))
+
+
+class CheckoutTests(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(
+            username='buyer', email='buyer@example.com', password='secret'
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        category = Category.objects.create(name='Things', slug='things')
+        self.first = make_product(category, 'A1', stock=5)
+        self.second = make_product(category, 'B1', stock=1, price='2.50')
+
+    def checkout(self, *items):
+        return self.client.post(ORDERS_URL, {
+            **SHIPPING,
+            'items': [{'product': product.pk, 'quantity': quantity} for product, quantity in items],
+        }, format='json')
+
+    def test_checkout_reserves_stock_and_merges_lines(self):
+        response = self.checkout((self.first, 2), (self.second, 1), (self.first, 1))
+
+        self.assertEqual(response.status_code, 201, response.data)
+        order = Order.objects.get()
+        self.assertEqual(order.customer_email, 'buyer@example.com')
+        self.assertEqual(order.subtotal, Decimal('32.50'))
+        self.assertEqual(order.tax_amount, Decimal('2.60'))
+        self.assertEqual(order.total_amount, Decimal('45.10'))
+        self.assertEqual(
+            dict(order.items.values_list('product_id', 'quantity')),
+            {self.first.pk: 3, self.second.pk: 1},
+        )
+        self.first.refresh_from_db()
+        self.second.refresh_from_db()
+        self.assertEqual((self.first.stock, self.second.stock), (2, 0))
+
+    def test_checkout_is_all_or_nothing(self):
+        response = self.checkout((self.first, 2), (self.second, 2))
+
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('B1', str(response.data))
+        self.assertFalse(Order.objects.exists())
+        self.assertFalse(OrderItem.objects.exists())
+        self.first.refresh_from_db()
+        self.assertEqual(self.first.stock, 5)
+
+    def test_order_number_collision_draws_a_new_number(self):
+        self.assertEqual(self.checkout((self.first, 1)).status_code, 201)
+        taken = Order.objects.get().order_number
+        fresh = generate_id()
+        with mock.patch.object(Order, 'generate_order_number', side_effect=[taken, fresh]):
+            self.assertEqual(self.checkout((self.first, 1)).status_code, 201)
+        self.assertEqual(Order.objects.latest('pk').order_number, fresh)
+
+        with mock.patch.object(Order, 'generate_order_number', return_value=taken):
+            with self.assertRaises(IntegrityError):
+                Order.objects.create(user=self.user, customer_email='buyer@example.com', **SHIPPING)
+
+    def test_cart_validation_is_one_query(self):
+        category = Category.objects.get(slug='things')
+        products = [make_product(category, f'C{n}', stock=1) for n in range(50)]
+        request = RequestFactory().post(ORDERS_URL)
+        request.user = self.user
+        data = {**SHIPPING, 'items': [{'product': product.pk, 'quantity': 1} for product in products]}
+        data['items'].append({'product': products[0].pk, 'quantity': 2})
+
+        serializer = OrderCreateSerializer(data=data, context={'request': request})
+        with self.assertNumQueries(1):
+            self.assertTrue(serializer.is_valid(), serializer.errors)
+        items = serializer.validated_data['items']
+        self.assertEqual(len(items), 50)
+        self.assertEqual(items[0], {'product': products[0], 'quantity': 3})
+
+    def test_inactive_products_are_rejected(self):
+        Product.objects.filter(pk=self.second.pk).update(is_active=False)
+
+        response = self.checkout((self.first, 1), (self.second, 1))
+
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('items', response.data)
+        self.assertFalse(Order.objects.exists())
+
+
+class CancelTests(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(
+            username='buyer', email='buyer@example.com', password='secret'
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        category = Category.objects.create(name='Things', slug='things')
+        self.first = make_product(category, 'A1', stock=10)
+        self.second = make_product(category, 'B1', stock=10)
+
+    def place_order(self, quantity=1):
+        response = self.client.post(ORDERS_URL, {
+            **SHIPPING,
+            'items': [
+                {'product': self.first.pk, 'quantity': quantity},
+                {'product': self.second.pk, 'quantity': 1},
+            ],
+        }, format='json')
+        self.assertEqual(response.status_code, 201, response.data)
+        return response.data['id']
+
+    def stock(self):
+        return tuple(Product.objects.filter(pk__in=[self.first.pk, self.second.pk]).order_by('sku').values_list(
+            'stock', flat=True
+        ))
+
+    def test_cancel_restores_stock_once(self):
+        order_id = self.place_order(quantity=3)
+        self.assertEqual(self.stock(), (7, 9))
+
+        for _ in range(2):
+            response = self.client.post(f'{ORDERS_URL}{order_id}/cancel/')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.data['status'], 'cancelled')
+        self.assertEqual(self.stock(), (10, 10))
+
+    def test_shipped_orders_cannot_be_cancelled(self):
+        order_id = self.place_order()
+        Order.objects.filter(pk=order_id).update(status='shipped')
+
+        response = self.client.post(f'{ORDERS_URL}{order_id}/cancel/')
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.stock(), (9, 9))
+
+    def test_bulk_cancel(self):
+        pending = [self.place_order(), self.place_order(quantity=2)]
+        shipped = self.place_order()
+        Order.objects.filter(pk=shipped).update(status='shipped')
+        self.assertEqual(self.stock(), (6, 7))
+
+        # Read, status CAS in its own savepoint, history, grouped quantities, stock restore,
+        # all inside the outer savepoint
+        with self.assertNumQueries(9):
+            response = self.client.post(
+                f'{ORDERS_URL}bulk_cancel/', {'ids': pending + [shipped, 999999]}, format='json'
+            )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['cancelled'], pending)
+        self.assertEqual(response.data['rejected'], {shipped: 'not_cancellable', 999999: 'not_found'})
+        self.assertEqual(self.stock(), (9, 9))
+
+        response = self.client.post(f'{ORDERS_URL}bulk_cancel/', {'ids': pending}, format='json')
+        self.assertEqual(response.data['cancelled'], [])
+        self.assertEqual(self.stock(), (9, 9))
+
+
+class StatusTransitionTests(TestCase):
+    def setUp(self):
+        User = get_user_model()
+        self.user = User.objects.create_user(username='buyer', email='buyer@example.com', password='secret')
+        self.staff = User.objects.create_user(
+            username='fulfilment', email='ops@example.com', password='secret', is_staff=True
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        category = Category.objects.create(name='Things', slug='things')
+        self.product = make_product(category, 'A1', stock=100)
+
+    def place_order(self):
+        response = self.client.post(ORDERS_URL, {
+            **SHIPPING, 'items': [{'product': self.product.pk, 'quantity': 1}],
+        }, format='json')
+        return response.data['id']
+
+    def update_status(self, order_id, target):
+        return self.client.post(f'{ORDERS_URL}{order_id}/update_status/', {'status': target}, format='json')
+
+    def test_orders_move_through_the_lifecycle(self):
+        order_id = self.place_order()
+        self.assertEqual(self.update_status(order_id, 'processing').status_code, 403)
+        self.client.force_authenticate(self.staff)
+
+        response = self.update_status(order_id, 'shipped')
+        self.assertEqual(response.status_code, 400)
+
+        for target in ('processing', 'shipped', 'delivered'):
+            response = self.update_status(order_id, target)
+            self.assertEqual(response.status_code, 200, response.data)
+            self.assertEqual(response.data['status'], target)
+        self.assertIsNotNone(response.data['shipped_at'])
+        self.assertIsNotNone(response.data['delivered_at'])
+        self.assertEqual(
+            list(OrderStatusChange.objects.filter(order_id=order_id).order_by('pk').values_list(
+                'from_status', 'to_status', 'changed_by'
+            )),
+            [('pending', 'processing', self.staff.pk), ('processing', 'shipped', self.staff.pk),
+             ('shipped', 'delivered', self.staff.pk)],
+        )
+
+        self.assertEqual(self.update_status(order_id, 'cancelled').status_code, 400)
+        self.assertEqual(self.update_status(order_id, 'delivered').status_code, 200)
+        self.assertEqual(OrderStatusChange.objects.filter(order_id=order_id).count(), 3)
+
+    def test_concurrent_change_is_not_overwritten(self):
+        first, second, third = (self.place_order() for _ in range(3))
+        rows = Order.objects.filter(pk__in=[first, second, third]).values_list('pk', 'status', 'payment_status')
+
+        # Another worker ships `second` between our read and our update
+        class Interleaved:
+            def filter(self, **kwargs):
+                read = list(rows.filter(**kwargs).order_by())
+                Order.objects.filter(pk=second).update(status='processing')
+                return FakeQuerySet(read)
+
+        class FakeQuerySet(list):
+            def order_by(self):
+                return self
+
+            def values_list(self, *fields):
+                return self
+
+        changed, rejected = transition_orders(Interleaved(), [first, second, third], 'processing')
+
+        self.assertEqual(changed, [first, third])
+        self.assertEqual(rejected, {second: 'conflict'})
+        self.assertEqual(OrderStatusChange.objects.count(), 2)
+
+    def test_bulk_transition(self):
+        orders = [self.place_order() for _ in range(5)]
+        self.client.force_authenticate(self.staff)
+        self.client.post(f'{ORDERS_URL}bulk_transition/', {'ids': orders[:4], 'status': 'processing'}, format='json')
+
+        # Read, CAS in its own savepoint, history, all inside the outer savepoint
+        with self.assertNumQueries(7):
+            response = self.client.post(
+                f'{ORDERS_URL}bulk_transition/', {'ids': orders + [999999], 'status': 'shipped'}, format='json'
+            )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['changed'], orders[:4])
+        self.assertEqual(response.data['rejected'], {orders[4]: 'not_allowed', 999999: 'not_found'})
+        self.assertEqual(
+            Order.objects.filter(status='shipped', shipped_at__isnull=False).count(), 4
+        )
+        self.assertEqual(OrderStatusChange.objects.filter(to_status='shipped').count(), 4)
+
+        # Cancelling through a transition restores stock like cancel does
+        response = self.client.post(
+            f'{ORDERS_URL}bulk_transition/', {'ids': orders, 'status': 'cancelled'}, format='json'
+        )
+        self.assertEqual(response.data['changed'], [orders[4]])
+        self.assertEqual(Product.objects.get(pk=self.product.pk).stock, 96)
+
+
+class OrderAdminTests(TestCase):
+    def setUp(self):
+        User = get_user_model()
+        self.admin = User.objects.create_superuser(username='admin', email='admin@example.com', password='secret')
+        self.client.force_login(self.admin)
+        self.buyers = [
+            User.objects.create_user(username=f'buyer{n}', email=f'buyer{n}@example.com', password='secret')
+            for n in range(6)
+        ]
+        category = Category.objects.create(name='Things', slug='things')
+        self.product = make_product(category, 'A1', stock=100)
+        self.changelist = reverse('admin:orders_order_changelist')
+
+    def place_order(self, buyer):
+        api = APIClient()
+        api.force_authenticate(buyer)
+        response = api.post(ORDERS_URL, {
+            **SHIPPING, 'items': [{'product': self.product.pk, 'quantity': 2}],
+        }, format='json')
+        return response.data['id']
+
+    def test_changelist_queries_do_not_grow_with_rows(self):
+        for buyer in self.buyers[:2]:
+            self.place_order(buyer)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.client.get(self.changelist).status_code, 200)
+        expected = len(queries)
+        for buyer in self.buyers[2:]:
+            self.place_order(buyer)
+        with self.assertNumQueries(expected):
+            self.client.get(self.changelist)
+
+    def test_item_forms_use_raw_id_widgets(self):
+        order_id = self.place_order(self.buyers[0])
+        response = self.client.get(reverse('admin:orders_order_change', args=[order_id]))
+        self.assertEqual(response.status_code, 200)
+        self.assertNotContains(response, '<select name="user"')
+        self.assertNotContains(response, '<select name="items-0-product"')
+
+    def test_ship_and_cancel_actions(self):
+        orders = [self.place_order(buyer) for buyer in self.buyers[:3]]
+        Order.objects.filter(pk__in=orders[:2]).update(status='processing')
+
+        response = self.client.post(self.changelist, {'action': 'mark_shipped', '_selected_action': orders})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(
+            dict(Order.objects.values_list('pk', 'status')),
+            {orders[0]: 'shipped', orders[1]: 'shipped', orders[2]: 'pending'},
+        )
+        self.assertEqual(OrderStatusChange.objects.filter(changed_by=self.admin).count(), 2)
+
+        self.client.post(self.changelist, {'action': 'cancel_orders', '_selected_action': orders})
+        self.assertEqual(Order.objects.get(pk=orders[2]).status, 'cancelled')
+        self.assertEqual(Product.objects.get(pk=self.product.pk).stock, 96)
+
+    def test_filtered_count_is_capped(self):
+        for buyer in self.buyers[:4]:
+            self.place_order(buyer)
+        paginator = EstimatedCountPaginator(Order.objects.filter(status='pending'), 2)
+        paginator.max_count = 3
+        self.assertEqual(paginator.count, 3)
+        self.assertEqual(EstimatedCountPaginator(Order.objects.all(), 2).count, 4)
+
+
+class OrderListingTests(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(
+            username='buyer', email='buyer@example.com', password='secret'
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        category = Category.objects.create(name='Things', slug='things')
+        self.products = [make_product(category, f'P{n}', stock=100) for n in range(5)]
+
+    def place_order(self, lines):
+        response = self.client.post(ORDERS_URL, {
+            **SHIPPING,
+            'items': [{'product': product.pk, 'quantity': 2} for product in self.products[:lines]],
+        }, format='json')
+        self.assertEqual(response.status_code, 201, response.data)
+        return response.data['id']
+
+    def test_checkout_stores_item_totals(self):
+        order_id = self.place_order(3)
+
+        order = Order.objects.get(pk=order_id)
+        self.assertEqual((order.item_count, order.total_quantity), (3, 6))
+
+    def test_list_is_a_query_of_summaries(self):
+        for lines in range(1, 6):
+            self.place_order(lines)
+
+        # Plus one on the archive, as the page runs out of hot orders
+        with self.assertNumQueries(2):
+            response = self.client.get(ORDERS_URL)
+
+        results = response.data['results']
+        self.assertEqual(len(results), 5)
+        self.assertNotIn('items', results[0])
+        self.assertEqual(
+            sorted((order['item_count'], order['total_quantity']) for order in results),
+            [(n, 2 * n) for n in range(1, 6)],
+        )
+
+    def test_detail_query_count_does_not_grow_with_items(self):
+        small, large = self.place_order(1), self.place_order(5)
+
+        for order_id, lines in ((small, 1), (large, 5)):
+            # Order, items with product and category, primary images, payment
+            with self.assertNumQueries(4):
+                response = self.client.get(f'{ORDERS_URL}{order_id}/')
+            self.assertEqual(len(response.data['items']), lines)
+            self.assertIn('primary_image', response.data['items'][0]['product_details'])
+
+    def test_sparse_fields_and_expand(self):
+        self.place_order(2)
+
+        # Both only read the (empty) archive after the hot orders
+        with self.assertNumQueries(2):
+            response = self.client.get(f'{ORDERS_URL}?fields=id,total_amount')
+        self.assertEqual(set(response.data['results'][0]), {'id', 'total_amount'})
+
+        # Items without their product details don't join products
+        with self.assertNumQueries(3):
+            response = self.client.get(f'{ORDERS_URL}?expand=items&fields=id,items.product_name')
+        items = response.data['results'][0]['items']
+        self.assertEqual(sorted(item['product_name'] for item in items), ['Product P0', 'Product P1'])
+        self.assertEqual(set(items[0]), {'product_name'})
+
+
+class IdempotencyTests(TestCase):
+    def setUp(self):
+        _responses.clear()
+        self.user = get_user_model().objects.create_user(
+            username='buyer', email='buyer@example.com', password='secret'
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        category = Category.objects.create(name='Things', slug='things')
+        self.product = make_product(category, 'A1', stock=10)
+        self.payload = {**SHIPPING, 'items': [{'product': self.product.pk, 'quantity': 1}]}
+
+    def checkout(self, key, payload=None):
+        return self.client.post(ORDERS_URL, payload or self.payload, format='json', HTTP_IDEMPOTENCY_KEY=key)
+
+    def test_retried_checkout_is_replayed(self):
+        first = self.checkout('key-1')
+        _responses.clear()  # once from the database
+        second = self.checkout('key-1')
+        third = self.checkout('key-1')  # and once from memory
+
+        self.assertEqual(first.status_code, 201)
+        self.assertEqual(second.status_code, 201)
+        self.assertEqual(second.data['id'], first.data['id'])
+        self.assertEqual(third.data['id'], first.data['id'])
+        self.assertEqual(second['Idempotent-Replayed'], 'true')
+        self.assertEqual(Order.objects.count(), 1)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, 9)
+
+        self.assertEqual(self.checkout('key-2').status_code, 201)
+        self.assertEqual(Order.objects.count(), 2)
+
+    def test_key_reused_for_another_request_is_rejected(self):
+        self.checkout('key-1')
+        other = {**self.payload, 'items': [{'product': self.product.pk, 'quantity': 2}]}
+
+        self.assertEqual(self.checkout('key-1', other).status_code, 422)
+        self.assertEqual(Order.objects.count(), 1)
+
+    def test_retried_payment_is_replayed(self):
+        order_id = self.checkout('order').data['id']
+        url = f'{ORDERS_URL}{order_id}/create_payment/'
+
+        first = self.client.post(url, {'payment_method': 'paypal'}, format='json', HTTP_IDEMPOTENCY_KEY='pay')
+        second = self.client.post(url, {'payment_method': 'paypal'}, format='json', HTTP_IDEMPOTENCY_KEY='pay')
+
+        self.assertEqual(first.status_code, 202)
+        self.assertEqual(second.data, first.data)
+        self.assertEqual(Payment.objects.count(), 1)
+
+    @override_settings(IDEMPOTENCY_WAIT=0.1, IDEMPOTENCY_LOCK_TIMEOUT=60)
+    def test_in_flight_and_abandoned_claims(self):
+        first = self.checkout('first')
+        record = IdempotencyKey.objects.get(key='first')
+        IdempotencyKey.objects.filter(pk=record.pk).update(
+            key='busy', status='in_progress', response_status=None, response_body=None,
+        )
+
+        self.assertEqual(self.checkout('busy').status_code, 409)
+
+        IdempotencyKey.objects.filter(pk=record.pk).update(locked_at=timezone.now() - timedelta(minutes=5))
+        response = self.checkout('busy')
+        self.assertEqual(response.status_code, 201)
+        self.assertNotEqual(response.data['id'], first.data['id'])
+        self.assertEqual(IdempotencyKey.objects.get(key='busy').status, 'completed')
+
+    def test_expired_keys_are_swept_in_batches(self):
+        now = timezone.now()
+        IdempotencyKey.objects.bulk_create([
+            IdempotencyKey(
+                user=self.user, key=f'k{n}', fingerprint='', locked_at=now,
+                expires_at=now + timedelta(days=-1 if n < 25 else 1),
+            )
+            for n in range(30)
+        ])
+
+        self.assertEqual(sweep_expired_keys(batch_size=10), 25)
+        self.assertEqual(IdempotencyKey.objects.count(), 5)
+
+
+class PaymentWorkerTests(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(
+            username='buyer', email='buyer@example.com', password='secret'
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        category = Category.objects.create(name='Things', slug='things')
+        product = make_product(category, 'A1', stock=10)
+        response = self.client.post(ORDERS_URL, {
+            **SHIPPING, 'items': [{'product': product.pk, 'quantity': 1}],
+        }, format='json')
+        self.order = Order.objects.get(pk=response.data['id'])
+
+    def pay(self):
+        return self.client.post(
+            f'{ORDERS_URL}{self.order.pk}/create_payment/', {'payment_method': 'credit_card'}, format='json'
+        )
+
+    def make_due(self):
+        PaymentJob.objects.update(run_after=timezone.now())
+
+    def test_payment_is_queued_and_charged_by_the_worker(self):
+        response = self.pay()
+
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.data['status'], 'pending')
+        self.assertEqual(PaymentJob.objects.get().status, 'queued')
+
+        self.assertEqual(process_jobs(FakeGateway()), 1)
+
+        payment = Payment.objects.get()
+        self.order.refresh_from_db()
+        self.assertEqual(payment.status, 'paid')
+        self.assertTrue(payment.payment_id.startswith('fake_'))
+        self.assertEqual(self.order.payment_status, 'paid')
+        self.assertIsNotNone(self.order.paid_at)
+        self.assertEqual(PaymentJob.objects.get().status, 'succeeded')
+        self.assertEqual(process_jobs(FakeGateway()), 0)
+        self.assertEqual(self.pay().status_code, 400)
+
+    @override_settings(PAYMENT_MAX_ATTEMPTS=5)
+    def test_transient_errors_are_retried_with_backoff(self):
+        self.pay()
+        gateway = FakeGateway(fail_first=2)
+
+        for attempt in (1, 2):
+            process_jobs(gateway)
+            job = PaymentJob.objects.get()
+            self.assertEqual((job.status, job.attempts), ('queued', attempt))
+            self.assertGreater(job.run_after, timezone.now())
+            # Not due yet
+            self.assertEqual(process_jobs(gateway), 0)
+            self.make_due()
+
+        process_jobs(gateway)
+        self.assertEqual(PaymentJob.objects.get().status, 'succeeded')
+        self.assertEqual(Payment.objects.get().status, 'paid')
+
+    @override_settings(PAYMENT_MAX_ATTEMPTS=2)
+    def test_idempotency_key_is_stable_within_a_job_only(self):
+        gateway = FakeGateway(fail_first=2)
+        keys = []
+        charge = gateway.charge
+
+        def recording(payment, idempotency_key):
+            keys.append(idempotency_key)
+            return charge(payment, idempotency_key)
+
+        gateway.charge = recording
+        self.pay()
+        process_jobs(gateway)
+        self.make_due()
+        process_jobs(gateway)
+        self.assertEqual(Payment.objects.get().status, 'failed')
+        self.pay()
+        process_jobs(gateway)
+        self.assertEqual(Payment.objects.get().status, 'paid')
+
+        first, second = PaymentJob.objects.order_by('pk')
+        self.assertEqual(keys, [f'payment-job-{first.pk}'] * 2 + [f'payment-job-{second.pk}'])
+
+    def test_cancelled_orders_cannot_be_paid(self):
+        Order.objects.filter(pk=self.order.pk).update(status='cancelled')
+        response = self.pay()
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(PaymentJob.objects.exists())
+
+    def test_order_cancelled_before_the_charge_is_not_charged(self):
+        self.pay()
+        Order.objects.filter(pk=self.order.pk).update(status='cancelled')
+        gateway = FakeGateway()
+        process_jobs(gateway)
+
+        self.assertEqual(gateway.calls, 0)
+        self.order.refresh_from_db()
+        self.assertEqual((self.order.status, self.order.payment_status), ('cancelled', 'pending'))
+        self.assertEqual(Payment.objects.get().status, 'failed')
+        self.assertEqual(PaymentJob.objects.get().last_error, 'Order was cancelled.')
+
+    def test_order_cancelled_during_the_charge_is_not_marked_paid(self):
+        self.pay()
+        gateway = FakeGateway()
+        charge = gateway.charge
+
+        def cancelling(payment, idempotency_key):
+            Order.objects.filter(pk=self.order.pk).update(status='cancelled')
+            return charge(payment, idempotency_key)
+
+        gateway.charge = cancelling
+        with mock.patch('apps.orders.payments.record_paid') as record_paid, \
+                self.assertLogs('apps.orders.payments', 'WARNING'):
+            process_jobs(gateway)
+
+        record_paid.assert_not_called()
+        self.order.refresh_from_db()
+        self.assertEqual((self.order.status, self.order.payment_status), ('cancelled', 'pending'))
+        self.assertIsNone(self.order.paid_at)
+        # The charge itself happened, the payment records it for the refund
+        self.assertEqual(Payment.objects.get().status, 'paid')
+
+    @override_settings(PAYMENT_MAX_ATTEMPTS=2)
+    def test_payment_fails_after_max_attempts_and_can_be_retried(self):
+        self.pay()
+        gateway = FakeGateway(fail_first=10)
+        process_jobs(gateway)
+        self.make_due()
+        process_jobs(gateway)
+
+        self.order.refresh_from_db()
+        self.assertEqual(PaymentJob.objects.get().status, 'failed')
+        self.assertEqual(Payment.objects.get().status, 'failed')
+        self.assertEqual(self.order.payment_status, 'failed')
+
+        self.assertEqual(self.pay().status_code, 202)
+        process_jobs(FakeGateway())
+        self.assertEqual(Payment.objects.get().status, 'paid')
+
+    def test_declined_payment_is_not_retried(self):
+        self.pay()
+        process_jobs(FakeGateway(decline=True))
+
+        job = PaymentJob.objects.get()
+        self.assertEqual((job.status, job.attempts, job.last_error), ('failed', 1, 'Card declined.'))
+        self.assertEqual(Payment.objects.get().status, 'failed')
+
+    @override_settings(PAYMENT_JOB_LOCK_TIMEOUT=60)
+    def test_jobs_of_a_crashed_worker_are_picked_up_again(self):
+        self.pay()
+        PaymentJob.objects.update(status='processing', locked_by='dead', locked_at=timezone.now())
+        self.assertEqual(process_jobs(FakeGateway()), 0)
+
+        PaymentJob.objects.update(locked_at=timezone.now() - timedelta(minutes=5))
+        self.assertEqual(process_jobs(FakeGateway()), 1)
+        self.assertEqual(Payment.objects.get().status, 'paid')
+
+
+class ArchiveTests(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(
+            username='buyer', email='buyer@example.com', password='secret'
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        category = Category.objects.create(name='Things', slug='things')
+        self.product = make_product(category, 'A1', stock=100)
+
+    def place_order(self, days_ago=0, status='pending', pay=False):
+        response = self.client.post(ORDERS_URL, {
+            **SHIPPING, 'items': [{'product': self.product.pk, 'quantity': 1}],
+        }, format='json')
+        order_id = response.data['id']
+        if pay:
+            self.client.post(f'{ORDERS_URL}{order_id}/create_payment/', {'payment_method': 'paypal'})
+            process_jobs(FakeGateway())
+        Order.objects.filter(pk=order_id).update(
+            status=status, created_at=timezone.now() - timedelta(days=days_ago)
+        )
+        return order_id
+
+    def test_closed_old_orders_are_moved_in_batches(self):
+        moved = [
+            self.place_order(400, 'delivered', pay=True),
+            self.place_order(500, 'delivered'),
+            self.place_order(600, 'cancelled'),
+        ]
+        kept = [self.place_order(400, 'pending'), self.place_order(10, 'delivered')]
+        unpaid = self.place_order(700)
+        # A payment still waiting for the worker keeps the order hot
+        self.client.post(f'{ORDERS_URL}{unpaid}/create_payment/', {'payment_method': 'paypal'})
+        Order.objects.filter(pk=unpaid).update(status='cancelled')
+        kept.append(unpaid)
+
+        stats = archive_orders(batch_size=2)
+
+        self.assertEqual((stats.orders, stats.items, stats.batches), (3, 3, 2))
+        self.assertGreater(stats.max_lock_time, 0)
+        self.assertCountEqual(Order.objects.values_list('pk', flat=True), kept)
+        self.assertCountEqual(ArchivedOrder.objects.values_list('pk', flat=True), moved)
+        self.assertEqual(ArchivedOrderItem.objects.filter(order__in=moved).count(), 3)
+        self.assertEqual(ArchivedPayment.objects.get().order_id, moved[0])
+        self.assertFalse(OrderItem.objects.filter(order__in=moved).exists())
+        self.assertFalse(Payment.objects.filter(order__in=moved).exists())
+        self.assertFalse(PaymentJob.objects.filter(payment__order__in=moved).exists())
+
+    def test_archiving_resumes_where_it_stopped(self):
+        for _ in range(5):
+            self.place_order(400, 'delivered')
+
+        self.assertEqual(archive_orders(batch_size=2, limit=3).orders, 3)
+        self.assertEqual(archive_orders(batch_size=2).orders, 2)
+        self.assertEqual(archive_orders().orders, 0)
+        self.assertEqual(ArchivedOrder.objects.count(), 5)
+
+    def test_listing_pages_through_hot_and_archived_orders(self):
+        expected = [self.place_order(days) for days in (1, 2, 3)]
+        # An old order that can't be archived yet sorts between archived ones
+        for days, status in ((400, 'delivered'), (410, 'pending'), (420, 'cancelled'), (430, 'delivered')):
+            expected.append(self.place_order(days, status))
+        archive_orders()
+        self.assertEqual(ArchivedOrder.objects.count(), 3)
+
+        # Only hot orders newer than the archive cutoff on this page, so the archive isn't read
+        with self.assertNumQueries(1):
+            response = self.client.get(ORDERS_URL, {'page_size': 2})
+        seen = [order['id'] for order in response.data['results']]
+        pages = [response.data]
+        while response.data['next']:
+            response = self.client.get(response.data['next'])
+            seen += [order['id'] for order in response.data['results']]
+            pages.append(response.data)
+        self.assertEqual(seen, expected)
+
+        # And back again
+        response = self.client.get(pages[-1]['previous'])
+        self.assertEqual(response.data['results'], pages[-2]['results'])
+
+        response = self.client.get(ORDERS_URL, {'status': 'delivered', 'with_count': 'true'})
+        self.assertEqual(response.data['count'], 2)
+        self.assertEqual([order['id'] for order in response.data['results']], [expected[3], expected[6]])
+
+    def test_archived_orders_can_be_viewed_but_not_changed(self):
+        order_id = self.place_order(400, 'delivered', pay=True)
+        archive_orders()
+
+        response = self.client.get(f'{ORDERS_URL}{order_id}/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['status'], 'delivered')
+        self.assertEqual(len(response.data['items']), 1)
+        self.assertEqual(response.data['payment']['status'], 'paid')
+        self.assertEqual(self.client.post(f'{ORDERS_URL}{order_id}/cancel/').status_code, 404)
+
+class ConcurrentCheckoutTests(TransactionTestCase):
+    """Many buyers racing for the same, limited stock."""
+    THREADS = 24
+    CHECKOUTS_PER_THREAD = 5
+    STOCK = 40
+
+    def setUp(self):
+        User = get_user_model()
+        self.users = [
+            User.objects.create_user(username=f'buyer{n}', email=f'buyer{n}@example.com', password='secret')
+            for n in range(self.THREADS)
+        ]
+        category = Category.objects.create(name='Limited', slug='limited')
+        self.product = make_product(category, 'HOT', stock=self.STOCK)
+        self.other = make_product(category, 'COLD', stock=10 ** 6)
+
+    def test_no_oversell_under_concurrency(self):
+        barrier = threading.Barrier(self.THREADS)
+        statuses = []
+        lock = threading.Lock()
+
+        def buy(user):
+            client = APIClient()
+            client.force_authenticate(user)
+            payload = {
+                **SHIPPING,
+                'items': [
+                    {'product': self.product.pk, 'quantity': 1},
+                    {'product': self.other.pk, 'quantity': 1},
+                ],
+            }
+            try:
+                barrier.wait()
+                for _ in range(self.CHECKOUTS_PER_THREAD):
+                    response = client.post(ORDERS_URL, payload, format='json')
+                    with lock:
+                        statuses.append(response.status_code)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=buy, args=(user,)) for user in self.users]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # Every attempt got an answer: an order while stock lasted, then a clean refusal
+        attempts = self.THREADS * self.CHECKOUTS_PER_THREAD
+        self.assertEqual(len(statuses), attempts)
+        self.assertEqual(statuses.count(201), self.STOCK)
+        self.assertEqual(statuses.count(400), attempts - self.STOCK)
+
+        self.product.refresh_from_db()
+        self.other.refresh_from_db()
+        self.assertEqual(self.product.stock, 0)
+        # Failed checkouts must not have kept their reservation of the other line
+        self.assertEqual(self.other.stock, 10 ** 6 - self.STOCK)
+        self.assertEqual(Order.objects.count(), self.STOCK)
+        self.assertEqual(OrderItem.objects.filter(product=self.product).count(), self.STOCK)
@@ -0,0 +1,129 @@
+"""
+Order status transitions.
+
+Orders move pending -> processing -> shipped -> delivered and can be
+cancelled until they ship, see TRANSITIONS. A transition is a
+compare-and-set without row locks: the orders are read, grouped by what was
+read, and each group is changed with `UPDATE ... WHERE status = <expected>`.
+An order someone else changed in the meantime doesn't match and is reported
+as a conflict instead of being overwritten. The matching timestamp
+(`shipped_at`, `delivered_at`) is set by the same UPDATE and every change is
+appended to OrderStatusChange.
+
+Cancelling restores the stock of exactly the orders this call cancelled and
+takes the paid ones out of the sales rollups.
+"""
+from collections import Counter, defaultdict
+
+from django.db import transaction
+from django.db.models import Sum
+from django.utils import timezone
+
+from apps.analytics.rollups import record_cancelled
+from apps.products.inventory import restore_stock
+from .models import Order, OrderItem, OrderStatusChange
+
+TRANSITIONS = {
+    'pending': ('processing', 'cancelled'),
+    'processing': ('shipped', 'cancelled'),
+    'shipped': ('delivered',),
+    'delivered': (),
+    'cancelled': (),
+}
+
+TIMESTAMP_FIELDS = {
+    'shipped': 'shipped_at',
+    'delivered': 'delivered_at',
+}
+
+CHUNK_SIZE = 1000
+
+NOT_FOUND = 'not_found'
+UNCHANGED = 'unchanged'
+NOT_ALLOWED = 'not_allowed'
+CONFLICT = 'conflict'
+
+
+class _Contended(Exception):
+    pass
+
+
+def can_transition(current, target):
+    return target in TRANSITIONS.get(current, ())
+
+
+def _compare_and_set(ids, expected, changes):
+    """Apply `changes` to the orders in `ids` that still match `expected`, returns the ids changed."""
+    try:
+        with transaction.atomic():
+            if Order.objects.filter(pk__in=ids, **expected).update(**changes) != len(ids):
+                raise _Contended
+        return ids
+    except _Contended:
+        # Some changed since they were read, the rowcount can't tell which, so one at a time
+        return [pk for pk in ids if Order.objects.filter(pk=pk, **expected).update(**changes)]
+
+
+def transition_orders(queryset, order_ids, target, user=None):
+    """
+    Move the orders in `order_ids` that `queryset` contains to `target`.
+
+    Returns `(changed, rejected)`: the ids changed by this call and a
+    mapping of the other ids to `not_found`, `unchanged` (already in
+    `target`), `not_allowed` or `conflict` (changed concurrently).
+    """
+    order_ids = list(dict.fromkeys(order_ids))
+    now = timezone.now()
+    changes = {'status': target, 'updated_at': now}
+    if target in TIMESTAMP_FIELDS:
+        changes[TIMESTAMP_FIELDS[target]] = now
+
+    changed = set()
+    paid = []
+    rejected = {}
+    log = []
+    with transaction.atomic():
+        for start in range(0, len(order_ids), CHUNK_SIZE):
+            chunk = order_ids[start:start + CHUNK_SIZE]
+            groups = defaultdict(list)
+            rows = queryset.filter(pk__in=chunk).order_by().values_list('pk', 'status', 'payment_status')
+            for pk, status, payment_status in rows:
+                if status == target:
+                    rejected[pk] = UNCHANGED
+                elif not can_transition(status, target):
+                    rejected[pk] = NOT_ALLOWED
+                else:
+                    groups[(status, payment_status)].append(pk)
+
+            for (status, payment_status), ids in groups.items():
+                # payment_status is compared too, so side effects act on the row as it was changed
+                done = _compare_and_set(ids, {'status': status, 'payment_status': payment_status}, changes)
+                changed.update(done)
+                if payment_status == 'paid':
+                    paid += done
+                log += [
+                    OrderStatusChange(order_id=pk, from_status=status, to_status=target, changed_by=user, changed_at=now)
+                    for pk in done
+                ]
+                rejected.update((pk, CONFLICT) for pk in set(ids).difference(done))
+
+        OrderStatusChange.objects.bulk_create(log, batch_size=CHUNK_SIZE)
+        if target == 'cancelled' and changed:
+            _release(list(changed), paid)
+
+    for pk in order_ids:
+        if pk not in changed and pk not in rejected:
+            rejected[pk] = NOT_FOUND
+    return [pk for pk in order_ids if pk in changed], rejected
+
+
+def _release(cancelled, paid):
+    """Put the stock of cancelled orders back and drop them from the rollups."""
+    quantities = Counter()
+    for start in range(0, len(cancelled), CHUNK_SIZE):
+        quantities.update(dict(
+            OrderItem.objects.filter(order_id__in=cancelled[start:start + CHUNK_SIZE]).order_by()
+            .values('product_id').annotate(quantity=Sum('quantity')).values_list('product_id', 'quantity')
+        ))
+    restore_stock(quantities)
+    record_cancelled(paid)
@@ -1,34 +1,88 @@
-from rest_framework import viewsets, status
+from rest_framework import viewsets, status, serializers
 from rest_framework.decorators import action
 from rest_framework.response import Response
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.generics import get_object_or_404
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
 from django_filters.rest_framework import DjangoFilterBackend
-from django.db.models import Q
-from .models import Order, Payment
+from django.db.models import Q, Prefetch
+from django.http import Http404
+from apps.core.sparse import SparseFieldsMixin
+from apps.products.models import primary_image_prefetch
+from . import transitions
+from .cancellation import NOT_CANCELLABLE, cancel_orders
+from .idempotency import idempotent
+from .models import ArchivedOrder, ArchivedOrderItem, Order, OrderItem, Payment
+from .pagination import OrderPagination
+from .payments import PaymentNotAllowed, enqueue_payment
 from .serializers import (
     OrderSerializer, OrderCreateSerializer, OrderStatusUpdateSerializer,
+    OrderBulkCancelSerializer, OrderBulkTransitionSerializer, OrderSummarySerializer,
     PaymentSerializer, PaymentCreateSerializer
 )
 from .filters import OrderFilter
 
-class OrderViewSet(viewsets.ModelViewSet):
+class OrderViewSet(SparseFieldsMixin, viewsets.ModelViewSet):
     permission_classes = [IsAuthenticated]
     filter_backends = [DjangoFilterBackend]
     filterset_class = OrderFilter
+    pagination_class = OrderPagination
+    # Fulfilment actions, for staff on everyone's orders
+    STAFF_ACTIONS = ('update_status', 'bulk_transition')
     
     def get_queryset(self):
-        return Order.objects.filter(user=self.request.user).prefetch_related('items', 'payment')
+        if self.action in self.STAFF_ACTIONS:
+            return Order.objects.all()
+        return self._with_relations(Order.objects.filter(user=self.request.user), OrderItem)
+    
+    def get_archive_queryset(self):
+        """The user's archived orders, filtered and loaded like get_queryset"""
+        queryset = self._with_relations(ArchivedOrder.objects.filter(user=self.request.user), ArchivedOrderItem)
+        return OrderFilter(self.request.query_params, queryset=queryset, request=self.request).qs
+    
+    def _with_relations(self, queryset, item_model):
+        # Summaries (the list) only need the order row unless items or payment are expanded
+        if self.wants('items'):
+            if self.wants('items.product_details'):
+                items = item_model.objects.select_related('product__category')
+                queryset = queryset.prefetch_related(Prefetch('items', queryset=items))
+                if self.wants('items.product_details.primary_image'):
+                    queryset = queryset.prefetch_related(primary_image_prefetch('items__product__'))
+            else:
+                queryset = queryset.prefetch_related('items')
+        if self.wants('payment'):
+            queryset = queryset.prefetch_related('payment')
+        return self.prune_queryset(queryset)
+    
+    def get_object(self):
+        try:
+            return super().get_object()
+        except Http404:
+            # Old orders can still be looked at, nothing else can be done with them
+            if self.action != 'retrieve':
+                raise
+            order = get_object_or_404(self.get_archive_queryset(), pk=self.kwargs['pk'])
+            self.check_object_permissions(self.request, order)
+            return order
     
     def get_serializer_class(self):
         if self.action == 'create':
             return OrderCreateSerializer
         elif self.action == 'update_status':
             return OrderStatusUpdateSerializer
+        elif self.action == 'bulk_cancel':
+            return OrderBulkCancelSerializer
+        elif self.action == 'bulk_transition':
+            return OrderBulkTransitionSerializer
+        elif self.action == 'list':
+            return OrderSummarySerializer
+        elif self.action == 'create_payment':
+            return PaymentCreateSerializer
         return OrderSerializer
     
     def perform_create(self, serializer):
         serializer.save(user=self.request.user)
     
+    @idempotent
     def create(self, request, *args, **kwargs):
         serializer = self.get_serializer(data=request.data)
         serializer.is_valid(raise_exception=True)
@@ -38,71 +92,83 @@ class OrderViewSet(viewsets.ModelViewSet):
             response_serializer = OrderSerializer(order)
             return Response(response_serializer.data, status=status.HTTP_201_CREATED)
         except serializers.ValidationError as e:
-            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+            return Response({'error': e.detail}, status=status.HTTP_400_BAD_REQUEST)
     
-    @action(detail=True, methods=['post'])
+    @action(detail=True, methods=['post'], permission_classes=[IsAdminUser])
     def update_status(self, request, pk=None):
-        """Update order status (for admin users or specific workflows)"""
+        """Move an order to the next status, see transitions.TRANSITIONS"""
         order = self.get_object()
-        serializer = self.get_serializer(order, data=request.data, partial=True)
+        serializer = self.get_serializer(data=request.data)
         serializer.is_valid(raise_exception=True)
         
-        # Add any status transition logic here
-        serializer.save()
+        target = serializer.validated_data['status']
+        _, rejected = transitions.transition_orders(Order.objects.all(), [order.pk], target, user=request.user)
+        reason = rejected.get(order.pk)
+        if reason == transitions.NOT_ALLOWED:
+            return Response(
+                {'error': f'Cannot change status from {order.status} to {target}.'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if reason == transitions.CONFLICT:
+            return Response(
+                {'error': 'The order was changed by someone else, reload it and try again.'},
+                status=status.HTTP_409_CONFLICT
+            )
+        
+        order.refresh_from_db()
         return Response(OrderSerializer(order).data)
     
+    @action(detail=False, methods=['post'], permission_classes=[IsAdminUser])
+    def bulk_transition(self, request):
+        """Move many orders to a status at once: `{"ids": [...], "status": "shipped"}`"""
+        serializer = OrderBulkTransitionSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        changed, rejected = transitions.transition_orders(
+            Order.objects.all(), serializer.validated_data['ids'], serializer.validated_data['status'],
+            user=request.user,
+        )
+        return Response({'changed': changed, 'rejected': rejected})
+    
     @action(detail=True, methods=['post'])
     def cancel(self, request, pk=None):
-        """Cancel an order"""
+        """Cancel an order, cancelling it again is a no-op"""
         order = self.get_object()
-        
-        if order.status in ['shipped', 'delivered']:
+        _, rejected = cancel_orders(Order.objects.filter(user=request.user), [order.pk], user=request.user)
+        if rejected.get(order.pk) == NOT_CANCELLABLE:
             return Response(
                 {'error': 'Cannot cancel order that has already been shipped or delivered.'},
                 status=status.HTTP_400_BAD_REQUEST
             )
         
-        order.status = 'cancelled'
-        order.save()
-        
-        # Restore product stock
-        for item in order.items.all():
-            item.product.stock += item.quantity
-            item.product.save()
-        
+        order.refresh_from_db(fields=['status', 'updated_at'])
         return Response(OrderSerializer(order).data)
     
+    @action(detail=False, methods=['post'])
+    def bulk_cancel(self, request):
+        """Cancel many orders at once: `{"ids": [...]}`"""
+        serializer = OrderBulkCancelSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        cancelled, rejected = cancel_orders(
+            Order.objects.filter(user=request.user), serializer.validated_data['ids'], user=request.user
+        )
+        return Response({'cancelled': cancelled, 'rejected': rejected})
+    
     @action(detail=True, methods=['post'])
+    @idempotent
     def create_payment(self, request, pk=None):
-        """Create payment for an order"""
+        """Queue a payment for an order, poll the payment (or order) for the outcome"""
         order = self.get_object()
         
-        if order.payment_status == 'paid':
-            return Response(
-                {'error': 'Order has already been paid.'},
-                status=status.HTTP_400_BAD_REQUEST
-            )
-        
         payment_serializer = PaymentCreateSerializer(data=request.data)
         payment_serializer.is_valid(raise_exception=True)
         
-        # In a real application, integrate with payment gateway here
-        payment = Payment.objects.create(
-            order=order,
-            amount=order.total_amount,
-            **payment_serializer.validated_data
-        )
-        
-        # Simulate payment processing
-        payment.status = 'paid'
-        payment.save()
-        
-        # Update order status
-        order.payment_status = 'paid'
-        order.paid_at = timezone.now()
-        order.save()
+        # Charged by the payment worker, see payments.py
+        try:
+            payment = enqueue_payment(order, payment_serializer.validated_data['payment_method'])
+        except PaymentNotAllowed as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
         
-        return Response(PaymentSerializer(payment).data)
+        return Response(PaymentSerializer(payment).data, status=status.HTTP_202_ACCEPTED)
 
 class PaymentViewSet(viewsets.ReadOnlyModelViewSet):
     serializer_class = PaymentSerializer
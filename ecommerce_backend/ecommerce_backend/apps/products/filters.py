@@ -1,21 +1,37 @@
 import django_filters
+from rest_framework import filters
 from .models import Product
-from django.db.models import Q
+from .search import search_products
+from .tree import get_category_path
 
 class ProductFilter(django_filters.FilterSet):
     min_price = django_filters.NumberFilter(field_name="price", lookup_expr='gte')
     max_price = django_filters.NumberFilter(field_name="price", lookup_expr='lte')
     category = django_filters.CharFilter(field_name='category__slug')
+    # Category slug including all of its subcategories
+    category_tree = django_filters.CharFilter(method='filter_category_tree')
     in_stock = django_filters.BooleanFilter(field_name='stock', lookup_expr='gt')
     search = django_filters.CharFilter(method='filter_search')
     
     class Meta:
         model = Product
-        fields = ['category', 'min_price', 'max_price', 'in_stock']
+        fields = ['category', 'category_tree', 'min_price', 'max_price', 'in_stock']
 
     def filter_search(self, queryset, name, value):
-        return queryset.filter(
-            Q(name__icontains=value) | 
-            Q(description__icontains=value) |
-            Q(category__name__icontains=value)
-        )
\ No newline at end of file
+        # Served from the in-memory index, see search.py
+        return search_products(queryset, value)
+
+    def filter_category_tree(self, queryset, name, value):
+        path = get_category_path(value)
+        if path is None:
+            return queryset.none()
+        # Prefix match on the indexed path is a single range scan
+        return queryset.filter(category__path__startswith=path)
+
+class ProductOrderingFilter(filters.OrderingFilter):
+    """Keep search results in relevance order unless `?ordering=` is given."""
+
+    def get_default_ordering(self, view):
+        if view.request.query_params.get('search'):
+            return ('search_rank',)
+        return super().get_default_ordering(view)
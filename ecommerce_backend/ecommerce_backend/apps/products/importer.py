@@ -0,0 +1,316 @@
+"""
+Streaming bulk import of products keyed by SKU.
+
+Rows are read lazily from CSV or NDJSON and validated in batches. Each
+batch is written in its own transaction: products are looked up (and
+locked) by SKU, existing ones updated with one `bulk_update` and new ones
+inserted with one `bulk_create`. A plain insert never touches another row,
+unlike an upsert, which on MySQL fires on any unique key and would
+overwrite the product owning a clashing slug. Only the current batch is
+held in memory, so the size of the file does not matter.
+
+Imports run outside of requests: `ProductViewSet.bulk_import` stores the
+file and queues a ProductImportJob for `manage.py run_import_worker`, and
+`manage.py import_products` imports a local file directly.
+"""
+import csv
+import json
+import logging
+import os
+import socket
+import time
+import uuid
+from datetime import timedelta
+from itertools import islice
+
+from django.conf import settings
+from django.db import IntegrityError, close_old_connections, transaction
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.text import slugify
+from rest_framework import serializers
+
+from .leaderboard import invalidate_featured
+from .models import Category, Product, ProductImportJob
+from .search import record_changes
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 1000
+# Attempts at a batch that raced with another writer over a SKU or slug
+BATCH_ATTEMPTS = 3
+
+# Columns overwritten when the SKU already exists. The slug is kept as it was
+# so existing product URLs do not change.
+UPSERT_FIELDS = [
+    'name', 'description', 'price', 'compare_price', 'category', 'stock', 'is_active', 'updated_at',
+]
+
+
+class ProductImportRowSerializer(serializers.Serializer):
+    """Field-level validation only, anything needing the database is checked per batch."""
+    sku = serializers.CharField(max_length=100)
+    name = serializers.CharField(max_length=200)
+    slug = serializers.SlugField(max_length=200, required=False, allow_blank=True)
+    description = serializers.CharField(max_length=500, required=False, allow_blank=True, default='')
+    price = serializers.DecimalField(max_digits=10, decimal_places=2, min_value=0)
+    compare_price = serializers.DecimalField(
+        max_digits=10, decimal_places=2, min_value=0, required=False, allow_null=True, default=None
+    )
+    category = serializers.SlugField(max_length=200)
+    stock = serializers.IntegerField(min_value=0, required=False, default=0)
+    is_active = serializers.BooleanField(required=False, default=True)
+
+    def to_internal_value(self, data):
+        # CSV has no nulls, treat empty cells as missing
+        data = {key: value for key, value in data.items() if value not in ('', None)}
+        return super().to_internal_value(data)
+
+
+def _text_lines(lines):
+    """Decode an iterable of byte lines (an upload, a request body or a file)."""
+    first = True
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        if first:
+            line = line.lstrip('\ufeff')
+            first = False
+        yield line
+
+
+def read_rows(lines, file_format):
+    """Yield one dict per record of a CSV or NDJSON stream."""
+    lines = _text_lines(lines)
+    if file_format == 'csv':
+        yield from csv.DictReader(lines)
+    elif file_format == 'ndjson':
+        for line in lines:
+            if line.strip():
+                try:
+                    yield json.loads(line)
+                except ValueError as exc:
+                    yield {'__error__': f'Invalid JSON: {exc}'}
+    else:
+        raise ValueError(f'Unsupported import format: {file_format}')
+
+
+class ImportReport:
+    """Counts plus the first `max_errors` row errors, so memory stays bounded."""
+
+    def __init__(self, max_errors=1000, on_error=None):
+        self.created = 0
+        self.updated = 0
+        self.failed = 0
+        self.errors = []
+        self.max_errors = max_errors
+        self.on_error = on_error
+
+    def add_error(self, row_number, errors):
+        self.failed += 1
+        error = {'row': row_number, 'errors': errors}
+        if self.on_error:
+            self.on_error(error)
+        if len(self.errors) < self.max_errors:
+            self.errors.append(error)
+
+    def as_dict(self):
+        return {
+            'created': self.created,
+            'updated': self.updated,
+            'failed': self.failed,
+            'errors': self.errors,
+            'errors_truncated': self.failed > len(self.errors),
+        }
+
+
+def import_products(rows, batch_size=DEFAULT_BATCH_SIZE, report=None, on_batch=None):
+    """
+    Upsert products from an iterable of row dicts and return an ImportReport.
+
+    `on_batch(report)` is called after every batch, e.g. to record progress.
+    """
+    report = report or ImportReport()
+    numbered = enumerate(rows, start=1)
+    while True:
+        batch = list(islice(numbered, batch_size))
+        if not batch:
+            break
+        valid = _validate_batch(batch, report)
+        for attempt in range(1, BATCH_ATTEMPTS + 1):
+            try:
+                _write_batch(valid, report)
+                break
+            except IntegrityError:
+                # Another writer took one of the SKUs or slugs since we read them,
+                # the retry sees its row and reports the clash
+                if attempt == BATCH_ATTEMPTS:
+                    raise
+        if on_batch:
+            on_batch(report)
+    transaction.on_commit(invalidate_featured)
+    return report
+
+
+def _validate_batch(batch, report):
+    """`{sku: (row_number, data)}` of the rows passing field validation."""
+    # One serializer for the whole batch, building its fields per row is the slow part
+    row_serializer = ProductImportRowSerializer()
+    valid = {}
+    for row_number, row in batch:
+        if not isinstance(row, dict):
+            report.add_error(row_number, {'non_field_errors': ['Expected an object.']})
+            continue
+        if '__error__' in row:
+            report.add_error(row_number, {'non_field_errors': [row['__error__']]})
+            continue
+        try:
+            data = row_serializer.run_validation(row)
+        except serializers.ValidationError as exc:
+            report.add_error(row_number, exc.detail)
+            continue
+        if not data.get('slug'):
+            data['slug'] = slugify(f"{data['name']}-{data['sku']}")[:200]
+        # A later row for the same SKU wins
+        valid.pop(data['sku'], None)
+        valid[data['sku']] = (row_number, data)
+    return valid
+
+
+def _write_batch(valid, report):
+    if not valid:
+        return
+    errors = []
+    with transaction.atomic():
+        # One query each for categories, existing SKUs (locked until the batch
+        # commits) and slugs already taken
+        category_slugs = {data['category'] for _, data in valid.values()}
+        categories = Category.objects.in_bulk(category_slugs, field_name='slug')
+        existing = {
+            sku: (pk, slug) for pk, sku, slug in
+            Product.objects.select_for_update().filter(sku__in=list(valid)).values_list('pk', 'sku', 'slug')
+        }
+        candidate_slugs = [data['slug'] for sku, (_, data) in valid.items() if sku not in existing]
+        taken_slugs = set(Product.objects.filter(slug__in=candidate_slugs).values_list('slug', flat=True))
+
+        now = timezone.now()
+        created, updated = [], []
+        for sku, (row_number, data) in valid.items():
+            category = categories.get(data['category'])
+            if category is None:
+                errors.append((row_number, {'category': [f"Category '{data['category']}' does not exist."]}))
+                continue
+            product = Product(
+                sku=sku,
+                name=data['name'],
+                description=data['description'],
+                price=data['price'],
+                compare_price=data['compare_price'],
+                category=category,
+                stock=data['stock'],
+                is_active=data['is_active'],
+                updated_at=now,
+            )
+            if sku in existing:
+                product.pk, product.slug = existing[sku]
+                updated.append(product)
+            elif data['slug'] in taken_slugs:
+                errors.append((row_number, {'slug': [f"Slug '{data['slug']}' is already used by another product."]}))
+            else:
+                taken_slugs.add(data['slug'])
+                product.slug = data['slug']
+                created.append(product)
+
+        if updated:
+            Product.objects.bulk_update(updated, UPSERT_FIELDS)
+        if created:
+            Product.objects.bulk_create(created)
+        # Neither sends signals, queue the batch for the search index here
+        record_changes(product_ids=Product.objects.filter(
+            sku__in=[product.sku for product in updated + created]
+        ).values_list('pk', flat=True))
+
+    # Only once the batch is in, a retried batch must not report its errors twice
+    for row_number, error in errors:
+        report.add_error(row_number, error)
+    report.updated += len(updated)
+    report.created += len(created)
+
+
+def enqueue_import(file, file_format, user=None):
+    """Store an import file and queue it for `manage.py run_import_worker`."""
+    job = ProductImportJob(file_format=file_format, requested_by=user)
+    job.file.save(f'{uuid.uuid4().hex}.{file_format}', file, save=False)
+    job.save()
+    return job
+
+
+def claim_import_job(worker):
+    """Mark the oldest due import job as processing by `worker` and return it, or None."""
+    now = timezone.now()
+    stale = now - timedelta(seconds=settings.PRODUCT_IMPORT_LOCK_TIMEOUT)
+    due = Q(status='queued') | Q(status='processing', locked_at__lt=stale)
+    token = f'{worker}:{uuid.uuid4().hex[:8]}'
+    with transaction.atomic():
+        pk = ProductImportJob.objects.select_for_update(skip_locked=True).filter(due).order_by(
+            'created_at'
+        ).values_list('pk', flat=True).first()
+        if pk is None:
+            return None
+        # Conditional, so it is safe even where SKIP LOCKED isn't available
+        claimed = ProductImportJob.objects.filter(due, pk=pk).update(
+            status='processing', locked_by=token, locked_at=now, updated_at=now,
+        )
+    if not claimed:
+        return None
+    return ProductImportJob.objects.get(pk=pk)
+
+
+def run_import_job(job, batch_size=DEFAULT_BATCH_SIZE):
+    """Import a claimed job's file, recording progress after every batch."""
+    owned = ProductImportJob.objects.filter(pk=job.pk, locked_by=job.locked_by, status='processing')
+
+    def progress(report):
+        # Also keeps the lock fresh, so the job isn't taken over while it runs
+        now = timezone.now()
+        owned.update(created=report.created, updated=report.updated, failed=report.failed, locked_at=now, updated_at=now)
+
+    report = ImportReport()
+    try:
+        with job.file.open('rb') as fh:
+            import_products(read_rows(fh, job.file_format), batch_size=batch_size, report=report, on_batch=progress)
+    except Exception as exc:
+        logger.exception('Product import job %s failed', job.pk)
+        status, error = 'failed', str(exc)
+    else:
+        status, error = 'succeeded', ''
+    result = report.as_dict()
+    now = timezone.now()
+    finished = owned.update(
+        status=status, last_error=error, created=result['created'], updated=result['updated'],
+        failed=result['failed'], errors=result['errors'], errors_truncated=result['errors_truncated'],
+        finished_at=now, updated_at=now,
+    )
+    if finished:
+        job.file.delete(save=False)
+        ProductImportJob.objects.filter(pk=job.pk).update(file='')
+    return report
+
+
+def process_import_job(batch_size=DEFAULT_BATCH_SIZE, worker=None):
+    """Claim and run the next due import job, returns it or None."""
+    job = claim_import_job(worker or f'{socket.gethostname()}:{os.getpid()}')
+    if job is not None:
+        run_import_job(job, batch_size)
+    return job
+
+
+def run_import_worker(batch_size=DEFAULT_BATCH_SIZE, poll_interval=5.0, once=False):
+    worker = f'{socket.gethostname()}:{os.getpid()}'
+    while True:
+        close_old_connections()
+        if process_import_job(batch_size, worker) is not None:
+            continue
+        if once:
+            return
+        time.sleep(poll_interval)
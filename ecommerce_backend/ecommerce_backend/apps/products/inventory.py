@@ -0,0 +1,101 @@
+"""
+Set-based stock changes.
+
+Stock is only ever changed with `UPDATE ... SET stock = stock + CASE ... END`
+statements that carry the `stock >= 0` guard themselves (and the table has a
+CHECK constraint as a last line of defence), never with a read-modify-write
+`save()` that can lose concurrent updates.
+"""
+from django.db import connection, transaction
+from django.db.models import F, IntegerField
+from django.db.models.expressions import RawSQL
+from django.utils import timezone
+
+from .leaderboard import invalidate_featured
+from .models import Product
+
+# Keeps IN lists and CASE expressions at a sane size
+CHUNK_SIZE = 1000
+
+UNKNOWN_SKU = 'unknown_sku'
+INSUFFICIENT_STOCK = 'insufficient_stock'
+
+
+def _chunks(items, size=CHUNK_SIZE):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def stock_case(values, column='id'):
+    """`CASE <column> WHEN key THEN value ... END` for the integers in `values`.
+
+    Built as raw SQL because resolving thousands of ORM When() nodes costs far
+    more than running the statement. `column` is unqualified, so only use it
+    in single-table UPDATEs on products.
+    """
+    sql = 'CASE {} {} END'.format(
+        connection.ops.quote_name(column),
+        ' '.join(['WHEN %s THEN %s'] * len(values)),
+    )
+    params = [param for item in values.items() for param in item]
+    return RawSQL(sql, params, output_field=IntegerField())
+
+
+def adjust_stock(adjustments, mode='delta'):
+    """
+    Apply `{sku: quantity}` to product stock in one transaction.
+
+    In `delta` mode quantities are added (negative to remove), in `absolute`
+    mode they replace the stock. Returns `(updated, rejected)` where
+    `rejected` maps SKUs to `unknown_sku` or `insufficient_stock`. Rejected
+    SKUs are skipped, the rest are still applied.
+    """
+    skus = list(adjustments)
+    rejected = {}
+    updated = 0
+    now = timezone.now()
+
+    with transaction.atomic():
+        for chunk in _chunks(skus):
+            # Lock the rows so the rejects we report are exactly the ones the guard skips
+            current = dict(
+                Product.objects.select_for_update().filter(sku__in=chunk).values_list('sku', 'stock')
+            )
+            accepted = {}
+            for sku in chunk:
+                if sku not in current:
+                    rejected[sku] = UNKNOWN_SKU
+                elif mode == 'delta' and current[sku] + adjustments[sku] < 0:
+                    rejected[sku] = INSUFFICIENT_STOCK
+                else:
+                    accepted[sku] = adjustments[sku]
+            if not accepted:
+                continue
+
+            queryset = Product.objects.filter(sku__in=list(accepted))
+            if mode == 'delta':
+                change = stock_case(accepted, column='sku')
+                updated += queryset.filter(stock__gte=-change).update(stock=F('stock') + change, updated_at=now)
+            else:
+                updated += queryset.update(stock=stock_case(accepted, column='sku'), updated_at=now)
+
+    if updated:
+        transaction.on_commit(invalidate_featured)
+    return updated, rejected
+
+
+def restore_stock(quantities):
+    """Put `{product_id: quantity}` back into stock, one UPDATE per chunk.
+
+    Run it inside the caller's transaction. Featured leaderboards are
+    invalidated once that transaction commits.
+    """
+    product_ids = list(quantities)
+    now = timezone.now()
+    restored = 0
+    for chunk in _chunks(product_ids):
+        change = stock_case({product_id: quantities[product_id] for product_id in chunk})
+        restored += Product.objects.filter(pk__in=chunk).update(stock=F('stock') + change, updated_at=now)
+    if restored:
+        transaction.on_commit(invalidate_featured)
+    return restored
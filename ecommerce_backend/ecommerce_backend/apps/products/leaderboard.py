@@ -0,0 +1,138 @@
+"""
+Precomputed featured-products leaderboards.
+
+The serialized top products (overall, or for a category subtree) are kept in
+the cache and served stale-while-revalidate: an entry older than
+`FEATURED_REFRESH_INTERVAL`, or one invalidated by a review or product change,
+is still returned while a background thread recomputes it. Nothing is ever
+computed on the request path: a cold cache serves the last leaderboard this
+process has seen, or an empty one, until the background refresh lands.
+`manage.py refresh_featured` warms them at deploy and refreshes them on a
+schedule.
+"""
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import close_old_connections, connection
+
+from .tree import get_category_path
+
+FEATURED_SIZE = 10
+MIN_RATING = 4.0
+
+ENTRY_KEY = 'leaderboard:featured:{scope}'
+LOCK_KEY = 'leaderboard:featured:{scope}:refreshing'
+GENERATION_KEY = 'leaderboard:featured:generation'
+STATS_KEY = 'leaderboard:stats:{name}'
+STATS = ('hits', 'stale_hits', 'misses', 'refreshes')
+
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='leaderboard')
+# Results last served by this process, by scope, for when the cache entry is gone
+_last_known = {}
+
+
+def _scope(category_slug):
+    return f'category:{category_slug}' if category_slug else 'all'
+
+
+def _generation():
+    generation = cache.get(GENERATION_KEY)
+    if generation is None:
+        cache.add(GENERATION_KEY, uuid.uuid4().hex, timeout=None)
+        generation = cache.get(GENERATION_KEY)
+    return generation
+
+
+def _count(name):
+    key = STATS_KEY.format(name=name)
+    try:
+        cache.incr(key)
+    except ValueError:
+        if not cache.add(key, 1, timeout=None):
+            cache.incr(key)
+
+
+def compute_featured(category_slug=None):
+    """Serialize the top rated, in-stock products. Runs the actual queries."""
+    from .models import Product, primary_image_prefetch
+    from .serializers import ProductListSerializer
+
+    queryset = Product.objects.filter(
+        is_active=True,
+        stock__gt=0,
+        avg_rating__gte=MIN_RATING,
+        rating_count__gte=1,
+    )
+    if category_slug:
+        path = get_category_path(category_slug)
+        if path is None:
+            return []
+        queryset = queryset.filter(category__path__startswith=path)
+    queryset = queryset.select_related('category').prefetch_related(
+        primary_image_prefetch()
+    ).order_by('-avg_rating', '-rating_count')[:FEATURED_SIZE]
+    return ProductListSerializer(queryset, many=True).data
+
+
+def refresh_featured(category_slug=None):
+    generation = _generation()
+    results = compute_featured(category_slug)
+    cache.set(
+        ENTRY_KEY.format(scope=_scope(category_slug)),
+        {'results': list(results), 'computed_at': time.time(), 'generation': generation},
+        timeout=None,
+    )
+    _count('refreshes')
+    return results
+
+
+def _refresh_in_background(category_slug):
+    try:
+        close_old_connections()
+        refresh_featured(category_slug)
+    finally:
+        cache.delete(LOCK_KEY.format(scope=_scope(category_slug)))
+        connection.close()
+
+
+def schedule_refresh(category_slug=None):
+    """Recompute a leaderboard off the request path, once at a time."""
+    if not getattr(settings, 'LEADERBOARD_BACKGROUND_REFRESH', True):
+        refresh_featured(category_slug)
+        return
+    if cache.add(LOCK_KEY.format(scope=_scope(category_slug)), 1, timeout=60):
+        _executor.submit(_refresh_in_background, category_slug)
+
+
+def get_featured(category_slug=None):
+    """Serialized featured products, possibly slightly stale."""
+    if category_slug and get_category_path(category_slug) is None:
+        return []
+    scope = _scope(category_slug)
+    entry = cache.get(ENTRY_KEY.format(scope=scope))
+    if entry is None:
+        _count('misses')
+        schedule_refresh(category_slug)
+        return _last_known.get(scope, [])
+
+    age = time.time() - entry['computed_at']
+    if entry['generation'] != _generation() or age > settings.FEATURED_REFRESH_INTERVAL:
+        _count('stale_hits')
+        schedule_refresh(category_slug)
+    else:
+        _count('hits')
+    _last_known[scope] = entry['results']
+    return entry['results']
+
+
+def invalidate_featured():
+    """Mark every leaderboard stale, they refresh on their next read."""
+    cache.set(GENERATION_KEY, uuid.uuid4().hex, timeout=None)
+
+
+def get_stats():
+    values = cache.get_many([STATS_KEY.format(name=name) for name in STATS])
+    return {name: values.get(STATS_KEY.format(name=name), 0) for name in STATS}
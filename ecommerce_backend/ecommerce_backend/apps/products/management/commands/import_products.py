@@ -0,0 +1,33 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from apps.products.importer import DEFAULT_BATCH_SIZE, ImportReport, import_products, read_rows
+
+
+class Command(BaseCommand):
+    help = 'Stream a CSV or NDJSON file of products and upsert them by SKU'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='File to import')
+        parser.add_argument('--format', choices=['csv', 'ndjson'], help='Defaults to the file extension')
+        parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        path = options['path']
+        file_format = options['format'] or ('ndjson' if path.lower().endswith(('.ndjson', '.jsonl')) else 'csv')
+
+        # Errors are written as they happen instead of being collected
+        report = ImportReport(
+            max_errors=0,
+            on_error=lambda error: self.stderr.write(json.dumps(error, default=str)),
+        )
+        try:
+            with open(path, 'rb') as fh:
+                import_products(read_rows(fh, file_format), batch_size=options['batch_size'], report=report)
+        except OSError as exc:
+            raise CommandError(str(exc))
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Created {report.created}, updated {report.updated}, failed {report.failed}'
+        ))
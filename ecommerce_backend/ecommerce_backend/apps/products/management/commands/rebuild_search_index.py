@@ -0,0 +1,31 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from apps.products.search import write_snapshot
+
+
+class Command(BaseCommand):
+    help = 'Write the product search index snapshot to SEARCH_INDEX_PATH (the only writer of that file)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--full', action='store_true', help='Rebuild from the database instead of catching up')
+        parser.add_argument(
+            '--interval', type=int, default=0,
+            help='Keep running and write a snapshot every N seconds instead of once',
+        )
+
+    def handle(self, *args, **options):
+        full = options['full']
+        while True:
+            index = write_snapshot(full=full)
+            path = getattr(settings, 'SEARCH_INDEX_PATH', None)
+            self.stdout.write(self.style.SUCCESS(
+                f'Indexed {len(index)} products ({len(index.postings)} terms)'
+                + (f' into {path}' if path else '')
+            ))
+            if not options['interval']:
+                break
+            full = False
+            time.sleep(options['interval'])
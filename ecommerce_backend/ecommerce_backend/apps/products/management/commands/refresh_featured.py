@@ -0,0 +1,30 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from apps.products.leaderboard import refresh_featured
+from apps.products.models import Category
+
+
+class Command(BaseCommand):
+    help = 'Recompute the cached featured-products leaderboards (overall and per category)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--no-categories', action='store_true', help='Only refresh the overall leaderboard')
+        parser.add_argument(
+            '--interval', type=int, default=0,
+            help='Keep running and refresh every N seconds instead of once',
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            refresh_featured()
+            refreshed = 1
+            if not options['no_categories']:
+                for slug in Category.objects.filter(is_active=True).values_list('slug', flat=True).iterator():
+                    refresh_featured(slug)
+                    refreshed += 1
+            self.stdout.write(self.style.SUCCESS(f'Refreshed {refreshed} leaderboards'))
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from apps.products.importer import DEFAULT_BATCH_SIZE, run_import_worker
+
+
+class Command(BaseCommand):
+    help = 'Process queued product import jobs (uploaded through the bulk_import endpoint)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE, help='Rows written per transaction')
+        parser.add_argument('--poll-interval', type=float, default=5.0, help='Seconds to wait when the queue is empty')
+        parser.add_argument('--once', action='store_true', help='Exit once no jobs are queued instead of polling')
+
+    def handle(self, *args, **options):
+        self.stdout.write(f'Import worker started (batch size {options["batch_size"]})')
+        run_import_worker(
+            batch_size=options['batch_size'],
+            poll_interval=options['poll_interval'],
+            once=options['once'],
+        )
@@ -1,4 +1,9 @@
-from django.db import models
+from decimal import Decimal
+
+from django.core.exceptions import ValidationError
+from django.db import models, transaction
+from django.db.models import Case, Count, F, Prefetch, Sum, Value, When
+from django.db.models.functions import Cast, Concat, Round, Substr
 from apps.users.models import User
 from django.core.validators import MinValueValidator, MaxValueValidator
 
@@ -9,6 +14,9 @@ class Category(models.Model):
     slug = models.SlugField(unique=True, max_length=200)
     description = models.TextField(max_length=450, blank=True)
     parent = models.ForeignKey('self', on_delete=models.CASCADE, null=True, blank=True, related_name='children')
+    # Materialized path of ancestor ids, e.g. "/1/4/9/". A subtree is every
+    # row whose path starts with the root's path.
+    path = models.CharField(max_length=255, editable=False, default='')
     is_active = models.BooleanField(default=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
@@ -20,11 +28,56 @@ class Category(models.Model):
             models.Index(fields=['slug']),
             models.Index(fields=['is_active']),
             models.Index(fields=['parent']),
+            models.Index(fields=['path']),
         ]
 
     def __str__(self):
         return self.name
 
+    def clean(self):
+        super().clean()
+        if self.is_ancestor_of(self.parent):
+            raise ValidationError({'parent': 'A category cannot be moved under itself or one of its subcategories.'})
+
+    def is_ancestor_of(self, category):
+        if category is None or self.pk is None:
+            return False
+        return category.pk == self.pk or f'/{self.pk}/' in category.path
+
+    def build_path(self):
+        parent_path = self.parent.path if self.parent_id else '/'
+        return f'{parent_path}{self.pk}/'
+
+    def save(self, *args, **kwargs):
+        if self.is_ancestor_of(self.parent):
+            raise ValidationError('A category cannot be moved under itself or one of its subcategories.')
+
+        with transaction.atomic():
+            if self.pk is None:
+                # The path ends with our own id, so it is only known after the insert
+                super().save(*args, **kwargs)
+                self.path = self.build_path()
+                Category.objects.filter(pk=self.pk).update(path=self.path)
+                return
+
+            old_path = self.path
+            self.path = self.build_path()
+            update_fields = kwargs.get('update_fields')
+            if update_fields is not None and 'parent' in update_fields:
+                kwargs['update_fields'] = {*update_fields, 'path'}
+            super().save(*args, **kwargs)
+            if old_path and old_path != self.path:
+                # Moved: rewrite the prefix of every descendant in one statement
+                Category.objects.filter(path__startswith=old_path).exclude(pk=self.pk).update(
+                    path=Concat(Value(self.path), Substr('path', len(old_path) + 1))
+                )
+
+    def get_descendants(self, include_self=True):
+        queryset = Category.objects.filter(path__startswith=self.path)
+        if not include_self:
+            queryset = queryset.exclude(pk=self.pk)
+        return queryset
+
 class Product(models.Model):
     name = models.CharField(max_length=200)
     slug = models.SlugField(unique=True, max_length=200)
@@ -35,6 +88,10 @@ class Product(models.Model):
     sku = models.CharField(max_length=100, unique=True)
     stock = models.IntegerField(default=0, validators=[MinValueValidator(0)])
     is_active = models.BooleanField(default=True)
+    # Aggregates of approved reviews, kept up to date by signals.py
+    rating_sum = models.PositiveIntegerField(default=0, editable=False)
+    rating_count = models.PositiveIntegerField(default=0, editable=False)
+    avg_rating = models.DecimalField(max_digits=3, decimal_places=2, default=0, editable=False)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
@@ -47,12 +104,28 @@ class Product(models.Model):
             models.Index(fields=['is_active']),
             models.Index(fields=['stock']),
             models.Index(fields=['created_at']),
+            models.Index(fields=['avg_rating', 'rating_count']),
             # models.Index(fields=['name']), 
         ]
+        constraints = [
+            models.CheckConstraint(condition=models.Q(stock__gte=0), name='products_stock_non_negative'),
+        ]
 
     def __str__(self):
         return self.name
 
+    RATING_FIELDS = ('rating_sum', 'rating_count', 'avg_rating')
+
+    def save(self, *args, **kwargs):
+        # Never write back rating aggregates loaded with the instance, they are
+        # only changed through apply_rating_change()/refresh_rating()
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in self.RATING_FIELDS
+            ]
+        super().save(*args, **kwargs)
+
     @property
     def in_stock(self):
         return self.stock > 0
@@ -63,6 +136,47 @@ class Product(models.Model):
             return int(((self.compare_price - self.price) / self.compare_price) * 100)
         return 0
 
+    @classmethod
+    def apply_rating_change(cls, product_id, sum_delta, count_delta):
+        """Atomically shift the rating aggregates of a product by the given deltas."""
+        new_sum = F('rating_sum') + sum_delta
+        new_count = F('rating_count') + count_delta
+        cls.objects.filter(pk=product_id).update(
+            # MySQL applies SET assignments left to right, so the average has to
+            # come first to see the old sum and count the deltas are added to
+            avg_rating=Case(
+                When(rating_count__gt=-count_delta, then=Round(Cast(new_sum, models.FloatField()) / new_count, 2)),
+                default=Value(Decimal('0')),
+                output_field=models.DecimalField(max_digits=3, decimal_places=2),
+            ),
+            rating_sum=new_sum,
+            rating_count=new_count,
+        )
+
+    def refresh_rating(self):
+        """Recompute the rating aggregates from the approved reviews."""
+        totals = self.reviews.filter(is_approved=True).aggregate(total=Sum('rating'), count=Count('id'))
+        self.rating_sum = totals['total'] or 0
+        self.rating_count = totals['count']
+        self.avg_rating = round(Decimal(self.rating_sum) / self.rating_count, 2) if self.rating_count else Decimal('0')
+        Product.objects.filter(pk=self.pk).update(
+            rating_sum=self.rating_sum, rating_count=self.rating_count, avg_rating=self.avg_rating
+        )
+
+class SearchIndexChange(models.Model):
+    """
+    A product, or every product of a category, whose search document changed.
+
+    Written in the same transaction as the change itself, so the search
+    workers only ever pick up committed changes, see search.py.
+    """
+    product_id = models.BigIntegerField(null=True, blank=True)
+    category_id = models.BigIntegerField(null=True, blank=True)
+    changed_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        db_table = 'search_index_changes'
+
 class ProductImage(models.Model):
     product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='images')
     image = models.ImageField(upload_to='products/')
@@ -77,6 +191,18 @@ class ProductImage(models.Model):
             models.Index(fields=['is_primary']),
         ]
 
+def primary_image_prefetch(prefix=''):
+    """Prefetch only the primary image of each product into `primary_images`.
+
+    `prefix` lets the same prefetch be reused through relations,
+    e.g. `primary_image_prefetch('items__product__')` on orders.
+    """
+    return Prefetch(
+        f'{prefix}images',
+        queryset=ProductImage.objects.filter(is_primary=True),
+        to_attr='primary_images',
+    )
+
 class ProductReview(models.Model):
     product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='reviews')
     user = models.ForeignKey(User, on_delete=models.CASCADE)
@@ -97,3 +223,55 @@ class ProductReview(models.Model):
             models.Index(fields=['is_approved']),
             models.Index(fields=['created_at']),
         ]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember what the stored row contributes so a save/delete can apply the difference
+        if {'product_id', 'rating', 'is_approved'}.issubset(field_names):
+            instance._rating_snapshot = instance.rating_contribution()
+        return instance
+
+    def rating_contribution(self):
+        """(product_id, rating) this review adds to the product aggregates, if any."""
+        if not self.is_approved:
+            return None
+        return (self.product_id, self.rating)
+
+
+class ProductImportJob(models.Model):
+    """A stored import file queued for `manage.py run_import_worker`, see importer.py."""
+    STATUS_CHOICES = [
+        ('queued', 'Queued'),
+        ('processing', 'Processing'),
+        ('succeeded', 'Succeeded'),
+        ('failed', 'Failed'),
+    ]
+    FORMAT_CHOICES = [('csv', 'CSV'), ('ndjson', 'NDJSON')]
+
+    file = models.FileField(upload_to='imports/', blank=True)
+    file_format = models.CharField(max_length=10, choices=FORMAT_CHOICES)
+    requested_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='queued')
+    created = models.PositiveIntegerField(default=0)
+    updated = models.PositiveIntegerField(default=0)
+    failed = models.PositiveIntegerField(default=0)
+    # The first row errors, as in ImportReport
+    errors = models.JSONField(default=list, blank=True)
+    errors_truncated = models.BooleanField(default=False)
+    locked_by = models.CharField(max_length=64, blank=True)
+    locked_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        db_table = 'product_import_jobs'
+        indexes = [
+            # Workers claim queued jobs oldest first
+            models.Index(fields=['status', 'created_at']),
+        ]
+
+    def __str__(self):
+        return f"Import job {self.pk} ({self.status})"
@@ -0,0 +1,380 @@
+"""
+In-process full-text search over the product catalog.
+
+Products are tokenized into an inverted index (term -> {product id: weighted
+term frequency}) covering name, sku, category name and description, and
+queries are ranked with BM25. The last word of a query also matches as a
+prefix so "head" finds "headphones" while the user is still typing.
+
+The index lives in memory in every worker and is only ever read there.
+Product and category writes add a SearchIndexChange row in their own
+transaction (see `signals.py`), and every worker catches up from those rows
+at most SEARCH_SYNC_INTERVAL seconds after they commit, or on its next
+search once a change from its own process committed. Changes that were
+rolled back never reach the index.
+
+A snapshot of the index (gzipped JSON) at SEARCH_INDEX_PATH saves new
+workers building it from the database. Only `manage.py rebuild_search_index`
+writes it, as the one writer; run it at deploy and, with `--interval`, on a
+schedule, which also prunes the change rows the snapshot covers.
+"""
+import gzip
+import json
+import math
+import os
+import re
+import tempfile
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, IntegerField, Q, Value, When
+from django.utils import timezone
+
+# Matches are weighted by the field they were found in
+FIELD_WEIGHTS = {
+    'name': 3.0,
+    'sku': 3.0,
+    'category': 2.0,
+    'description': 1.0,
+}
+
+# Prefix expansions count for less than exact term matches
+PREFIX_WEIGHT = 0.5
+MIN_PREFIX_LENGTH = 2
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+STOP_WORDS = frozenset([
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'for', 'from', 'in',
+    'is', 'it', 'of', 'on', 'or', 'the', 'to', 'with',
+])
+
+TOKEN_RE = re.compile(r'[a-z0-9]+')
+
+SNAPSHOT_FORMAT = 1
+# Changes are re-read this far back, for slow commits and clock skew between app servers
+SYNC_OVERLAP = timedelta(seconds=30)
+# Change rows are kept this long after a snapshot covering them was written
+CHANGE_RETENTION = timedelta(hours=1)
+
+
+def tokenize(text):
+    """Lowercase `text` and split it into indexable terms."""
+    if not text:
+        return []
+    return [token for token in TOKEN_RE.findall(text.lower()) if token not in STOP_WORDS]
+
+
+def product_document(product, category_name=None):
+    """Build the field -> text mapping that gets indexed for a product."""
+    if category_name is None:
+        category_name = product.category.name
+    return {
+        'name': product.name,
+        'sku': product.sku,
+        'category': category_name,
+        'description': product.description,
+    }
+
+
+class SearchIndex:
+    """Inverted index with BM25 ranking and prefix matching."""
+
+    def __init__(self):
+        self.postings = {}      # term -> {doc_id: weighted tf}
+        self.doc_terms = {}     # doc_id -> {term: weighted tf}, needed for removals
+        self.doc_lengths = {}   # doc_id -> weighted document length
+        self.total_length = 0.0
+        self._sorted_terms = None
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.doc_lengths)
+
+    def add(self, doc_id, fields):
+        """Index (or re-index) a document given as a field -> text mapping."""
+        terms = Counter()
+        for field, text in fields.items():
+            weight = FIELD_WEIGHTS.get(field, 1.0)
+            for token in tokenize(text):
+                terms[token] += weight
+
+        with self._lock:
+            self._add_terms(doc_id, terms)
+
+    def remove(self, doc_id):
+        with self._lock:
+            self._remove(doc_id)
+
+    def _remove(self, doc_id):
+        terms = self.doc_terms.pop(doc_id, None)
+        if terms is None:
+            return
+        for term in terms:
+            docs = self.postings.get(term)
+            if docs is None:
+                continue
+            docs.pop(doc_id, None)
+            if not docs:
+                del self.postings[term]
+                self._sorted_terms = None
+        self.total_length -= self.doc_lengths.pop(doc_id)
+
+    def _terms_with_prefix(self, prefix):
+        if self._sorted_terms is None:
+            self._sorted_terms = sorted(self.postings)
+        terms = self._sorted_terms
+        position = bisect_left(terms, prefix)
+        while position < len(terms) and terms[position].startswith(prefix):
+            yield terms[position]
+            position += 1
+
+    def search(self, query, limit=None):
+        """Return product ids matching `query`, best match first."""
+        tokens = tokenize(query)
+        if not tokens:
+            return []
+
+        with self._lock:
+            doc_count = len(self.doc_lengths)
+            if not doc_count:
+                return []
+            avg_length = self.total_length / doc_count
+
+            # Every token is an exact term, the last one is also a prefix
+            query_terms = Counter({token: 1.0 for token in tokens})
+            last = tokens[-1]
+            if len(last) >= MIN_PREFIX_LENGTH:
+                for term in self._terms_with_prefix(last):
+                    query_terms[term] = max(query_terms[term], PREFIX_WEIGHT)
+
+            scores = Counter()
+            for term, query_weight in query_terms.items():
+                docs = self.postings.get(term)
+                if not docs:
+                    continue
+                idf = math.log(1 + (doc_count - len(docs) + 0.5) / (len(docs) + 0.5))
+                for doc_id, tf in docs.items():
+                    norm = BM25_K1 * (1 - BM25_B + BM25_B * self.doc_lengths[doc_id] / avg_length)
+                    scores[doc_id] += query_weight * idf * tf * (BM25_K1 + 1) / (tf + norm)
+
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+        if limit is not None:
+            ranked = ranked[:limit]
+        return [doc_id for doc_id, _ in ranked]
+
+    def _add_terms(self, doc_id, terms):
+        # Caller holds the lock
+        self._remove(doc_id)
+        for term, tf in terms.items():
+            if term not in self.postings:
+                self.postings[term] = {}
+                self._sorted_terms = None
+            self.postings[term][doc_id] = tf
+        length = sum(terms.values())
+        self.doc_terms[doc_id] = dict(terms)
+        self.doc_lengths[doc_id] = length
+        self.total_length += length
+
+    def save(self, path, synced_until):
+        """
+        Atomically write the index to `path` as gzipped JSON.
+
+        `synced_until` is when the data it was built from was read, readers
+        catch up on the changes made since.
+        """
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        with self._lock:
+            snapshot = {
+                'format': SNAPSHOT_FORMAT,
+                'synced_until': synced_until.isoformat(),
+                'documents': self.doc_terms,
+            }
+            fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+            try:
+                with gzip.open(os.fdopen(fd, 'wb'), 'wt', encoding='utf-8') as fh:
+                    json.dump(snapshot, fh, separators=(',', ':'))
+                os.replace(tmp_path, path)
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+
+    @classmethod
+    def load(cls, path):
+        """The index saved at `path` and its `synced_until`, data only, nothing in it is executed."""
+        with gzip.open(path, 'rt', encoding='utf-8') as fh:
+            snapshot = json.load(fh)
+        if snapshot.get('format') != SNAPSHOT_FORMAT:
+            raise ValueError(f'Unsupported search index format in {path}')
+        index = cls()
+        for doc_id, terms in snapshot['documents'].items():
+            index._add_terms(int(doc_id), terms)
+        return index, datetime.fromisoformat(snapshot['synced_until'])
+
+    @classmethod
+    def build(cls):
+        """Build a fresh index from every product in the database."""
+        from .models import Product
+
+        index = cls()
+        for product in _documents(Product.objects.all()).iterator(chunk_size=2000):
+            index.add(product.pk, product_document(product))
+        return index
+
+
+def _documents(queryset):
+    return queryset.select_related('category').only('id', 'name', 'sku', 'description', 'category__name')
+
+
+class IndexState:
+    """This process's index and how far it has caught up with the change log."""
+
+    def __init__(self):
+        self.index = None
+        self.mtime = None
+        self.synced_until = None
+        self.synced_at = 0.0
+        self.pending = False
+        self.lock = threading.Lock()
+
+    def get(self):
+        """The index, reloaded when a newer snapshot was written and caught up when due."""
+        path = _index_path()
+        mtime = _mtime(path) if path else None
+        due = self.pending or time.monotonic() - self.synced_at > settings.SEARCH_SYNC_INTERVAL
+        if self.index is not None and mtime == self.mtime and not due:
+            return self.index
+
+        with self.lock:
+            mtime = _mtime(path) if path else None
+            if self.index is None or (mtime is not None and mtime != self.mtime):
+                self._load(path, mtime)
+            if self.pending or time.monotonic() - self.synced_at > settings.SEARCH_SYNC_INTERVAL:
+                self._catch_up()
+            return self.index
+
+    def _load(self, path, mtime):
+        if mtime is not None:
+            try:
+                self.index, self.synced_until = SearchIndex.load(path)
+                self.mtime = mtime
+                return
+            except (OSError, ValueError, KeyError, TypeError):
+                # Unreadable or from another version, build our own until it is rewritten
+                pass
+        self.synced_until = timezone.now()
+        self.index = SearchIndex.build()
+        self.mtime = mtime
+        self.synced_at = time.monotonic()
+
+    def _catch_up(self):
+        """Re-index the products changed since the last sync, from the database."""
+        from .models import Product, SearchIndexChange
+
+        self.pending = False
+        started = timezone.now()
+        changes = SearchIndexChange.objects.filter(changed_at__gte=self.synced_until - SYNC_OVERLAP)
+        product_ids, category_ids = set(), set()
+        for product_id, category_id in changes.values_list('product_id', 'category_id').iterator():
+            if product_id is not None:
+                product_ids.add(product_id)
+            if category_id is not None:
+                category_ids.add(category_id)
+        if product_ids or category_ids:
+            products = _documents(Product.objects.filter(Q(pk__in=product_ids) | Q(category_id__in=category_ids)))
+            found = set()
+            for product in products.iterator(chunk_size=2000):
+                self.index.add(product.pk, product_document(product))
+                found.add(product.pk)
+            for product_id in product_ids - found:
+                self.index.remove(product_id)
+        self.synced_until = started
+        self.synced_at = time.monotonic()
+
+
+_state = IndexState()
+
+
+def _index_path():
+    return getattr(settings, 'SEARCH_INDEX_PATH', None)
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+def get_index():
+    """This worker's index, see IndexState.get()."""
+    return _state.get()
+
+
+def _mark_pending():
+    _state.pending = True
+
+
+def record_changes(product_ids=(), category_ids=()):
+    """
+    Queue products (or all products of categories) for re-indexing.
+
+    Call it inside the transaction making the change: the workers see it once
+    that commits, this one on its next search.
+    """
+    from .models import SearchIndexChange
+
+    SearchIndexChange.objects.bulk_create(
+        [SearchIndexChange(product_id=product_id) for product_id in product_ids]
+        + [SearchIndexChange(category_id=category_id) for category_id in category_ids]
+    )
+    transaction.on_commit(_mark_pending)
+
+
+def write_snapshot(full=False):
+    """
+    Write this process's index to SEARCH_INDEX_PATH and prune the change rows it covers.
+
+    Caught up from the change log, or rebuilt from scratch with `full`. Meant
+    for the one writer, `manage.py rebuild_search_index`.
+    """
+    from .models import SearchIndexChange
+
+    path = _index_path()
+    with _state.lock:
+        if full:
+            _state._load(None, None)
+        elif _state.index is None:
+            _state._load(path, _mtime(path) if path else None)
+        _state._catch_up()
+        index, synced_until = _state.index, _state.synced_until
+        if path:
+            index.save(path, synced_until)
+            _state.mtime = _mtime(path)
+    if path:
+        SearchIndexChange.objects.filter(changed_at__lt=synced_until - CHANGE_RETENTION).delete()
+    return index
+
+
+def search_products(queryset, query):
+    """Filter `queryset` down to products matching `query`.
+
+    Matches are annotated with `search_rank` (0 is the best match) so
+    callers can keep the relevance order.
+    """
+    ids = get_index().search(query, limit=getattr(settings, 'SEARCH_MAX_RESULTS', 1000))
+    if not ids:
+        return queryset.none().annotate(search_rank=Value(0, output_field=IntegerField()))
+    ranking = Case(
+        *[When(pk=product_id, then=Value(position)) for position, product_id in enumerate(ids)],
+        output_field=IntegerField(),
+    )
+    return queryset.filter(pk__in=ids).annotate(search_rank=ranking)
@@ -1,17 +1,24 @@
 from rest_framework import serializers
-from .models import Category, Product, ProductImage, ProductReview
+from apps.core.sparse import SparseFieldsSerializerMixin
+from .models import Category, Product, ProductImage, ProductImportJob, ProductReview
 
-class CategorySerializer(serializers.ModelSerializer):
+class CategorySerializer(SparseFieldsSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = Category
         fields = '__all__'
+        read_only_fields = ('path',)
 
-class ProductImageSerializer(serializers.ModelSerializer):
+    def validate_parent(self, value):
+        if self.instance and self.instance.is_ancestor_of(value):
+            raise serializers.ValidationError("A category cannot be moved under itself or one of its subcategories.")
+        return value
+
+class ProductImageSerializer(SparseFieldsSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = ProductImage
         fields = ('id', 'image', 'alt_text', 'is_primary')
 
-class ProductReviewSerializer(serializers.ModelSerializer):
+class ProductReviewSerializer(SparseFieldsSerializerMixin, serializers.ModelSerializer):
     user_name = serializers.CharField(source='user.get_full_name', read_only=True)
     
     class Meta:
@@ -19,7 +26,7 @@ class ProductReviewSerializer(serializers.ModelSerializer):
         fields = ('id', 'user', 'user_name', 'rating', 'title', 'comment', 'created_at')
         read_only_fields = ('user',)
 
-class ProductListSerializer(serializers.ModelSerializer):
+class ProductListSerializer(SparseFieldsSerializerMixin, serializers.ModelSerializer):
     category_name = serializers.CharField(source='category.name', read_only=True)
     primary_image = serializers.SerializerMethodField()
     discount_percentage = serializers.ReadOnlyField()
@@ -28,9 +35,20 @@ class ProductListSerializer(serializers.ModelSerializer):
         model = Product
         fields = ('id', 'name', 'slug', 'price', 'compare_price', 'discount_percentage', 
                  'category', 'category_name', 'sku', 'stock', 'in_stock', 'primary_image')
+        # Columns read by fields that aren't plain model fields (see apps.core.sparse)
+        field_sources = {
+            'discount_percentage': ('price', 'compare_price'),
+            'in_stock': ('stock',),
+            'primary_image': (),
+        }
 
     def get_primary_image(self, obj):
-        primary_image = obj.images.filter(is_primary=True).first()
+        # Use `primary_image_prefetch()` when the queryset has it, otherwise
+        # fall back to the (possibly prefetched) `images` relation.
+        primary_images = getattr(obj, 'primary_images', None)
+        if primary_images is None:
+            primary_images = [image for image in obj.images.all() if image.is_primary]
+        primary_image = primary_images[0] if primary_images else None
         if primary_image:
             return ProductImageSerializer(primary_image).data
         return None
@@ -46,12 +64,45 @@ class ProductDetailSerializer(ProductListSerializer):
             'description', 'images', 'reviews', 'average_rating', 'review_count', 
             'created_at', 'updated_at'
         )
+        field_sources = {
+            **ProductListSerializer.Meta.field_sources,
+            'average_rating': ('avg_rating',),
+            'review_count': ('rating_count',),
+        }
 
     def get_average_rating(self, obj):
-        approved_reviews = obj.reviews.filter(is_approved=True)
-        if approved_reviews:
-            return round(sum(review.rating for review in approved_reviews) / approved_reviews.count(), 1)
-        return 0
+        return round(float(obj.avg_rating), 1)
 
     def get_review_count(self, obj):
-        return obj.reviews.filter(is_approved=True).count()
\ No newline at end of file
+        return obj.rating_count
+
+
+class StockAdjustmentSerializer(serializers.Serializer):
+    MODE_CHOICES = [('delta', 'Delta'), ('absolute', 'Absolute')]
+    MAX_ADJUSTMENTS = 50000
+
+    mode = serializers.ChoiceField(choices=MODE_CHOICES, default='delta')
+    adjustments = serializers.DictField(child=serializers.IntegerField(), allow_empty=False)
+
+    def validate(self, attrs):
+        adjustments = attrs['adjustments']
+        if len(adjustments) > self.MAX_ADJUSTMENTS:
+            raise serializers.ValidationError(
+                {"adjustments": f"At most {self.MAX_ADJUSTMENTS} SKUs can be adjusted per request."}
+            )
+        if attrs['mode'] == 'absolute':
+            negative = [sku for sku, value in adjustments.items() if value < 0]
+            if negative:
+                raise serializers.ValidationError(
+                    {"adjustments": f"Absolute stock cannot be negative: {', '.join(negative[:20])}"}
+                )
+        return attrs
+
+class ProductImportJobSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = ProductImportJob
+        fields = [
+            'id', 'status', 'file_format', 'created', 'updated', 'failed', 'errors', 'errors_truncated',
+            'last_error', 'created_at', 'updated_at', 'finished_at',
+        ]
+        read_only_fields = fields
@@ -0,0 +1,88 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .models import Category, Product, ProductImage, ProductReview
+from .search import record_changes
+from .leaderboard import invalidate_featured
+from .tree import invalidate_category_tree
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+@receiver(post_save, sender=ProductReview)
+@receiver(post_delete, sender=ProductReview)
+def featured_inputs_changed(sender, **kwargs):
+    # Stock, price or rating changes can reorder the featured leaderboards,
+    # refreshed from the committed rows only
+    transaction.on_commit(invalidate_featured)
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def reindex_product(sender, instance, raw=False, **kwargs):
+    # Logged with the write itself, the search workers re-index it once committed
+    if raw:
+        return
+    record_changes(product_ids=[instance.pk])
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def category_changed(sender, **kwargs):
+    # Save runs in its own atomic block, workers reloading before the commit
+    # would cache the old rows under the new version
+    transaction.on_commit(invalidate_category_tree)
+    transaction.on_commit(invalidate_featured)
+
+
+@receiver(post_save, sender=Category)
+def reindex_category_products(sender, instance, created=False, raw=False, **kwargs):
+    # Products carry the category name in the index, refresh them on rename
+    if raw or created:
+        return
+    record_changes(category_ids=[instance.pk])
+
+
+def _apply_review_change(old, new):
+    """Move a review's contribution from `old` to `new` ((product_id, rating) or None)."""
+    if old == new:
+        return
+    if old is not None:
+        Product.apply_rating_change(old[0], -old[1], -1)
+    if new is not None:
+        Product.apply_rating_change(new[0], new[1], 1)
+
+
+@receiver(post_save, sender=ProductImage)
+@receiver(post_delete, sender=ProductImage)
+@receiver(post_save, sender=ProductReview)
+@receiver(post_delete, sender=ProductReview)
+def touch_product(sender, instance, raw=False, **kwargs):
+    # Images and reviews are part of the product representation, bump its
+    # updated_at so ETag/Last-Modified validators change with them
+    if raw:
+        return
+    Product.objects.filter(pk=instance.product_id).update(updated_at=timezone.now())
+
+
+@receiver(post_save, sender=ProductReview)
+def review_saved(sender, instance, created=False, raw=False, **kwargs):
+    if raw:
+        return
+    new = instance.rating_contribution()
+    if created:
+        _apply_review_change(None, new)
+    elif hasattr(instance, '_rating_snapshot'):
+        _apply_review_change(instance._rating_snapshot, new)
+    else:
+        # Loaded with deferred fields, the previous values are unknown
+        instance.product.refresh_rating()
+    instance._rating_snapshot = new
+
+
+@receiver(post_delete, sender=ProductReview)
+def review_deleted(sender, instance, **kwargs):
+    old = getattr(instance, '_rating_snapshot', instance.rating_contribution())
+    _apply_review_change(old, None)
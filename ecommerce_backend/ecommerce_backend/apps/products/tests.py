@@ -1,3 +1,696 @@
-from django.test import TestCase
+import gzip
+import json
+import os
+import tempfile
+from base64 import urlsafe_b64encode
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import IntegrityError, connection, transaction
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from . import leaderboard, search, tree
+from .importer import claim_import_job, import_products, process_import_job
+from .inventory import INSUFFICIENT_STOCK, UNKNOWN_SKU, adjust_stock, restore_stock
+from .models import Category, Product, ProductImage, ProductImportJob, ProductReview, SearchIndexChange
+from .search import IndexState, SearchIndex
+
+PRODUCTS_URL = '/api/products/products/'
+
+
+def make_category(name, parent=None):
+    return Category.objects.create(name=name, slug=name.lower().replace(' ', '-'), parent=parent)
+
+
+def make_product(category, sku, name=None, stock=10, price='10.00', **fields):
+    return Product.objects.create(
+        name=name or f'Product {sku}', slug=f'product-{sku}'.lower(), sku=sku,
+        price=Decimal(price), category=category, stock=stock, **fields,
+    )
+
+
+class ProductTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.category = make_category('Audio')
+
+
+class PrimaryImageTests(ProductTestCase):
+    def add_products(self, count, start=0):
+        for n in range(start, start + count):
+            product = make_product(self.category, f'SKU{n}')
+            ProductImage.objects.create(product=product, image=f'products/{n}-side.jpg')
+            ProductImage.objects.create(product=product, image=f'products/{n}.jpg', is_primary=True)
+
+    def list_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(PRODUCTS_URL)
+        count = len(queries)
+        self.assertEqual(response.status_code, 200)
+        return response, count
+
+    def test_list_uses_the_primary_image(self):
+        self.add_products(1)
+        make_product(self.category, 'NOIMAGE')
+        response, _ = self.list_queries()
+        images = {row['sku']: row['primary_image'] for row in response.data['results']}
+        self.assertTrue(images['SKU0']['image'].endswith('products/0.jpg'))
+        self.assertTrue(images['SKU0']['is_primary'])
+        self.assertIsNone(images['NOIMAGE'])
+
+    def test_list_query_count_does_not_grow_with_the_page(self):
+        self.add_products(2)
+        _, few = self.list_queries()
+        self.add_products(10, start=2)
+        response, many = self.list_queries()
+        self.assertEqual(len(response.data['results']), 12)
+        self.assertEqual(few, many)
+
+    def test_detail_picks_primary_from_all_images(self):
+        self.add_products(1)
+        response = self.client.get(f'{PRODUCTS_URL}product-sku0/')
+        self.assertEqual(len(response.data['images']), 2)
+        self.assertTrue(response.data['primary_image']['image'].endswith('products/0.jpg'))
+
+
+class SearchTests(ProductTestCase):
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.object(search, '_state', IndexState())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def search(self, query):
+        response = self.client.get(PRODUCTS_URL, {'search': query})
+        self.assertEqual(response.status_code, 200)
+        return [row['sku'] for row in response.data['results']]
+
+    def test_bm25_ranking(self):
+        index = SearchIndex()
+        index.add(1, {'name': 'Wireless headphones', 'description': ''})
+        index.add(2, {'name': 'Phone case', 'description': 'Fits wireless headphones and more'})
+        index.add(3, {'name': 'Desk lamp', 'description': 'A lamp for the desk'})
+        # A name match outweighs a description match
+        self.assertEqual(index.search('headphones'), [1, 2])
+        # The last word matches as a prefix, stop words are ignored
+        self.assertEqual(index.search('the wireless head'), [1, 2])
+        self.assertEqual(index.search('the'), [])
+        index.remove(1)
+        self.assertEqual(index.search('headphones'), [2])
+
+    def test_search_in_relevance_order(self):
+        make_product(self.category, 'A1', name='Speaker stand', description='Holds a bluetooth speaker')
+        make_product(self.category, 'A2', name='Bluetooth speaker')
+        make_product(self.category, 'A3', name='Cable')
+        self.assertEqual(self.search('bluetooth speaker'), ['A2', 'A1'])
+
+    def test_changes_are_indexed_once_committed(self):
+        self.assertEqual(self.search('turntable'), [])
+        with self.captureOnCommitCallbacks(execute=True):
+            product = make_product(self.category, 'T1', name='Turntable')
+        self.assertEqual(self.search('turntable'), ['T1'])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            product.name = 'Record player'
+            product.save()
+        self.assertEqual(self.search('turntable'), [])
+        self.assertEqual(self.search('record'), ['T1'])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            product.delete()
+        self.assertEqual(search.get_index().search('record'), [])
+
+    def test_rolled_back_changes_are_not_indexed(self):
+        self.search('anything')
+        with self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                make_product(self.category, 'R1', name='Rollback radio')
+                raise RuntimeError
+        search._state.pending = True
+        self.assertEqual(search.get_index().search('radio'), [])
+        self.assertFalse(SearchIndexChange.objects.exists())
+
+    def test_category_rename_reindexes_its_products(self):
+        make_product(self.category, 'C1', name='Amplifier')
+        self.search('amplifier')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.category.name = 'Hifi'
+            self.category.save()
+        self.assertEqual(self.search('hifi'), ['C1'])
+        self.assertEqual(SearchIndexChange.objects.filter(category_id=self.category.pk).count(), 1)
+
+    def test_other_processes_changes_are_picked_up_on_sync(self):
+        self.search('anything')
+        # Written by another worker: the row and its change log entry, no local callback
+        Product.objects.bulk_create([Product(
+            name='Subwoofer', slug='subwoofer', sku='S1', price=Decimal('99.00'), category=self.category,
+        )])
+        SearchIndexChange.objects.create(product_id=Product.objects.get(sku='S1').pk)
+        self.assertEqual(self.search('subwoofer'), [])
+        search._state.synced_at -= 60
+        self.assertEqual(self.search('subwoofer'), ['S1'])
+
+    def test_snapshot_is_plain_data_and_the_single_writer_prunes(self):
+        make_product(self.category, 'P1', name='Microphone')
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'index.json.gz')
+            with override_settings(SEARCH_INDEX_PATH=path):
+                SearchIndexChange.objects.update(changed_at=timezone.now() - timedelta(days=1))
+                call_command('rebuild_search_index', '--full', stdout=StringIO())
+                with gzip.open(path, 'rt') as fh:
+                    snapshot = json.load(fh)
+                self.assertEqual(list(snapshot['documents']), [str(Product.objects.get(sku='P1').pk)])
+                self.assertFalse(SearchIndexChange.objects.exists())
+
+                # A new worker loads the snapshot instead of building the index
+                search._state = IndexState()
+                with mock.patch.object(SearchIndex, 'build') as build:
+                    self.assertEqual(self.search('micro'), ['P1'])
+                build.assert_not_called()
+
+                # Searching never writes it
+                mtime = os.stat(path).st_mtime
+                with self.captureOnCommitCallbacks(execute=True):
+                    make_product(self.category, 'P2', name='Microphone stand')
+                self.assertEqual(self.search('microphone'), ['P1', 'P2'])
+                self.assertEqual(os.stat(path).st_mtime, mtime)
+
+
+class PaginationTests(ProductTestCase):
+    def setUp(self):
+        super().setUp()
+        for n in range(5):
+            make_product(self.category, f'P{n}', price=f'{10 + n % 2}.00')
+
+    def get(self, url, **params):
+        response = self.client.get(url, params)
+        self.assertEqual(response.status_code, 200)
+        return [row['sku'] for row in response.data['results']], response.data
+
+    def test_pages_forward_and_back(self):
+        # Ties on price are broken by id
+        first, data = self.get(PRODUCTS_URL, ordering='price', page_size=2)
+        self.assertEqual(first, ['P0', 'P2'])
+        self.assertIsNone(data['previous'])
+        second, data = self.get(data['next'])
+        self.assertEqual(second, ['P4', 'P1'])
+        third, data = self.get(data['next'])
+        self.assertEqual(third, ['P3'])
+        self.assertIsNone(data['next'])
+        back, data = self.get(data['previous'])
+        self.assertEqual(back, ['P4', 'P1'])
+        back, data = self.get(data['previous'])
+        self.assertEqual(back, ['P0', 'P2'])
+        self.assertIsNone(data['previous'])
+
+    def test_count_only_on_request(self):
+        _, data = self.get(PRODUCTS_URL)
+        self.assertNotIn('count', data)
+        _, data = self.get(PRODUCTS_URL, with_count='true')
+        self.assertEqual(data['count'], 5)
+
+    def test_invalid_cursors_are_not_found(self):
+        def cursor(value):
+            return urlsafe_b64encode(json.dumps(value).encode()).decode()
+
+        for bad in (
+            'not-base64!', cursor([1, 2]), cursor({'v': [1]}),
+            cursor({'v': ['notadate', 1]}),
+            cursor({'v': [{'a': 1}, 1]}),
+            cursor({'v': ['2020-01-01T00:00:00', 'x']}),
+            cursor({'v': [None, 1]}),
+        ):
+            with self.subTest(cursor=bad):
+                response = self.client.get(PRODUCTS_URL, {'cursor': bad})
+                self.assertEqual(response.status_code, 404)
+
+    def test_naive_datetime_in_cursor_is_served(self):
+        product = Product.objects.get(sku='P3')
+        created = timezone.localtime(product.created_at).replace(tzinfo=None).isoformat()
+        cursor = urlsafe_b64encode(json.dumps({'v': [created, product.pk]}).encode()).decode()
+        skus, _ = self.get(PRODUCTS_URL, ordering='-created_at', page_size=2, cursor=cursor)
+        self.assertEqual(skus, ['P2', 'P1'])
+
+
+class CategoryTreeTests(ProductTestCase):
+    TREE_URL = '/api/products/categories/tree/'
+
+    def names(self, nodes):
+        return [(node['name'], self.names(node['children'])) for node in nodes]
+
+    def get_tree(self):
+        response = self.client.get(self.TREE_URL)
+        self.assertEqual(response.status_code, 200)
+        return self.names(response.data)
+
+    def test_tree_nests_active_categories(self):
+        headphones = make_category('Headphones', parent=self.category)
+        in_ear = make_category('In ear', parent=headphones)
+        hidden = make_category('Hidden', parent=self.category)
+        hidden.is_active = False
+        hidden.save()
+        make_category('Under hidden', parent=hidden)
+        make_category('Video')
+        self.assertEqual(self.get_tree(), [
+            ('Audio', [('Headphones', [('In ear', [])])]),
+            ('Video', []),
+        ])
+        self.assertEqual(tree.get_category_path('in-ear'), f'/{self.category.pk}/{headphones.pk}/{in_ear.pk}/')
+
+    def test_tree_is_served_from_memory(self):
+        self.get_tree()
+        with self.assertNumQueries(0):
+            self.get_tree()
+
+    def test_tree_is_rebuilt_once_the_change_commits(self):
+        self.assertEqual(self.get_tree(), [('Audio', [])])
+        with self.captureOnCommitCallbacks(execute=True):
+            make_category('Video')
+            # Still uncommitted, the cached tree stays valid
+            self.assertEqual(tree.get_category_tree(), [
+                {'id': self.category.pk, 'name': 'Audio', 'slug': 'audio', 'children': []},
+            ])
+        self.assertEqual(self.get_tree(), [('Audio', []), ('Video', [])])
+
+    def test_other_workers_notice_a_new_version(self):
+        self.get_tree()
+        Category.objects.filter(pk=self.category.pk).update(name='Sound')
+        self.assertEqual(self.get_tree(), [('Audio', [])])
+        cache.delete(tree.VERSION_KEY)
+        self.assertEqual(self.get_tree(), [('Sound', [])])
+
+
+class RatingTests(ProductTestCase):
+    def setUp(self):
+        super().setUp()
+        self.product = make_product(self.category, 'R1')
+        self.users = [
+            get_user_model().objects.create_user(username=f'reviewer{n}', email=f'reviewer{n}@example.com')
+            for n in range(3)
+        ]
+
+    def review(self, user, rating, is_approved=True):
+        return ProductReview.objects.create(
+            product=self.product, user=user, rating=rating, title='Review', is_approved=is_approved,
+        )
+
+    def assertRating(self, total, count, average):
+        self.product.refresh_from_db()
+        self.assertEqual(
+            (self.product.rating_sum, self.product.rating_count, self.product.avg_rating),
+            (total, count, Decimal(average)),
+        )
+
+    def test_approved_reviews_update_the_aggregates(self):
+        self.review(self.users[0], 5)
+        self.review(self.users[1], 4)
+        pending = self.review(self.users[2], 1, is_approved=False)
+        self.assertRating(9, 2, '4.50')
+
+        pending.is_approved = True
+        pending.save()
+        self.assertRating(10, 3, '3.33')
+
+        pending.rating = 3
+        pending.save()
+        self.assertRating(12, 3, '4.00')
+
+        pending.delete()
+        self.assertRating(9, 2, '4.50')
+
+        ProductReview.objects.get(user=self.users[0]).delete()
+        ProductReview.objects.get(user=self.users[1]).delete()
+        self.assertRating(0, 0, '0')
+
+    def test_changes_are_applied_with_f_expressions(self):
+        first = self.review(self.users[0], 5)
+        # A stale instance saved elsewhere doesn't overwrite the aggregates
+        stale = Product.objects.get(pk=self.product.pk)
+        self.review(self.users[1], 3)
+        stale.name = 'Renamed'
+        stale.save()
+        self.assertRating(8, 2, '4.00')
+
+        with CaptureQueriesContext(connection) as queries:
+            first.rating = 4
+            first.save()
+        # The old rating is taken out and the new one added in the database, nothing is read first
+        self.assertFalse(any(q['sql'].startswith('SELECT') for q in queries))
+        self.assertTrue(any('"rating_sum" = ("products"."rating_sum"' in q['sql'] for q in queries))
+        self.assertRating(7, 2, '3.50')
+
+    def test_average_is_assigned_before_the_totals(self):
+        with CaptureQueriesContext(connection) as queries:
+            Product.apply_rating_change(self.product.pk, 5, 1)
+        sql = queries[0]['sql']
+        # Assigned after the totals, MySQL would average the already updated values
+        self.assertLess(sql.index('"avg_rating" ='), sql.index('"rating_sum" ='))
+        self.assertLess(sql.index('"avg_rating" ='), sql.index('"rating_count" ='))
+
+    def test_adding_then_deleting_reviews(self):
+        self.review(self.users[0], 5)
+        second = self.review(self.users[1], 3)
+        self.assertRating(8, 2, '4.00')
+        second.delete()
+        self.assertRating(5, 1, '5.00')
+
+    def test_editing_a_rating_keeps_the_count(self):
+        self.review(self.users[0], 2)
+        edited = self.review(self.users[1], 5)
+        edited.rating = 4
+        edited.save()
+        self.assertRating(6, 2, '3.00')
+        Product.apply_rating_change(self.product.pk, 2, 0)
+        self.assertRating(8, 2, '4.00')
+
+    def test_deleting_the_last_review_resets_the_average(self):
+        only = self.review(self.users[0], 4)
+        self.assertRating(4, 1, '4.00')
+        only.delete()
+        self.assertRating(0, 0, '0')
+
+    def test_deferred_review_falls_back_to_a_recount(self):
+        self.review(self.users[0], 2)
+        review = ProductReview.objects.only('id', 'product').get()
+        review.rating = 4
+        review.save()
+        self.assertRating(4, 1, '4.00')
+
+    def test_refresh_rating_repairs_drift(self):
+        self.review(self.users[0], 5)
+        self.review(self.users[1], 2)
+        Product.objects.filter(pk=self.product.pk).update(rating_sum=100, rating_count=1, avg_rating=5)
+        self.product.refresh_rating()
+        self.assertRating(7, 2, '3.50')
+
+
+@override_settings(LEADERBOARD_BACKGROUND_REFRESH=True, FEATURED_REFRESH_INTERVAL=300)
+class LeaderboardTests(ProductTestCase):
+    FEATURED_URL = f'{PRODUCTS_URL}featured/'
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.dict(leaderboard._last_known, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        submit = mock.patch.object(leaderboard._executor, 'submit')
+        self.submit = submit.start()
+        self.addCleanup(submit.stop)
+        self.product = make_product(self.category, 'F1')
+        Product.objects.filter(pk=self.product.pk).update(avg_rating=Decimal('4.50'), rating_count=2)
+
+    def featured(self):
+        response = self.client.get(self.FEATURED_URL)
+        self.assertEqual(response.status_code, 200)
+        return [row['sku'] for row in response.data['results']]
+
+    def run_scheduled(self):
+        # What the background thread would have done
+        for call in self.submit.call_args_list:
+            leaderboard.refresh_featured(*call.args[1:])
+        self.submit.reset_mock()
+
+    def test_cold_cache_is_never_computed_on_the_request(self):
+        with mock.patch.object(leaderboard, 'compute_featured') as compute:
+            self.assertEqual(self.featured(), [])
+        compute.assert_not_called()
+        self.assertEqual(self.submit.call_count, 1)
+        # Another request while the refresh runs doesn't schedule a second one
+        self.featured()
+        self.assertEqual(self.submit.call_count, 1)
+        self.run_scheduled()
+        cache.delete(leaderboard.LOCK_KEY.format(scope='all'))
+        self.assertEqual(self.featured(), ['F1'])
+        self.submit.assert_not_called()
+        self.assertEqual(leaderboard.get_stats()['misses'], 2)
+
+    def test_stale_entries_are_served_while_refreshing(self):
+        leaderboard.refresh_featured()
+        with self.captureOnCommitCallbacks(execute=True):
+            make_product(self.category, 'F2')
+        Product.objects.filter(sku='F2').update(avg_rating=Decimal('5.00'), rating_count=1)
+        self.assertEqual(self.featured(), ['F1'])
+        self.assertEqual(self.submit.call_count, 1)
+        self.run_scheduled()
+        cache.delete(leaderboard.LOCK_KEY.format(scope='all'))
+        self.assertEqual(self.featured(), ['F2', 'F1'])
+
+    def test_old_entries_are_refreshed(self):
+        leaderboard.refresh_featured()
+        entry_key = leaderboard.ENTRY_KEY.format(scope='all')
+        entry = cache.get(entry_key)
+        cache.set(entry_key, {**entry, 'computed_at': entry['computed_at'] - 301}, timeout=None)
+        self.assertEqual(self.featured(), ['F1'])
+        self.assertEqual(self.submit.call_count, 1)
+
+    def test_evicted_entry_serves_the_last_known_results(self):
+        leaderboard.refresh_featured()
+        self.assertEqual(self.featured(), ['F1'])
+        cache.delete(leaderboard.ENTRY_KEY.format(scope='all'))
+        self.assertEqual(self.featured(), ['F1'])
+        self.assertEqual(self.submit.call_count, 1)
+
+    def test_invalidation_waits_for_the_commit(self):
+        leaderboard.refresh_featured()
+        generation = cache.get(leaderboard.GENERATION_KEY)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.stock = 0
+            self.product.save()
+            self.assertEqual(cache.get(leaderboard.GENERATION_KEY), generation)
+        self.assertNotEqual(cache.get(leaderboard.GENERATION_KEY), generation)
+
+    def test_refresh_command_warms_every_scope(self):
+        call_command('refresh_featured', stdout=StringIO())
+        self.assertEqual(self.featured(), ['F1'])
+        response = self.client.get(self.FEATURED_URL, {'category': 'audio'})
+        self.assertEqual([row['sku'] for row in response.data['results']], ['F1'])
+        self.submit.assert_not_called()
+
+
+class ConditionalGetTests(ProductTestCase):
+    def setUp(self):
+        super().setUp()
+        self.first = make_product(self.category, 'C1')
+        self.second = make_product(self.category, 'C2')
+
+    def get(self, url, etag=None, **params):
+        headers = {'HTTP_IF_NONE_MATCH': etag} if etag else {}
+        return self.client.get(url, params, **headers)
+
+    def test_unchanged_list_is_not_modified(self):
+        response = self.get(PRODUCTS_URL)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        with CaptureQueriesContext(connection) as queries:
+            response = self.get(PRODUCTS_URL, etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        # Nothing runs over the whole filtered queryset
+        self.assertFalse(any('COUNT(' in q['sql'] or 'MAX(' in q['sql'] for q in queries))
+
+    def test_list_validators_follow_the_page(self):
+        etag = self.get(PRODUCTS_URL, page_size=1)['ETag']
+        # C2 is the newest, the only product on the page
+        Product.objects.filter(pk=self.first.pk).update(updated_at=timezone.now() + timedelta(minutes=1))
+        self.assertEqual(self.get(PRODUCTS_URL, etag, page_size=1).status_code, 304)
+        Product.objects.filter(pk=self.second.pk).update(updated_at=timezone.now() + timedelta(minutes=1))
+        self.assertEqual(self.get(PRODUCTS_URL, etag, page_size=1).status_code, 200)
+
+    def test_new_rows_and_related_changes_modify_the_list(self):
+        etag = self.get(PRODUCTS_URL)['ETag']
+        self.first.delete()
+        response = self.get(PRODUCTS_URL, etag)
+        self.assertEqual(response.status_code, 200)
+
+        etag = response['ETag']
+        self.category.name = 'Sound'
+        self.category.save()
+        response = self.get(PRODUCTS_URL, etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['results'][0]['category_name'], 'Sound')
+
+    def test_detail_is_not_modified_until_saved(self):
+        url = f'{PRODUCTS_URL}product-c1/'
+        response = self.get(url)
+        etag = response['ETag']
+        self.assertIn('Last-Modified', response)
+        self.assertEqual(self.get(url, etag).status_code, 304)
+        self.first.price = Decimal('12.00')
+        self.first.save()
+        self.assertEqual(self.get(url, etag).status_code, 200)
+
+
+class ImportTests(ProductTestCase):
+    def row(self, sku, **fields):
+        return {'sku': sku, 'name': f'Product {sku}', 'price': '10.00', 'category': 'audio', **fields}
+
+    def test_upserts_by_sku(self):
+        existing = make_product(self.category, 'U1', stock=1)
+        report = import_products([
+            self.row('U1', name='Renamed', slug='ignored', stock='5'),
+            self.row('U2', slug='new-product'),
+            self.row('U2', slug='new-product', price='12.50'),
+        ])
+        self.assertEqual((report.created, report.updated, report.failed), (1, 1, 0))
+        existing.refresh_from_db()
+        # The slug of an existing product never changes
+        self.assertEqual((existing.name, existing.slug, existing.stock), ('Renamed', 'product-u1', 5))
+        # A later row for the same SKU wins
+        self.assertEqual(Product.objects.get(sku='U2').price, Decimal('12.50'))
+
+    def test_slug_clash_never_touches_the_other_product(self):
+        other = make_product(self.category, 'OTHER', name='Other', price='99.00')
+        report = import_products([self.row('NEW', slug=other.slug, price='1.00')])
+        self.assertEqual((report.created, report.failed), (0, 1))
+        self.assertEqual(report.errors[0]['errors'], {'slug': [f"Slug '{other.slug}' is already used by another product."]})
+        other.refresh_from_db()
+        self.assertEqual((other.sku, other.name, other.price), ('OTHER', 'Other', Decimal('99.00')))
+        self.assertFalse(Product.objects.filter(sku='NEW').exists())
+
+    def test_invalid_rows_are_reported(self):
+        report = import_products([
+            self.row('B1', category='missing'),
+            self.row('B2', price='free'),
+            'not an object',
+            {'__error__': 'Invalid JSON: oops'},
+            self.row('B3'),
+        ], batch_size=2)
+        self.assertEqual((report.created, report.failed), (1, 4))
+        self.assertEqual(sorted(error['row'] for error in report.errors), [1, 2, 3, 4])
+
+    def test_batch_racing_another_writer_is_retried_once(self):
+        bulk_create = Product.objects.bulk_create
+        calls = []
+
+        def racing(products, *args, **kwargs):
+            calls.append(len(products))
+            if len(calls) == 1:
+                raise IntegrityError('UNIQUE constraint failed: products.sku')
+            return bulk_create(products, *args, **kwargs)
+
+        with mock.patch.object(Product.objects, 'bulk_create', side_effect=racing):
+            report = import_products([self.row('X1'), self.row('X2', category='missing')])
+        self.assertEqual(calls, [1, 1])
+        self.assertEqual((report.created, report.updated, report.failed), (1, 0, 1))
+
+
+class ImportJobTests(ProductTestCase):
+    IMPORT_URL = f'{PRODUCTS_URL}bulk_import/'
+
+    def setUp(self):
+        super().setUp()
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        settings_override = override_settings(MEDIA_ROOT=media.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.admin = get_user_model().objects.create_user(username='admin', email='admin@example.com', is_staff=True)
+        self.client.force_authenticate(self.admin)
+
+    def run_worker(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            return process_import_job()
+
+    def test_upload_is_queued_and_imported_by_the_worker(self):
+        upload = SimpleUploadedFile('products.csv', b'sku,name,price,category,stock\nJ1,Jack,5.00,audio,3\nJ2,Jill,,audio,1\n')
+        response = self.client.post(self.IMPORT_URL, {'file': upload}, format='multipart')
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.data['status'], 'queued')
+        self.assertFalse(Product.objects.exists())
+
+        self.run_worker()
+        job = ProductImportJob.objects.get(pk=response.data['id'])
+        self.assertEqual((job.status, job.created, job.failed), ('succeeded', 1, 1))
+        self.assertEqual(job.errors[0]['row'], 2)
+        self.assertFalse(job.file)
+        self.assertEqual(Product.objects.get().sku, 'J1')
+
+        status = self.client.get(f'{self.IMPORT_URL}{job.pk}/')
+        self.assertEqual(status.status_code, 200)
+        self.assertEqual((status.data['created'], status.data['failed']), (1, 1))
+
+    def test_raw_body_is_queued(self):
+        body = json.dumps({'sku': 'N1', 'name': 'Noise', 'price': '10.00', 'category': 'audio'}) + '\n'
+        response = self.client.generic('POST', self.IMPORT_URL, body, content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, 202)
+        self.run_worker()
+        self.assertEqual(ProductImportJob.objects.get().status, 'succeeded')
+        self.assertTrue(Product.objects.filter(sku='N1').exists())
+
+    def test_only_admins_can_import(self):
+        self.client.force_authenticate(None)
+        upload = SimpleUploadedFile('products.csv', b'sku,name,price,category\n')
+        self.assertIn(self.client.post(self.IMPORT_URL, {'file': upload}).status_code, (401, 403))
+
+    def test_jobs_of_crashed_workers_are_taken_over(self):
+        upload = SimpleUploadedFile('products.csv', b'sku,name,price,category\nK1,Kit,1.00,audio\n')
+        self.client.post(self.IMPORT_URL, {'file': upload}, format='multipart')
+        job = claim_import_job('crashed')
+        self.assertEqual(job.status, 'processing')
+        self.assertIsNone(claim_import_job('other'))
+        ProductImportJob.objects.filter(pk=job.pk).update(locked_at=timezone.now() - timedelta(hours=1))
+        self.run_worker()
+        self.assertEqual(ProductImportJob.objects.get(pk=job.pk).status, 'succeeded')
+        self.assertTrue(Product.objects.filter(sku='K1').exists())
+
+
+class StockTests(ProductTestCase):
+    STOCK_URL = f'{PRODUCTS_URL}bulk_stock/'
+
+    def setUp(self):
+        super().setUp()
+        self.first = make_product(self.category, 'S1', stock=5)
+        self.second = make_product(self.category, 'S2', stock=1)
+
+    def stock(self):
+        return dict(Product.objects.values_list('sku', 'stock'))
+
+    def test_delta_adjustments_skip_what_would_go_negative(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            updated, rejected = adjust_stock({'S1': -2, 'S2': -3, 'NOPE': 1})
+        self.assertEqual(updated, 1)
+        self.assertEqual(rejected, {'S2': INSUFFICIENT_STOCK, 'NOPE': UNKNOWN_SKU})
+        self.assertEqual(self.stock(), {'S1': 3, 'S2': 1})
+
+    def test_absolute_adjustments_replace_the_stock(self):
+        updated, rejected = adjust_stock({'S1': 0, 'S2': 40}, mode='absolute')
+        self.assertEqual((updated, rejected), (2, {}))
+        self.assertEqual(self.stock(), {'S1': 0, 'S2': 40})
+
+    def test_one_update_for_many_skus(self):
+        for n in range(3, 8):
+            make_product(self.category, f'S{n}')
+        with self.assertNumQueries(4):
+            # A locking SELECT and one UPDATE, inside a savepoint
+            adjust_stock({f'S{n}': 1 for n in range(1, 8)})
+        self.assertEqual(self.stock()['S7'], 11)
+
+    def test_restore_stock(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(restore_stock({self.first.pk: 2, self.second.pk: 1}), 2)
+        self.assertEqual(self.stock(), {'S1': 7, 'S2': 2})
+
+    def test_stock_can_never_go_negative(self):
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Product.objects.filter(pk=self.second.pk).update(stock=-1)
+
+    def test_endpoint(self):
+        admin = get_user_model().objects.create_user(username='admin', email='admin@example.com', is_staff=True)
+        self.client.force_authenticate(admin)
+        response = self.client.post(self.STOCK_URL, {'adjustments': {'S1': 1, 'S9': 1}}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, {'updated': 1, 'rejected': {'S9': UNKNOWN_SKU}})
+        response = self.client.post(
+            self.STOCK_URL, {'mode': 'absolute', 'adjustments': {'S1': -1}}, format='json',
+        )
+        self.assertEqual(response.status_code, 400)
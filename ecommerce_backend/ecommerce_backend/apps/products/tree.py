@@ -0,0 +1,81 @@
+"""
+In-memory copy of the category tree.
+
+Each worker keeps the nested tree and a slug -> path map in process memory.
+Category writes replace a version token in the shared cache, so every worker
+notices the change on its next read and rebuilds with a single query.
+"""
+import threading
+import uuid
+
+from django.core.cache import cache
+
+VERSION_KEY = 'category-tree-version'
+
+_lock = threading.Lock()
+_state = {'version': None, 'tree': None, 'paths': None}
+
+
+def _current_version():
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        # add() so concurrent workers agree on the first version
+        cache.add(VERSION_KEY, uuid.uuid4().hex, timeout=None)
+        version = cache.get(VERSION_KEY)
+    return version
+
+
+def _build():
+    from .models import Category
+
+    categories = list(
+        Category.objects.order_by('path').values('id', 'name', 'slug', 'parent_id', 'is_active', 'path')
+    )
+    paths = {category['slug']: category['path'] for category in categories}
+
+    # Ordering by path puts every parent before its children
+    nodes = {}
+    tree = []
+    for category in categories:
+        if not category['is_active']:
+            continue
+        node = {
+            'id': category['id'],
+            'name': category['name'],
+            'slug': category['slug'],
+            'children': [],
+        }
+        if category['parent_id'] is None:
+            tree.append(node)
+        elif category['parent_id'] in nodes:
+            nodes[category['parent_id']]['children'].append(node)
+        else:
+            # Under an inactive parent, hidden along with it
+            continue
+        nodes[category['id']] = node
+    return tree, paths
+
+
+def _load():
+    version = _current_version()
+    if _state['version'] != version:
+        with _lock:
+            if _state['version'] != version:
+                tree, paths = _build()
+                _state.update(version=version, tree=tree, paths=paths)
+    return _state
+
+
+def get_category_tree():
+    """Nested list of active categories, each with its `children`."""
+    return _load()['tree']
+
+
+def get_category_path(slug):
+    """Materialized path of the category with `slug`, or None."""
+    return _load()['paths'].get(slug)
+
+
+def invalidate_category_tree():
+    cache.set(VERSION_KEY, uuid.uuid4().hex, timeout=None)
+    _state['version'] = None
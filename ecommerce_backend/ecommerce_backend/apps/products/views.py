@@ -1,39 +1,76 @@
-from rest_framework import viewsets, filters, status
+import shutil
+import tempfile
+
+from django.core.files import File
+from django.shortcuts import get_object_or_404
+from rest_framework import viewsets, status
 from rest_framework.decorators import action
 from rest_framework.response import Response
-from rest_framework.permissions import IsAuthenticatedOrReadOnly, IsAuthenticated
+from rest_framework.permissions import IsAuthenticatedOrReadOnly, IsAuthenticated, IsAdminUser
+from rest_framework.parsers import MultiPartParser
 from django_filters.rest_framework import DjangoFilterBackend
-from django.db.models import Q, Avg, Count
-from .models import Category, Product, ProductReview
+from .models import Category, Product, ProductImportJob, ProductReview, primary_image_prefetch
 from .serializers import (
     CategorySerializer, ProductListSerializer, 
-    ProductDetailSerializer, ProductReviewSerializer
+    ProductDetailSerializer, ProductImportJobSerializer, ProductReviewSerializer, StockAdjustmentSerializer
 )
-from .filters import ProductFilter
+from apps.core.conditional import ConditionalGetMixin, respond_with_validators
+from apps.core.pagination import KeysetPagination
+from apps.core.sparse import SparseFieldsMixin
+from .filters import ProductFilter, ProductOrderingFilter
+from .importer import enqueue_import
+from .inventory import adjust_stock
+from .leaderboard import get_featured, get_stats as get_leaderboard_stats
+from .tree import get_category_tree
 
-class CategoryViewSet(viewsets.ModelViewSet):
+class CategoryViewSet(SparseFieldsMixin, ConditionalGetMixin, viewsets.ModelViewSet):
     queryset = Category.objects.filter(is_active=True)
     serializer_class = CategorySerializer
     permission_classes = [IsAuthenticatedOrReadOnly]
     lookup_field = 'slug'
 
-class ProductViewSet(viewsets.ModelViewSet):
+    def get_queryset(self):
+        return self.prune_queryset(super().get_queryset())
+
+    @action(detail=False, methods=['get'])
+    def tree(self, request):
+        """Get all active categories as a nested tree (served from memory)"""
+        return respond_with_validators(request, get_category_tree())
+
+class ProductViewSet(SparseFieldsMixin, ConditionalGetMixin, viewsets.ModelViewSet):
     permission_classes = [IsAuthenticatedOrReadOnly]
-    filter_backends = [DjangoFilterBackend, filters.SearchFilter, filters.OrderingFilter]
+    # `?search=` is handled by ProductFilter through the search index
+    filter_backends = [DjangoFilterBackend, ProductOrderingFilter]
     filterset_class = ProductFilter
-    search_fields = ['name', 'description', 'category__name']
-    ordering_fields = ['price', 'name', 'created_at', 'stock']
+    ordering_fields = ['price', 'name', 'created_at', 'stock', 'avg_rating']
     ordering = ['-created_at']
+    pagination_class = KeysetPagination
     lookup_field = 'slug'
+    # Products embed their category name, so category edits change the representation too
+    conditional_fields = ('updated_at', 'category__updated_at')
+    # Raw request bodies accepted by bulk_import
+    IMPORT_CONTENT_TYPES = {
+        'text/csv': 'csv',
+        'application/x-ndjson': 'ndjson',
+        'application/jsonl': 'ndjson',
+    }
 
     def get_queryset(self):
-        queryset = Product.objects.filter(is_active=True).select_related('category').prefetch_related('images')
+        queryset = Product.objects.filter(is_active=True)
+        if self.wants('category_name'):
+            queryset = queryset.select_related('category')
         
-        # Optimize queries based on action
+        # Optimize queries based on action, skipping relations `?fields=` left out
         if self.action == 'retrieve':
-            queryset = queryset.prefetch_related('images', 'reviews__user')
+            # Detail shows every image, so the primary one is picked from them
+            if self.wants('images') or self.wants('primary_image'):
+                queryset = queryset.prefetch_related('images')
+            if self.wants('reviews'):
+                queryset = queryset.prefetch_related('reviews__user')
+        elif self.wants('primary_image'):
+            queryset = queryset.prefetch_related(primary_image_prefetch())
         
-        return queryset
+        return self.prune_queryset(queryset)
 
     def get_serializer_class(self):
         if self.action == 'retrieve':
@@ -60,22 +97,13 @@ class ProductViewSet(viewsets.ModelViewSet):
 
     @action(detail=False, methods=['get'])
     def featured(self, request):
-        """Get featured products (in stock and with highest ratings)"""
+        """Get featured products (in stock and with highest ratings), optionally for a `?category=` subtree"""
         try:
-            featured_products = self.get_queryset().filter(
-                stock__gt=0  # Only products with stock > 0
-            ).annotate(
-                avg_rating=Avg('reviews__rating'),
-                review_count=Count('reviews')
-            ).filter(
-                avg_rating__gte=4.0,  # At least 4-star rating
-                review_count__gte=1   # At least 1 review
-            ).order_by('-avg_rating', '-review_count')[:10]  # Order by rating then review count
-            
-            serializer = self.get_serializer(featured_products, many=True)
-            return Response({
-                'count': len(featured_products),
-                'results': serializer.data
+            # Precomputed in the cache, see leaderboard.py
+            results = get_featured(request.query_params.get('category'))
+            return respond_with_validators(request, {
+                'count': len(results),
+                'results': results
             })
         except Exception as e:
             return Response(
@@ -83,6 +111,56 @@ class ProductViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
 
+    @action(detail=False, methods=['post'], permission_classes=[IsAdminUser], parser_classes=[MultiPartParser])
+    def bulk_import(self, request):
+        """Queue an upsert of products by SKU from a CSV or NDJSON file.
+
+        Send the file as multipart `file`, or stream it as the raw request body
+        with a `text/csv` or `application/x-ndjson` content type. The file is
+        imported by the import worker, poll the returned job for its report.
+        """
+        content_type = request.content_type.split(';')[0].strip()
+        if content_type == 'multipart/form-data':
+            upload = request.FILES.get('file')
+            if upload is None:
+                return Response({'error': 'No file uploaded.'}, status=status.HTTP_400_BAD_REQUEST)
+            file_format = 'ndjson' if upload.name.lower().endswith(('.ndjson', '.jsonl')) else 'csv'
+            job = enqueue_import(upload, file_format, request.user)
+        elif content_type in self.IMPORT_CONTENT_TYPES:
+            # Copied to disk in chunks instead of letting a parser load the body whole
+            file_format = self.IMPORT_CONTENT_TYPES[content_type]
+            with tempfile.TemporaryFile() as body:
+                shutil.copyfileobj(request._request, body)
+                body.seek(0)
+                job = enqueue_import(File(body), file_format, request.user)
+        else:
+            return Response(
+                {'error': f'Unsupported content type {content_type}.'},
+                status=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE
+            )
+        return Response(ProductImportJobSerializer(job).data, status=status.HTTP_202_ACCEPTED)
+
+    @action(detail=False, methods=['get'], permission_classes=[IsAdminUser], url_path=r'bulk_import/(?P<job_id>\d+)')
+    def bulk_import_status(self, request, job_id):
+        """Progress and report of a queued bulk import"""
+        job = get_object_or_404(ProductImportJob, pk=job_id)
+        return Response(ProductImportJobSerializer(job).data)
+
+    @action(detail=False, methods=['post'], permission_classes=[IsAdminUser])
+    def bulk_stock(self, request):
+        """Adjust stock for many SKUs at once: `{"mode": "delta"|"absolute", "adjustments": {sku: n}}`"""
+        serializer = StockAdjustmentSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        updated, rejected = adjust_stock(
+            serializer.validated_data['adjustments'], serializer.validated_data['mode']
+        )
+        return Response({'updated': updated, 'rejected': rejected})
+
+    @action(detail=False, methods=['get'], permission_classes=[IsAdminUser])
+    def featured_stats(self, request):
+        """Cache hit/miss counters of the featured leaderboards"""
+        return Response(get_leaderboard_stats())
+
 class ProductReviewViewSet(viewsets.ModelViewSet):
     serializer_class = ProductReviewSerializer
     permission_classes = [IsAuthenticated]
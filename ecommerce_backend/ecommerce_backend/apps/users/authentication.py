@@ -0,0 +1,169 @@
+"""
+JWT authentication without a `users` query per request.
+
+CachedJWTAuthentication resolves the token's user from two caches before
+falling back to the database: a small LRU in each process, trusted for
+USER_CACHE_LOCAL_TTL seconds, and the shared Django cache, for
+USER_CACHE_TTL seconds. Entries are keyed by user id and token version and
+are dropped when the user is saved or deleted (profile edits, password
+changes, deactivation), see signals.py. Other processes may keep serving
+their local copy for up to USER_CACHE_LOCAL_TTL seconds after that.
+
+Dropping also moves the user to a new generation. Shared entries record the
+generation read before the database lookup and are ignored once it changed,
+so a request that loaded the old row just before an invalidation can't
+cache it again for USER_CACHE_TTL seconds.
+
+The token version (`ver` claim) is derived from the password hash like
+Django's session hash, so a password change also retires the tokens issued
+before it. Tokens without the claim are still accepted.
+"""
+import copy
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.crypto import constant_time_compare
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import RefreshToken
+
+TOKEN_VERSION_CLAIM = 'ver'
+CACHE_KEY = 'auth:user:{user_id}'
+GENERATION_KEY = 'auth:user:{user_id}:generation'
+STATS = ('local_hits', 'shared_hits', 'misses')
+
+
+def token_version(user):
+    return user.get_session_auth_hash()[:16]
+
+
+class VersionedRefreshToken(RefreshToken):
+    """Refresh token (and access token made from it) carrying the user's token version."""
+
+    @classmethod
+    def for_user(cls, user):
+        token = super().for_user(user)
+        token[TOKEN_VERSION_CLAIM] = token_version(user)
+        return token
+
+
+class UserCache:
+    """Thread-safe LRU of `user_id -> (version, user, expires)`, bounded to `max_size` entries."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id, version):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return None
+            if entry[0] != version or entry[2] <= time.monotonic():
+                del self._entries[user_id]
+                return None
+            self._entries.move_to_end(user_id)
+            return entry[1]
+
+    def set(self, user_id, version, user, ttl):
+        with self._lock:
+            self._entries[user_id] = (version, user, time.monotonic() + ttl)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def discard(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_users = UserCache(settings.USER_CACHE_SIZE)
+# Per process, a shared counter would cost the cache round trip the local cache saves
+_stats = dict.fromkeys(STATS, 0)
+_stats_lock = threading.Lock()
+
+
+def _count(name):
+    with _stats_lock:
+        _stats[name] += 1
+
+
+def get_stats():
+    with _stats_lock:
+        stats = dict(_stats)
+    lookups = sum(stats.values())
+    stats['hit_ratio'] = round((stats['local_hits'] + stats['shared_hits']) / lookups, 4) if lookups else None
+    return stats
+
+
+def reset_stats():
+    with _stats_lock:
+        _stats.update(dict.fromkeys(STATS, 0))
+
+
+def invalidate_user(user_id):
+    _users.discard(user_id)
+    # Losing the generation is safe, a new one is made that no entry matches
+    cache.set(GENERATION_KEY.format(user_id=user_id), uuid.uuid4().hex, settings.USER_CACHE_TTL)
+    cache.delete(CACHE_KEY.format(user_id=user_id))
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    def get_user(self, validated_token):
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken(_("Token contained no recognizable user identification"))
+        version = validated_token.get(TOKEN_VERSION_CLAIM, '')
+
+        user = _users.get(user_id, version) if settings.USER_CACHE_LOCAL_TTL else None
+        if user is not None:
+            _count('local_hits')
+        else:
+            user = self._get_shared(user_id, version)
+        # The request may change its user, don't hand out the cached instance
+        return copy.copy(user)
+
+    def _get_shared(self, user_id, version):
+        key = CACHE_KEY.format(user_id=user_id)
+        generation_key = GENERATION_KEY.format(user_id=user_id)
+        values = cache.get_many([key, generation_key])
+        entry, generation = values.get(key), values.get(generation_key)
+        if generation is None:
+            cache.add(generation_key, uuid.uuid4().hex, settings.USER_CACHE_TTL)
+            generation = cache.get(generation_key)
+        if entry is not None and entry['version'] == version and entry['generation'] == generation:
+            _count('shared_hits')
+            user = entry['user']
+        else:
+            _count('misses')
+            # Read before the lookup, if the user is invalidated meanwhile this entry is never used
+            user = self._load(user_id, version)
+            cache.set(key, {'version': version, 'generation': generation, 'user': user}, settings.USER_CACHE_TTL)
+        if settings.USER_CACHE_LOCAL_TTL:
+            _users.set(user_id, version, user, settings.USER_CACHE_LOCAL_TTL)
+        return user
+
+    def _load(self, user_id, version):
+        """The database lookup and checks of JWTAuthentication.get_user, plus the token version."""
+        try:
+            user = self.user_model.objects.get(**{api_settings.USER_ID_FIELD: user_id})
+        except self.user_model.DoesNotExist:
+            raise AuthenticationFailed(_("User not found"), code="user_not_found")
+        # Only active users with a current token version are ever cached
+        if not user.is_active:
+            raise AuthenticationFailed(_("User is inactive"), code="user_inactive")
+        if version and not constant_time_compare(version, token_version(user)):
+            raise AuthenticationFailed(_("Token is no longer valid"), code="token_version_changed")
+        return user
@@ -0,0 +1,75 @@
+"""
+Password hashing off the request path.
+
+Hashing a password is deliberately slow (tens of milliseconds of CPU with
+PBKDF2). Login and registration hand it to a small thread pool, so at most
+AUTH_HASH_WORKERS hashes run at once whatever the traffic, and at most
+AUTH_HASH_QUEUE_SIZE more wait for a thread. Past that a request is turned
+away with a 503 instead of queueing up behind a burst of sign-ins, and the
+rest of the API keeps its CPU. The database work stays on the request
+thread.
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import check_password, make_password
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+_executor = ThreadPoolExecutor(max_workers=settings.AUTH_HASH_WORKERS, thread_name_prefix='password-hash')
+_slots = threading.BoundedSemaphore(settings.AUTH_HASH_WORKERS + settings.AUTH_HASH_QUEUE_SIZE)
+
+
+class HashingBusy(APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = 'Too many sign-ins in progress, please try again shortly.'
+    default_code = 'hashing_busy'
+    # Sent as Retry-After by DRF's exception handler
+    wait = 1
+
+
+def offload(func, *args):
+    """Run `func(*args)` on the hashing pool, HashingBusy when it is full or too slow."""
+    if not _slots.acquire(blocking=False):
+        raise HashingBusy()
+    try:
+        future = _executor.submit(func, *args)
+    except BaseException:
+        _slots.release()
+        raise
+    future.add_done_callback(lambda _: _slots.release())
+    try:
+        return future.result(timeout=settings.AUTH_HASH_TIMEOUT)
+    except FutureTimeout:
+        raise HashingBusy()
+
+
+def hash_password(raw_password):
+    return offload(make_password, raw_password)
+
+
+def check_credentials(email, password):
+    """
+    The active user with these credentials, or None.
+
+    Same outcome as `authenticate()` with ModelBackend, including hashing
+    once for unknown emails so they take as long as wrong passwords.
+    """
+    User = get_user_model()
+    try:
+        user = User._default_manager.get_by_natural_key(email)
+    except User.DoesNotExist:
+        offload(make_password, password)
+        return None
+
+    outdated = []
+    if not offload(check_password, password, user.password, outdated.append):
+        return None
+    if outdated:
+        # Hasher settings changed since it was stored, rehash like check_password() would
+        user.password = hash_password(password)
+        user.save(update_fields=['password'])
+    return user if user.is_active else None
@@ -16,3 +16,17 @@ class User(AbstractUser):
             models.Index(fields=['email']),
             models.Index(fields=['username']),
         ]
+
+
+class RevokedToken(models.Model):
+    """A refresh token that can no longer be used, kept until it would have expired anyway."""
+    jti = models.CharField(max_length=255, unique=True)
+    expires_at = models.DateTimeField(db_index=True)
+    # Workers pick up new rows by this, see apps.users.revocation
+    revoked_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        db_table = 'revoked_tokens'
+
+    def __str__(self):
+        return self.jti
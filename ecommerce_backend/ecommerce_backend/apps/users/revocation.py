@@ -0,0 +1,234 @@
+"""
+Refresh-token revocation.
+
+Logging out, and rotating a refresh token on refresh, writes the token's jti
+to the `revoked_tokens` table. Checking a token doesn't read that table:
+every process keeps a Bloom filter of all unexpired revoked jtis plus an
+exact set of the REVOCATION_RECENT_SIZE most recent ones. A jti the filter
+has never seen is not revoked, one in the recent set is, and only the rare
+other filter hits (old revocations and false positives, about
+REVOCATION_FALSE_POSITIVE_RATE of all checks) are looked up in the
+database.
+
+Processes stay in sync incrementally: a revocation bumps a generation
+counter in the shared cache, and a process that sees a new generation, or
+hasn't synced for REVOCATION_SYNC_INTERVAL seconds, loads the rows revoked
+since its last sync (with SYNC_OVERLAP of slack for slow commits and clock
+skew). Every REVOCATION_REBUILD_INTERVAL seconds the filter is rebuilt from
+the unexpired rows, which drops expired tokens and grows it if needed.
+Access tokens aren't tracked, they stay valid until they expire.
+"""
+import hashlib
+import math
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from rest_framework_simplejwt.settings import api_settings
+
+from .models import RevokedToken
+
+GENERATION_KEY = 'auth:revoked:generation'
+SYNC_OVERLAP = timedelta(seconds=60)
+SYNC_BATCH_SIZE = 1000
+PURGE_BATCH_SIZE = 1000
+STATS = ('recent_hits', 'filter_misses', 'db_checks', 'false_positives', 'syncs', 'rebuilds')
+
+
+class BloomFilter:
+    """
+    Probabilistic set of strings: no false negatives, and false positives at
+    about `error_rate` while it holds at most `capacity` items.
+    """
+
+    def __init__(self, capacity, error_rate):
+        self.capacity = capacity
+        self.size = max(64, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.count = 0
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item):
+        # Double hashing, k positions from one digest
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        step = int.from_bytes(digest[8:], 'little') | 1
+        return [(first + i * step) % self.size for i in range(self.hashes)]
+
+    def add(self, item):
+        for position in self._positions(item):
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item):
+        return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+
+class RevocationList:
+    """A process's in-memory view of `revoked_tokens`, thread-safe."""
+
+    def __init__(self, capacity, error_rate, recent_size):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.recent_size = recent_size
+        self._filter = None
+        self._recent = OrderedDict()
+        self._generation = None
+        self._synced_until = None
+        self._synced_at = self._rebuilt_at = 0.0
+        self._stats = dict.fromkeys(STATS, 0)
+        self._lock = threading.Lock()
+
+    def _add(self, jti):
+        # Caller holds the lock
+        self._filter.add(jti)
+        self._recent[jti] = None
+        self._recent.move_to_end(jti)
+        while len(self._recent) > self.recent_size:
+            self._recent.popitem(last=False)
+
+    def add(self, jti, generation=None):
+        """Add a jti this process revoked, which bumped the shared generation to `generation`."""
+        with self._lock:
+            if self._filter is None:
+                return
+            self._add(jti)
+            # Nobody else revoked anything since the last sync, no need to catch up
+            if generation is not None and isinstance(self._generation, int) and generation == self._generation + 1:
+                self._generation = generation
+
+    def sync(self):
+        """Bring the filter up to date if the table may have changed."""
+        generation = cache.get(GENERATION_KEY)
+        now = time.monotonic()
+        with self._lock:
+            if self._filter is None or now - self._rebuilt_at > settings.REVOCATION_REBUILD_INTERVAL:
+                action = self._rebuild
+            elif generation != self._generation or now - self._synced_at > settings.REVOCATION_SYNC_INTERVAL:
+                action = self._catch_up
+            else:
+                return
+        action(generation)
+
+    def _rebuild(self, generation):
+        started = timezone.now()
+        live = RevokedToken.objects.filter(expires_at__gt=started)
+        bloom = BloomFilter(max(self.capacity, 2 * live.count()), self.error_rate)
+        recent = OrderedDict()
+        for jti in live.order_by('revoked_at').values_list('jti', flat=True).iterator(chunk_size=SYNC_BATCH_SIZE):
+            bloom.add(jti)
+            recent[jti] = None
+            if len(recent) > self.recent_size:
+                recent.popitem(last=False)
+        with self._lock:
+            # Revocations published while the rows were being read
+            for jti in self._recent:
+                if jti not in recent:
+                    bloom.add(jti)
+                    recent[jti] = None
+            self._filter = bloom
+            self._recent = recent
+            while len(self._recent) > self.recent_size:
+                self._recent.popitem(last=False)
+            self._generation = generation
+            self._synced_until = started
+            self._synced_at = self._rebuilt_at = time.monotonic()
+            self._stats['rebuilds'] += 1
+
+    def _catch_up(self, generation):
+        started = timezone.now()
+        with self._lock:
+            since = self._synced_until - SYNC_OVERLAP
+        rows = RevokedToken.objects.filter(revoked_at__gte=since, expires_at__gt=started)
+        jtis = list(rows.order_by('revoked_at').values_list('jti', flat=True))
+        with self._lock:
+            for jti in jtis:
+                if jti not in self._recent:
+                    self._add(jti)
+            self._generation = generation
+            self._synced_until = max(self._synced_until, started)
+            self._synced_at = time.monotonic()
+            self._stats['syncs'] += 1
+
+    def is_revoked(self, jti):
+        self.sync()
+        with self._lock:
+            if jti in self._recent:
+                self._stats['recent_hits'] += 1
+                return True
+            if jti not in self._filter:
+                self._stats['filter_misses'] += 1
+                return False
+            self._stats['db_checks'] += 1
+        revoked = RevokedToken.objects.filter(jti=jti).exists()
+        if not revoked:
+            with self._lock:
+                self._stats['false_positives'] += 1
+        return revoked
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['filter_size'] = self._filter.count if self._filter is not None else 0
+            stats['filter_capacity'] = self._filter.capacity if self._filter is not None else 0
+            stats['recent_size'] = len(self._recent)
+        return stats
+
+    def reset(self):
+        with self._lock:
+            self._filter = None
+            self._recent.clear()
+            self._stats = dict.fromkeys(STATS, 0)
+
+
+_revoked = RevocationList(
+    settings.REVOCATION_FILTER_CAPACITY, settings.REVOCATION_FALSE_POSITIVE_RATE, settings.REVOCATION_RECENT_SIZE,
+)
+
+
+def _published(jti):
+    try:
+        generation = cache.incr(GENERATION_KEY)
+    except ValueError:
+        generation = None
+        cache.set(GENERATION_KEY, 1, None)
+    _revoked.add(jti, generation)
+
+
+def is_revoked(token):
+    return _revoked.is_revoked(token[api_settings.JTI_CLAIM])
+
+
+def revoke(token):
+    """Revoke a refresh token, False if it already was."""
+    jti = token[api_settings.JTI_CLAIM]
+    expires_at = datetime.fromtimestamp(token['exp'], tz=dt_timezone.utc)
+    try:
+        with transaction.atomic():
+            RevokedToken.objects.create(jti=jti, expires_at=expires_at)
+    except IntegrityError:
+        return False
+    # Other processes only see the row once it is committed
+    transaction.on_commit(lambda: _published(jti))
+    return True
+
+
+def get_stats():
+    return _revoked.get_stats()
+
+
+def purge_expired(batch_size=PURGE_BATCH_SIZE):
+    """Delete revocations of tokens that have expired, returns how many were deleted."""
+    deleted = 0
+    while True:
+        ids = list(
+            RevokedToken.objects.filter(expires_at__lte=timezone.now()).values_list('pk', flat=True)[:batch_size]
+        )
+        if not ids:
+            return deleted
+        deleted += RevokedToken.objects.filter(pk__in=ids).delete()[0]
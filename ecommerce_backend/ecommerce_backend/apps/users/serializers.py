@@ -1,5 +1,11 @@
 from rest_framework import serializers
 from django.contrib.auth.password_validation import validate_password
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.settings import api_settings
+from apps.core.sparse import SparseFieldsSerializerMixin
+from .authentication import VersionedRefreshToken
+from .hashing import hash_password
+from .revocation import is_revoked, revoke
 from .models import User
 
 class UserRegistrationSerializer(serializers.ModelSerializer):
@@ -17,10 +23,15 @@ class UserRegistrationSerializer(serializers.ModelSerializer):
 
     def create(self, validated_data):
         validated_data.pop('password2')
-        user = User.objects.create_user(**validated_data)
+        # What create_user() does, with the hashing on the bounded pool
+        password = hash_password(validated_data.pop('password'))
+        validated_data['email'] = User.objects.normalize_email(validated_data['email'])
+        validated_data['username'] = User.normalize_username(validated_data['username'])
+        user = User(password=password, **validated_data)
+        user.save()
         return user
 
-class UserProfileSerializer(serializers.ModelSerializer):
+class UserProfileSerializer(SparseFieldsSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = User
         fields = ('id', 'email', 'username', 'first_name', 'last_name', 'phone', 'address', 'date_joined')
@@ -28,4 +39,31 @@ class UserProfileSerializer(serializers.ModelSerializer):
 
 class LoginSerializer(serializers.Serializer):
     email = serializers.EmailField()
-    password = serializers.CharField()
\ No newline at end of file
+    password = serializers.CharField()
+class TokenRefreshSerializer(serializers.Serializer):
+    """simplejwt's refresh, rejecting revoked tokens and revoking the old one on rotation."""
+    refresh = serializers.CharField()
+    access = serializers.CharField(read_only=True)
+
+    def validate(self, attrs):
+        refresh = VersionedRefreshToken(attrs['refresh'])
+        if is_revoked(refresh):
+            raise TokenError('Token is revoked')
+        data = {'access': str(refresh.access_token)}
+
+        if api_settings.ROTATE_REFRESH_TOKENS:
+            # The insert also settles two refreshes racing with the same token
+            if not revoke(refresh):
+                raise TokenError('Token is revoked')
+            refresh.set_jti()
+            refresh.set_exp()
+            refresh.set_iat()
+            data['refresh'] = str(refresh)
+        return data
+
+class LogoutSerializer(serializers.Serializer):
+    refresh = serializers.CharField()
+
+    def validate(self, attrs):
+        revoke(VersionedRefreshToken(attrs['refresh']))
+        return attrs
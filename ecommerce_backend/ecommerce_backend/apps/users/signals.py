@@ -0,0 +1,15 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .authentication import invalidate_user
+from .models import User
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def user_changed(sender, instance, **kwargs):
+    # Profile edits, password changes and deactivation all go through save().
+    # Once committed, or another request could cache the old row again.
+    user_id = instance.pk
+    transaction.on_commit(lambda: invalidate_user(user_id))
@@ -1,3 +1,328 @@
-from django.test import TestCase
+import threading
+import time
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.test import RequestFactory, TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.authentication import JWTAuthentication
+
+from .authentication import (
+    CachedJWTAuthentication, VersionedRefreshToken, _users, get_stats, invalidate_user, reset_stats,
+)
+from .hashing import HashingBusy, _slots, offload
+from .models import RevokedToken, User
+from .revocation import GENERATION_KEY, BloomFilter, _revoked
+from .throttling import TokenBucketThrottle
+
+PROFILE_URL = '/api/auth/profile'
+LOGIN_URL = '/api/auth/login'
+REFRESH_URL = '/api/auth/refresh'
+LOGOUT_URL = '/api/auth/logout'
+
+
+class CachedAuthenticationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        _users.clear()
+        reset_stats()
+        self.user = User.objects.create_user(username='buyer', email='buyer@example.com', password='old-secret')
+        self.client = APIClient()
+
+    def token(self, user=None):
+        return str(VersionedRefreshToken.for_user(user or self.user).access_token)
+
+    def get_profile(self, token):
+        return self.client.get(PROFILE_URL, HTTP_AUTHORIZATION=f'Bearer {token}')
+
+    def test_user_is_loaded_once(self):
+        token = self.token()
+        with self.assertNumQueries(1):
+            self.assertEqual(self.get_profile(token).status_code, 200)
+        with self.assertNumQueries(0):
+            for _ in range(5):
+                response = self.get_profile(token)
+        self.assertEqual(response.data['email'], 'buyer@example.com')
+
+        # Another process only has the shared cache
+        _users.clear()
+        with self.assertNumQueries(0):
+            self.get_profile(token)
+        stats = get_stats()
+        self.assertEqual((stats['local_hits'], stats['shared_hits'], stats['misses']), (5, 1, 1))
+        self.assertEqual(stats['hit_ratio'], 0.8571)
+
+    def test_profile_changes_are_seen(self):
+        token = self.token()
+        self.get_profile(token)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.patch(PROFILE_URL, {'first_name': 'Ada'}, HTTP_AUTHORIZATION=f'Bearer {token}')
+        self.assertEqual(self.get_profile(token).data['first_name'], 'Ada')
+
+    def test_deactivated_users_are_rejected(self):
+        token = self.token()
+        self.get_profile(token)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.is_active = False
+            self.user.save()
+        self.assertEqual(self.get_profile(token).status_code, 401)
+
+    def test_cache_is_invalidated_once_committed(self):
+        token = self.token()
+        self.get_profile(token)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.first_name = 'Grace'
+            self.user.save()
+            # Not committed yet, the cached user is still the committed one
+            self.assertEqual(self.get_profile(token).data['first_name'], '')
+        self.assertEqual(self.get_profile(token).data['first_name'], 'Grace')
+
+    def test_user_loaded_before_an_invalidation_is_not_cached(self):
+        token = self.token()
+        load = CachedJWTAuthentication._load
+
+        def load_then_commit_elsewhere(authentication, user_id, version):
+            user = load(authentication, user_id, version)
+            # Another request commits a change after this one read the row
+            User.objects.filter(pk=user_id).update(first_name='Grace')
+            invalidate_user(user_id)
+            return user
+
+        with mock.patch.object(CachedJWTAuthentication, '_load', load_then_commit_elsewhere):
+            self.assertEqual(self.get_profile(token).data['first_name'], '')
+        # Another process only has the shared cache, where the old row must not be served from
+        _users.clear()
+        self.assertEqual(self.get_profile(token).data['first_name'], 'Grace')
+        self.assertEqual(get_stats()['misses'], 2)
+
+    def test_profile_update_does_not_write_back_the_cached_user(self):
+        token = self.token()
+        self.get_profile(token)
+        # Deactivated by another process, this one still has the user cached
+        User.objects.filter(pk=self.user.pk).update(is_active=False)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.patch(PROFILE_URL, {'first_name': 'Ada'}, HTTP_AUTHORIZATION=f'Bearer {token}')
+        self.assertEqual(response.status_code, 200)
+        self.user.refresh_from_db()
+        self.assertEqual((self.user.first_name, self.user.is_active), ('Ada', False))
+
+    def test_password_change_retires_old_tokens(self):
+        old = self.token()
+        self.get_profile(old)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.set_password('new-secret')
+            self.user.save()
+
+        self.assertEqual(self.get_profile(old).status_code, 401)
+        self.assertEqual(self.get_profile(self.token()).status_code, 200)
+
+    def test_login_issues_versioned_tokens(self):
+        response = self.client.post(LOGIN_URL, {'email': 'buyer@example.com', 'password': 'old-secret'})
+        self.assertEqual(self.get_profile(response.data['access']).status_code, 200)
+
+    def test_one_query_per_user_instead_of_per_request(self):
+        users = [User.objects.create_user(username=f'user{n}', email=f'user{n}@example.com') for n in range(20)]
+        factory = RequestFactory()
+        requests = [
+            factory.get(PROFILE_URL, HTTP_AUTHORIZATION=f'Bearer {self.token(user)}')
+            for user in users
+        ] * 25
+
+        counts = {}
+        for name, authentication in (('uncached', JWTAuthentication()), ('cached', CachedJWTAuthentication())):
+            with CaptureQueriesContext(connection) as queries:
+                for request in requests:
+                    self.assertIn(authentication.authenticate(request)[0], users)
+            counts[name] = len(queries)
+        self.assertEqual(counts, {'uncached': len(requests), 'cached': len(users)})
+
+
+class FakeClockThrottle(TokenBucketThrottle):
+    rate = '3/min'
+    now = 1000.0
+
+    def timer(self):
+        return self.now
+
+    def get_cache_key(self, request, view):
+        return 'throttle_test_client'
+
+
+class AuthEndpointProtectionTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        User.objects.create_user(username='buyer', email='buyer@example.com', password='secret')
+        self.client = APIClient()
+
+    def login(self, email='buyer@example.com', password='wrong', ip='10.0.0.1'):
+        return self.client.post(LOGIN_URL, {'email': email, 'password': password}, REMOTE_ADDR=ip)
+
+    def test_token_bucket_bursts_then_refills(self):
+        throttle = FakeClockThrottle()
+        self.assertEqual([throttle.allow_request(None, None) for _ in range(4)], [True, True, True, False])
+        self.assertAlmostEqual(throttle.wait(), 20)
+        # One token back every 20 seconds
+        FakeClockThrottle.now += 20
+        self.assertEqual([throttle.allow_request(None, None) for _ in range(2)], [True, False])
+        # State is a single number per key
+        self.assertIsInstance(cache.get('throttle_test_client'), float)
+
+    def test_login_attempts_are_throttled_per_account(self):
+        responses = [self.login(ip=f'10.0.0.{n}').status_code for n in range(6)]
+        self.assertEqual(responses, [401] * 5 + [429])
+        response = self.login(ip='10.0.0.99')
+        self.assertEqual(response.status_code, 429)
+        self.assertIn('Retry-After', response)
+        # Other accounts from the same addresses are unaffected
+        self.assertEqual(self.login(email='someone@example.com', ip='10.0.0.1').status_code, 401)
+
+    def test_login_attempts_are_throttled_per_ip(self):
+        # 20/min, a few more may get through as the bucket refills while hashing
+        responses = [self.login(email=f'user{n}@example.com').status_code for n in range(30)]
+        self.assertEqual(responses[:20], [401] * 20)
+        self.assertEqual(responses[-1], 429)
+        self.assertEqual(self.login(ip='10.0.0.2').status_code, 401)
+
+    def test_saturated_hashing_pool_is_a_503(self):
+        capacity = settings.AUTH_HASH_WORKERS + settings.AUTH_HASH_QUEUE_SIZE
+        for _ in range(capacity):
+            _slots.acquire()
+        try:
+            response = self.login(password='secret')
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response['Retry-After'], '1')
+        finally:
+            for _ in range(capacity):
+                _slots.release()
+        self.assertEqual(self.login(password='secret').status_code, 200)
+
+    def test_hashing_concurrency_is_bounded(self):
+        running = []
+        peak = []
+        lock = threading.Lock()
+
+        def work():
+            with lock:
+                running.append(1)
+                peak.append(len(running))
+            time.sleep(0.02)
+            with lock:
+                running.pop()
+
+        outcomes = []
+
+        def call():
+            try:
+                offload(work)
+                outcomes.append('ok')
+            except HashingBusy:
+                outcomes.append('busy')
+
+        threads = [threading.Thread(target=call) for _ in range(40)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertLessEqual(max(peak), settings.AUTH_HASH_WORKERS)
+        self.assertEqual(outcomes.count('ok'), len(peak))
+        self.assertGreaterEqual(outcomes.count('busy'), 40 - settings.AUTH_HASH_WORKERS - settings.AUTH_HASH_QUEUE_SIZE)
+
+
+class RevocationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        _revoked.reset()
+        self.user = User.objects.create_user(username='buyer', email='buyer@example.com', password='secret')
+        self.client = APIClient()
+
+    def refresh(self, token):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(REFRESH_URL, {'refresh': token})
+
+    def logout(self, token):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(LOGOUT_URL, {'refresh': token})
+
+    def test_refresh_rotates_and_old_token_is_rejected(self):
+        token = str(VersionedRefreshToken.for_user(self.user))
+        response = self.refresh(token)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('access', response.data)
+        rotated = response.data['refresh']
+        self.assertNotEqual(rotated, token)
+
+        self.assertEqual(self.refresh(token).status_code, 401)
+        self.assertEqual(self.refresh(rotated).status_code, 200)
+
+    def test_logout_revokes_refresh_token(self):
+        token = str(VersionedRefreshToken.for_user(self.user))
+        self.assertEqual(self.logout(token).status_code, 204)
+        self.assertTrue(RevokedToken.objects.exists())
+        self.assertEqual(self.refresh(token).status_code, 401)
+        # Logging out twice is fine, a malformed token isn't
+        self.assertEqual(self.logout(token).status_code, 204)
+        self.assertEqual(self.logout('not-a-token').status_code, 401)
+
+    def test_revocation_is_checked_in_memory(self):
+        revoked = VersionedRefreshToken.for_user(self.user)
+        self.logout(str(revoked))
+        token = str(VersionedRefreshToken.for_user(self.user))
+        self.refresh(str(VersionedRefreshToken.for_user(self.user)))
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.refresh(token).status_code, 200)
+            self.assertEqual(self.refresh(str(revoked)).status_code, 401)
+        reads = [q['sql'] for q in queries.captured_queries if q['sql'].startswith('SELECT')]
+        self.assertEqual(reads, [])
+        stats = _revoked.get_stats()
+        self.assertEqual(stats['filter_misses'], 2)
+        self.assertEqual(stats['recent_hits'], 1)
+        self.assertEqual(stats['db_checks'], 0)
+
+    def test_revocations_from_other_processes_are_picked_up(self):
+        token = VersionedRefreshToken.for_user(self.user)
+        _revoked.sync()
+        # Written by another process: the row plus a new generation
+        RevokedToken.objects.create(jti=token['jti'], expires_at=timezone.now() + timedelta(days=1))
+        self.assertFalse(_revoked.is_revoked(token['jti']))
+        cache.set(GENERATION_KEY, 1, None)
+        self.assertTrue(_revoked.is_revoked(token['jti']))
+        self.assertEqual(_revoked.get_stats()['syncs'], 1)
+
+    def test_rebuild_skips_expired_and_old_revocations_hit_the_database(self):
+        _revoked.recent_size = 2
+        self.addCleanup(setattr, _revoked, 'recent_size', settings.REVOCATION_RECENT_SIZE)
+        now = timezone.now()
+        RevokedToken.objects.create(jti='expired', expires_at=now - timedelta(seconds=1))
+        for n in range(3):
+            RevokedToken.objects.create(jti=f'live-{n}', expires_at=now + timedelta(days=1))
+
+        self.assertFalse(_revoked.is_revoked('expired'))
+        self.assertTrue(_revoked.is_revoked('live-2'))
+        with self.assertNumQueries(1):
+            self.assertTrue(_revoked.is_revoked('live-0'))
+        stats = _revoked.get_stats()
+        self.assertEqual((stats['filter_size'], stats['recent_size'], stats['db_checks']), (3, 2, 1))
+
+    def test_bloom_filter_false_positive_rate(self):
+        bloom = BloomFilter(10000, 0.01)
+        for n in range(10000):
+            bloom.add(f'revoked-{n}')
+        self.assertTrue(all(f'revoked-{n}' in bloom for n in range(10000)))
+        false_positives = sum(f'other-{n}' in bloom for n in range(10000))
+        self.assertLess(false_positives, 200)
+        self.assertLess(len(bloom._bits), 12 * 1024)
+
+    def test_purge_expired(self):
+        now = timezone.now()
+        RevokedToken.objects.create(jti='expired', expires_at=now - timedelta(seconds=1))
+        RevokedToken.objects.create(jti='live', expires_at=now + timedelta(days=1))
+        call_command('purge_revoked_tokens', stdout=StringIO())
+        self.assertEqual(list(RevokedToken.objects.values_list('jti', flat=True)), ['live'])
@@ -0,0 +1,60 @@
+"""
+Token-bucket throttles for the auth endpoints.
+
+A rate of `N/period` is a bucket of N tokens refilled at N per period, so a
+client can burst N requests and then sustains one every period/N. The
+bucket is kept as a single number in the shared cache, the time at which it
+will be full again (GCRA), instead of DRF's list of request timestamps, so
+every key costs the same few bytes however busy it is. Concurrent requests
+for the same key may read the same value, which at worst lets a few extra
+requests through.
+"""
+import hashlib
+
+from rest_framework.throttling import SimpleRateThrottle
+
+
+class TokenBucketThrottle(SimpleRateThrottle):
+    def allow_request(self, request, view):
+        if self.rate is None:
+            return True
+        self.key = self.get_cache_key(request, view)
+        if self.key is None:
+            return True
+
+        now = self.timer()
+        interval = self.duration / self.num_requests
+        full_at = max(self.cache.get(self.key, now), now) + interval
+        self.wait_time = full_at - now - self.duration
+        if self.wait_time > 0:
+            return False
+        self.cache.set(self.key, full_at, int(full_at - now) + 1)
+        return True
+
+    def wait(self):
+        return self.wait_time
+
+
+class ClientIPThrottle(TokenBucketThrottle):
+    def get_cache_key(self, request, view):
+        return self.cache_format % {'scope': self.scope, 'ident': self.get_ident(request)}
+
+
+class LoginIPThrottle(ClientIPThrottle):
+    scope = 'login_ip'
+
+
+class RegisterIPThrottle(ClientIPThrottle):
+    scope = 'register_ip'
+
+
+class LoginAccountThrottle(TokenBucketThrottle):
+    """Per email address, however many addresses the attempts come from."""
+    scope = 'login_account'
+
+    def get_cache_key(self, request, view):
+        email = request.data.get('email') if hasattr(request.data, 'get') else None
+        if not email or not isinstance(email, str):
+            return None
+        ident = hashlib.sha256(email.strip().lower().encode()).hexdigest()
+        return self.cache_format % {'scope': self.scope, 'ident': ident}
@@ -5,7 +5,11 @@ from . import views
 urlpatterns = [
     path('register', views.register_user, name='register'),
     path('login', views.login_user, name='login'),
+    path('refresh', views.refresh_token, name='token-refresh'),
+    path('logout', views.logout_user, name='logout'),
     path('profile', views.UserProfileView.as_view(), name='profile'),
+    path('cache-stats', views.user_cache_stats, name='user-cache-stats'),
+    path('revocation-stats', views.revocation_stats, name='revocation-stats'),
 ]
 # from django.urls import path
 # from rest_framework.decorators import api_view
@@ -1,22 +1,29 @@
 from rest_framework import status, generics
-from rest_framework.decorators import api_view, permission_classes
+from rest_framework.decorators import api_view, permission_classes, throttle_classes
 from rest_framework.response import Response
-from rest_framework.permissions import IsAuthenticated, AllowAny
-from rest_framework_simplejwt.tokens import RefreshToken
-from django.contrib.auth import authenticate
+from rest_framework.permissions import SAFE_METHODS, IsAdminUser, IsAuthenticated, AllowAny
+from apps.core.sparse import SparseFieldsMixin
+from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
+from .authentication import VersionedRefreshToken, get_stats
+from . import revocation
+from .hashing import check_credentials
+from .throttling import LoginAccountThrottle, LoginIPThrottle, RegisterIPThrottle
 from .models import User
-from .serializers import UserRegistrationSerializer, UserProfileSerializer, LoginSerializer
+from .serializers import (
+    UserRegistrationSerializer, UserProfileSerializer, LoginSerializer, LogoutSerializer, TokenRefreshSerializer,
+)
 from django.views.decorators.csrf import csrf_exempt
 from django.utils.decorators import method_decorator
 
 @csrf_exempt
 @api_view(['POST'])
 @permission_classes([AllowAny])
+@throttle_classes([RegisterIPThrottle])
 def register_user(request):
     serializer = UserRegistrationSerializer(data=request.data)
     if serializer.is_valid():
         user = serializer.save()
-        refresh = RefreshToken.for_user(user)
+        refresh = VersionedRefreshToken.for_user(user)
         return Response({
             'user': UserProfileSerializer(user).data,
             'refresh': str(refresh),
@@ -26,15 +33,17 @@ def register_user(request):
 
 @api_view(['POST', "GET"])
 @permission_classes([AllowAny])
+@throttle_classes([LoginIPThrottle, LoginAccountThrottle])
 def login_user(request):
     serializer = LoginSerializer(data=request.data)
     if serializer.is_valid():
         email = serializer.validated_data['email']
         password = serializer.validated_data['password']
-        user = authenticate(request, email=email, password=password)
+        # Hashed on a bounded pool, a 503 when it is saturated (see hashing.py)
+        user = check_credentials(email, password)
         
         if user:
-            refresh = RefreshToken.for_user(user)
+            refresh = VersionedRefreshToken.for_user(user)
             return Response({
                 'user': UserProfileSerializer(user).data,
                 'refresh': str(refresh),
@@ -43,9 +52,46 @@ def login_user(request):
         return Response({'error': 'Invalid credentials'}, status=status.HTTP_401_UNAUTHORIZED)
     return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
-class UserProfileView(generics.RetrieveUpdateAPIView):
+@api_view(['POST'])
+@permission_classes([AllowAny])
+def refresh_token(request):
+    """New access token (and rotated refresh token) for a refresh token that isn't revoked"""
+    serializer = TokenRefreshSerializer(data=request.data)
+    try:
+        serializer.is_valid(raise_exception=True)
+    except TokenError as e:
+        raise InvalidToken(e.args[0])
+    return Response(serializer.validated_data)
+
+@api_view(['POST'])
+@permission_classes([AllowAny])
+def logout_user(request):
+    """Revoke a refresh token, access tokens made from it last until they expire"""
+    serializer = LogoutSerializer(data=request.data)
+    try:
+        serializer.is_valid(raise_exception=True)
+    except TokenError as e:
+        raise InvalidToken(e.args[0])
+    return Response(status=status.HTTP_204_NO_CONTENT)
+
+class UserProfileView(SparseFieldsMixin, generics.RetrieveUpdateAPIView):
     serializer_class = UserProfileSerializer
     permission_classes = [IsAuthenticated]
 
     def get_object(self):
-        return self.request.user
+        if self.request.method in SAFE_METHODS:
+            return self.request.user
+        # request.user may come from the user cache, saving it would write its stale columns back
+        return User.objects.get(pk=self.request.user.pk)
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def user_cache_stats(request):
+    """Hit/miss counters of the authenticated-user cache, for this process"""
+    return Response(get_stats())
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def revocation_stats(request):
+    """Counters of the revoked refresh token filter, for this process"""
+    return Response(revocation.get_stats())
@@ -12,5 +12,7 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ecommerce_backend.settings.base')
+# Requests don't keep to one thread here, use DB_POOL_SIZE rather than per-thread persistent connections
+os.environ.setdefault('DB_CONN_MAX_AGE', '0')
 
 application = get_asgi_application()
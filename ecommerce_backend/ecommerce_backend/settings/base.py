@@ -61,9 +61,11 @@ INSTALLED_APPS = [
     "whitenoise.runserver_nostatic",  # For development static serving
 
     # Local apps
+    "apps.core",
     "apps.users",
     "apps.products",
     "apps.orders",
+    "apps.analytics",
 ]
 
 MIDDLEWARE = [
@@ -116,9 +118,21 @@ DATABASE_URL = env("MYSQL_URL", default=None)
 #     }
 # else:
    
+# Connections: with DB_POOL_SIZE > 0 each process shares a pool of that many connections
+# between its threads, checked out per request (see apps.core.db.pool). Otherwise every thread
+# keeps its own connection for DB_CONN_MAX_AGE seconds; asgi.py defaults that to 0, as a
+# connection kept by one thread isn't reused there. Reused connections are pinged before use.
+DB_POOL_SIZE = env.int("DB_POOL_SIZE", default=0)
+DB_POOL = {
+    "max_size": DB_POOL_SIZE,
+    "timeout": env.float("DB_POOL_TIMEOUT", default=5.0),
+    "max_lifetime": env.float("DB_POOL_MAX_LIFETIME", default=600.0),
+    "check_after": env.float("DB_POOL_CHECK_AFTER", default=10.0),
+}
+
 DATABASES = {
             "default": {
-                "ENGINE": "django.db.backends.mysql",
+                "ENGINE": "apps.core.db.mysql",
                 "NAME": env("DB_NAME", default="railway"),
                 "USER": env("DB_USER", default="root"),
                 "PASSWORD": env("DB_PASSWORD", default="UxhYTMwimWUFYCCqTtIAEJQPLLrirKGK"),
@@ -127,11 +141,28 @@ DATABASES = {
                 "OPTIONS": {
                     "init_command": "SET sql_mode='STRICT_TRANS_TABLES'",
                     "charset": "utf8mb4",
+                    "pool": DB_POOL if DB_POOL_SIZE else False,
                 },
+                # Pooled connections go back to the pool at the end of every request
+                "CONN_MAX_AGE": 0 if DB_POOL_SIZE else env.int("DB_CONN_MAX_AGE", default=60),
+                "CONN_HEALTH_CHECKS": env.bool("DB_CONN_HEALTH_CHECKS", default=True),
             }
     }
 
 
+# SHARED CACHE
+# Throttle buckets, the category tree version, featured leaderboards, `with_count` totals,
+# cached users and the token revocation generation are shared between worker processes
+# through this cache, so it must be one all of them reach, e.g. Redis (redis://host:6379/0,
+# rediss:// for TLS). A process-local cache (locmemcache://) only suits a single process,
+# so it is only the default with DEBUG.
+CACHES = {
+    "default": env.cache(
+        "CACHE_URL", default="locmemcache://" if DEBUG else "redis://redis.railway.internal:6379/0"
+    ),
+}
+
+
 # AUTH & JWT
 AUTH_USER_MODEL = "users.User"
 
@@ -139,12 +170,18 @@ REST_FRAMEWORK = {
     'DEFAULT_SCHEMA_CLASS': 'drf_spectacular.openapi.AutoSchema',
 
     "DEFAULT_AUTHENTICATION_CLASSES": (
-        "rest_framework_simplejwt.authentication.JWTAuthentication",
+        "apps.users.authentication.CachedJWTAuthentication",
         "rest_framework.authentication.SessionAuthentication",
     ),
     "DEFAULT_PERMISSION_CLASSES": (
         "rest_framework.permissions.IsAuthenticatedOrReadOnly",
     ),
+    # Token buckets on the auth endpoints, see apps.users.throttling
+    "DEFAULT_THROTTLE_RATES": {
+        "login_ip": env("THROTTLE_LOGIN_IP", default="20/min"),
+        "login_account": env("THROTTLE_LOGIN_ACCOUNT", default="5/min"),
+        "register_ip": env("THROTTLE_REGISTER_IP", default="10/hour"),
+    },
     "DEFAULT_PAGINATION_CLASS": "rest_framework.pagination.PageNumberPagination",
     "PAGE_SIZE": 20,
 
@@ -160,6 +197,29 @@ SIMPLE_JWT = {
     "ROTATE_REFRESH_TOKENS": True,
 }
 
+# Authenticated users are cached by apps.users.authentication.CachedJWTAuthentication:
+# in the shared cache for USER_CACHE_TTL seconds and in each process for USER_CACHE_LOCAL_TTL
+# (a process may serve a changed or deactivated user that long, 0 turns the local cache off)
+USER_CACHE_TTL = env.int("USER_CACHE_TTL", default=300)
+USER_CACHE_LOCAL_TTL = env.int("USER_CACHE_LOCAL_TTL", default=5)
+USER_CACHE_SIZE = env.int("USER_CACHE_SIZE", default=10000)
+
+# Password hashing for login/registration runs on AUTH_HASH_WORKERS threads per process, with
+# up to AUTH_HASH_QUEUE_SIZE requests waiting; beyond that (or after AUTH_HASH_TIMEOUT seconds) a 503
+AUTH_HASH_WORKERS = env.int("AUTH_HASH_WORKERS", default=2)
+AUTH_HASH_QUEUE_SIZE = env.int("AUTH_HASH_QUEUE_SIZE", default=16)
+AUTH_HASH_TIMEOUT = env.float("AUTH_HASH_TIMEOUT", default=5.0)
+
+# Revoked refresh tokens (logout, rotation) are checked in memory, see apps.users.revocation:
+# a Bloom filter sized for REVOCATION_FILTER_CAPACITY tokens plus the REVOCATION_RECENT_SIZE latest,
+# caught up from the table at least every REVOCATION_SYNC_INTERVAL seconds and rebuilt every
+# REVOCATION_REBUILD_INTERVAL seconds
+REVOCATION_FILTER_CAPACITY = env.int("REVOCATION_FILTER_CAPACITY", default=200000)
+REVOCATION_FALSE_POSITIVE_RATE = env.float("REVOCATION_FALSE_POSITIVE_RATE", default=0.001)
+REVOCATION_RECENT_SIZE = env.int("REVOCATION_RECENT_SIZE", default=10000)
+REVOCATION_SYNC_INTERVAL = env.int("REVOCATION_SYNC_INTERVAL", default=30)
+REVOCATION_REBUILD_INTERVAL = env.int("REVOCATION_REBUILD_INTERVAL", default=3600)
+
 # CORS
 CORS_ALLOWED_ORIGINS = env.list(
     "CORS_ALLOWED_ORIGINS",
@@ -185,6 +245,60 @@ EMAIL_HOST_USER = env("EMAIL_HOST_USER", default="")
 EMAIL_HOST_PASSWORD = env("EMAIL_HOST_PASSWORD", default="")
 DEFAULT_FROM_EMAIL = EMAIL_HOST_USER
 
+# PRODUCT SEARCH
+# In-memory inverted index in every worker. `manage.py rebuild_search_index` writes a snapshot
+# here that workers load instead of building their own, empty to always build in memory.
+# Workers catch up on product changes every SEARCH_SYNC_INTERVAL seconds.
+SEARCH_INDEX_PATH = env("SEARCH_INDEX_PATH", default=str(BASE_DIR / "var" / "search_index.json.gz")) or None
+SEARCH_SYNC_INTERVAL = env.int("SEARCH_SYNC_INTERVAL", default=5)
+SEARCH_MAX_RESULTS = env.int("SEARCH_MAX_RESULTS", default=1000)
+
+# FEATURED LEADERBOARDS
+# Cached featured lists older than this (seconds) are served stale and refreshed in the background
+FEATURED_REFRESH_INTERVAL = env.int("FEATURED_REFRESH_INTERVAL", default=300)
+LEADERBOARD_BACKGROUND_REFRESH = env.bool("LEADERBOARD_BACKGROUND_REFRESH", default=True)
+
+# PRODUCT IMPORTS
+# Import jobs whose worker hasn't reported progress for this long (seconds, a crashed
+# worker) are picked up again. Imports are upserts by SKU, so a rerun is harmless.
+PRODUCT_IMPORT_LOCK_TIMEOUT = env.int("PRODUCT_IMPORT_LOCK_TIMEOUT", default=900)
+
+# ORDER NUMBERS
+# Host id (0 - 255) baked into generated ids such as order numbers, together with the
+# process id. Give every machine its own to guarantee uniqueness, unset picks a random
+# node id per process and order creation retries on the rare collision.
+ID_HOST_ID = env.int("ID_HOST_ID", default=None)
+
+# IDEMPOTENCY KEYS
+# Responses to order/payment requests sent with an Idempotency-Key are replayed for this long (seconds)
+IDEMPOTENCY_KEY_TTL = env.int("IDEMPOTENCY_KEY_TTL", default=86400)
+# Completed responses kept in memory per worker
+IDEMPOTENCY_CACHE_SIZE = env.int("IDEMPOTENCY_CACHE_SIZE", default=1000)
+# How long a retry waits for the original request to finish before getting a 409
+IDEMPOTENCY_WAIT = env.float("IDEMPOTENCY_WAIT", default=5.0)
+# A claim older than this (seconds) is considered abandoned and can be taken over
+IDEMPOTENCY_LOCK_TIMEOUT = env.int("IDEMPOTENCY_LOCK_TIMEOUT", default=60)
+
+# PAYMENTS
+# Gateway client used by the payment worker, built with PAYMENT_GATEWAY_OPTIONS as kwargs
+PAYMENT_GATEWAY = env("PAYMENT_GATEWAY", default="apps.orders.gateway.FakeGateway")
+PAYMENT_GATEWAY_OPTIONS = {}
+PAYMENT_MAX_ATTEMPTS = env.int("PAYMENT_MAX_ATTEMPTS", default=5)
+# Retries wait PAYMENT_RETRY_BACKOFF * 2^(attempt - 1) seconds, capped at PAYMENT_RETRY_BACKOFF_MAX
+PAYMENT_RETRY_BACKOFF = env.int("PAYMENT_RETRY_BACKOFF", default=5)
+PAYMENT_RETRY_BACKOFF_MAX = env.int("PAYMENT_RETRY_BACKOFF_MAX", default=600)
+# Jobs stuck in processing this long (a crashed worker) are picked up again
+PAYMENT_JOB_LOCK_TIMEOUT = env.int("PAYMENT_JOB_LOCK_TIMEOUT", default=300)
+
+# ORDER ARCHIVE
+# Delivered and cancelled orders created more than this many days ago are moved to the
+# archive tables by `manage.py archive_orders`. Listings only look in the archive past this
+# age, so don't raise it once orders have been archived.
+ORDER_ARCHIVE_AFTER_DAYS = env.int("ORDER_ARCHIVE_AFTER_DAYS", default=365)
+ORDER_ARCHIVE_BATCH_SIZE = env.int("ORDER_ARCHIVE_BATCH_SIZE", default=500)
+# Batches that hold their row locks longer than this are halved
+ORDER_ARCHIVE_MAX_LOCK_MS = env.int("ORDER_ARCHIVE_MAX_LOCK_MS", default=200)
+
 # INTERNATIONALIZATION
 LANGUAGE_CODE = "en-us"
 TIME_ZONE = "UTC"
@@ -23,6 +23,7 @@ from drf_spectacular.views import SpectacularAPIView, SpectacularSwaggerView, Sp
 from django.views.generic import RedirectView
 from django.conf import settings
 from django.conf.urls.static import static
+from apps.core.views import database_stats
 
 # schema_view = get_schema_view(
 #     openapi.Info(
@@ -46,6 +47,8 @@ urlpatterns = [
     path('api/auth/', include('apps.users.urls')),
     path('api/products/', include('apps.products.urls')),
     path('api/orders/', include('apps.orders.urls')),
+    path('api/analytics/', include('apps.analytics.urls')),
+    path('api/db-stats', database_stats, name='database-stats'),
     
     # API Documentation
     # path('', RedirectView.as_view(url='/swagger/', permanent=False)),
@@ -9,6 +9,12 @@ python manage.py migrate
 # Collect static files (for production)
 python manage.py collectstatic --noinput
 
+# Search index snapshot, so the workers load it instead of each building the index
+python manage.py rebuild_search_index --full
+
+# Featured leaderboards, requests never compute them
+python manage.py refresh_featured
+
 # Create superuser if needed (optional, for dev)
 # python manage.py createsuperuser --noinput || true
 